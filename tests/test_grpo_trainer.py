@@ -12,25 +12,44 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import asyncio
 import tempfile
+import time
 import unittest
+from types import SimpleNamespace
 from unittest.mock import patch
 
 import torch
 from datasets import load_dataset
 from parameterized import parameterized
-from transformers import AutoModelForCausalLM, AutoModelForSequenceClassification, AutoTokenizer
+from transformers import (
+    AutoModelForCausalLM,
+    AutoModelForSequenceClassification,
+    AutoTokenizer,
+    Gemma2Config,
+    Gemma2ForCausalLM,
+)
 from transformers.testing_utils import require_peft
 from transformers.utils import is_peft_available
 
 from trl import GRPOConfig, GRPOTrainer
+from trl.data_utils import maybe_apply_chat_template
 from trl.trainer.grpo_trainer import RepeatSampler
+from trl.trainer.utils import group_consecutive, selective_log_softmax
 
 from .testing_utils import require_vllm
 
 
 if is_peft_available():
-    from peft import LoraConfig, PeftModel
+    from peft import LoraConfig, PeftModel, get_peft_model
+
+
+def process_reward_func(completions, **kwargs):
+    """Reward function called in a process pool, defined at module level so that the workers can import it."""
+    return [float(len(completions[0]))]
+
+
+process_reward_func.concurrency = "process"
 
 
 class RepeatRandomSamplerTester(unittest.TestCase):
@@ -142,6 +161,219 @@ class RepeatRandomSamplerTester(unittest.TestCase):
         assert sampled[24:28] == sampled[28:32] == sampled[32:36]
 
 
+class GatherGroupsTester(unittest.TestCase):
+    # 4 prompts with 3 completions each, spread over processes of 2 rows (groups split across processes) or 4 rows
+    # (processes with groups of uneven sizes)
+    @parameterized.expand([(2,), (4,)])
+    def test_gather_groups(self, per_device_batch_size):
+        num_generations = 3
+        prompts = [prompt for prompt in ["A", "B", "C", "D"] for _ in range(num_generations)]
+        local_prompts = [prompts[i : i + per_device_batch_size] for i in range(0, len(prompts), per_device_batch_size)]
+
+        # Each process sends one item per local group (here, its lower-cased prompt), with the size of the group
+        local_groups = []
+        for process_prompts in local_prompts:
+            group_starts, group_sizes = group_consecutive(process_prompts)
+            local_groups.append(([process_prompts[i].lower() for i in group_starts], group_sizes))
+        if per_device_batch_size == 4:
+            self.assertEqual([sizes for _, sizes in local_groups], [[3, 1], [2, 2], [1, 3]])
+
+        with patch("trl.trainer.grpo_trainer.gather_object", return_value=local_groups):
+            for group_items, group_sizes in local_groups:
+                all_items = GRPOTrainer._gather_groups(None, group_items, group_sizes)
+                # One item per row of all the processes, in order
+                self.assertEqual(all_items, [prompt.lower() for prompt in prompts])
+                self.assertEqual(all_items[::num_generations], ["a", "b", "c", "d"])
+
+        # The local tensors, one row per group, are repeated for each row of their group
+        for process_prompts, (group_items, group_sizes) in zip(local_prompts, local_groups):
+            group_ids = torch.tensor([ord(item) for item in group_items])
+            row_ids = group_ids.repeat_interleave(torch.tensor(group_sizes))
+            self.assertEqual(row_ids.tolist(), [ord(prompt.lower()) for prompt in process_prompts])
+
+
+class FilterZeroStdGroupsTester(unittest.TestCase):
+    # 2 processes with 2 gradient accumulation steps of 2 completions, and a generation batch of 4 groups of 3
+    # completions, as with `oversampling_factor=1.5`
+    def filter(self, is_std_zero, process_index):
+        prompt_lengths = torch.tensor([4, 2, 4, 1]).repeat_interleave(3)
+        completion_lengths = torch.tensor([5, 5, 5, 2, 1, 2, 5, 5, 5, 1, 2, 1])
+        prompt_mask = (torch.arange(4) >= 4 - prompt_lengths.unsqueeze(1)).long()  # left-padded
+        completion_mask = (torch.arange(5) < completion_lengths.unsqueeze(1)).long()  # right-padded
+        inputs = {
+            "prompt_ids": torch.randint(1, 100, (12, 4)) * prompt_mask,
+            "prompt_mask": prompt_mask,
+            "completion_ids": torch.randint(1, 100, (12, 5)) * completion_mask,
+            "completion_mask": completion_mask,
+            "advantages": torch.arange(12).float(),  # identifies the rows
+            "old_per_token_logps": None,
+            "ref_per_token_logps": -torch.rand(12, 5) * completion_mask,
+        }
+        trainer = SimpleNamespace(
+            accelerator=SimpleNamespace(
+                num_processes=2, process_index=process_index, pad_across_processes=lambda tensor, **kwargs: tensor
+            ),
+            args=SimpleNamespace(gradient_accumulation_steps=2, per_device_train_batch_size=2),
+            processing_class=SimpleNamespace(pad_token_id=0),
+        )
+        # The inputs stand for the whole generation batch, so gathering them across processes is a no-op
+        with patch("trl.trainer.grpo_trainer.gather", side_effect=lambda tensor: tensor):
+            outputs = GRPOTrainer._filter_zero_std_groups(
+                trainer, inputs, torch.tensor(is_std_zero).repeat_interleave(3)
+            )
+        return inputs, outputs
+
+    @parameterized.expand(
+        [
+            # The 6 remaining completions are rounded down to a multiple of the 4 forward passes of a step
+            ([True, False, True, False], [([3, 4], 2, 2), ([5, 9], 2, 2)]),
+            # The 3 remaining completions are completed with the first one of the dropped groups
+            ([True, False, True, True], [([3, 4], 2, 2), ([5, 0], 4, 5)]),
+            # Only the completions of one step, out of the 12 remaining ones, are kept
+            ([False, False, False, False], [([0, 1, 2, 3], 4, 5), ([4, 5, 6, 7], 4, 5)]),
+        ]
+    )
+    def test_filter_zero_std_groups(self, is_std_zero, expected_outputs):
+        # For each process: the rows it gets, and the lengths of its longest prompt and completion
+        for process_index, (rows, prompt_length, completion_length) in enumerate(expected_outputs):
+            inputs, outputs = self.filter(is_std_zero, process_index)
+
+            # Each process gets its rows in order, as many as the other processes, and a multiple of the number of
+            # gradient accumulation steps
+            self.assertEqual(outputs["advantages"].tolist(), [float(row) for row in rows])
+            self.assertEqual(len(rows) % 2, 0)
+            self.assertIsNone(outputs["old_per_token_logps"])
+
+            # The padding columns that are no longer needed by the rows of the process are trimmed
+            for key in ["prompt_ids", "prompt_mask"]:
+                self.assertEqual(outputs[key].tolist(), inputs[key][rows, -prompt_length:].tolist())
+                self.assertTrue(inputs[key][rows, :-prompt_length].eq(0).all())
+            for key in ["completion_ids", "completion_mask", "ref_per_token_logps"]:
+                self.assertEqual(outputs[key].tolist(), inputs[key][rows, :completion_length].tolist())
+                self.assertTrue(inputs[key][rows, completion_length:].eq(0).all())
+
+
+@require_peft
+class PeftParamNameToVLLMTester(unittest.TestCase):
+    def setUp(self):
+        model = AutoModelForCausalLM.from_pretrained("trl-internal-testing/tiny-Qwen2ForCausalLM-2.5")
+        self.base_state_dict_keys = set(model.state_dict())
+        self.base_param_names = {name for name, _ in model.named_parameters()}
+        peft_config = LoraConfig(target_modules=["q_proj", "v_proj"], modules_to_save=["down_proj"], bias="all")
+        self.model = get_peft_model(model, peft_config)
+
+    def sent_names(self, vllm_sync_adapted_modules_only):
+        trainer = SimpleNamespace(
+            model=self.model, args=SimpleNamespace(vllm_sync_adapted_modules_only=vllm_sync_adapted_modules_only)
+        )
+        names = [
+            GRPOTrainer._peft_param_name_to_vllm(trainer, name, param) for name, param in self.model.named_parameters()
+        ]
+        return [name for name in names if name is not None]
+
+    def test_all_params(self):
+        # All the parameters of the base model are sent once, without the adapter and `original_module` weights
+        names = self.sent_names(vllm_sync_adapted_modules_only=False)
+        self.assertEqual(len(names), len(set(names)))
+        self.assertEqual(set(names), self.base_param_names)
+
+    def test_adapted_modules_only(self):
+        names = self.sent_names(vllm_sync_adapted_modules_only=True)
+        self.assertEqual(len(names), len(set(names)))
+        self.assertTrue(set(names) <= self.base_state_dict_keys)
+        # The weights of the modules with adapters, of the modules to save, and the trainable parameters (all the
+        # biases, with `bias="all"`)
+        expected_names = {
+            name
+            for name in self.base_param_names
+            if any(module in name for module in ["q_proj", "v_proj", "down_proj"]) or name.endswith(".bias")
+        }
+        self.assertEqual(set(names), expected_names)
+        self.assertTrue(any(name.endswith("k_proj.bias") for name in names))
+        self.assertFalse(any(name.endswith("k_proj.weight") for name in names))
+
+
+class PrepareConversationsTester(unittest.TestCase):
+    def _prepare_conversations_per_conversation(self, tokenizer, inputs):
+        # Reference implementation: template and tokenize the prompt and completion of each turn of each conversation
+        # separately, and concatenate them
+        sequences = []
+        for conversation in inputs:
+            token_ids, is_completion = [], []
+            prompt = []
+            for message in conversation["messages"]:
+                if message["role"] != "assistant":
+                    prompt.append(message)
+                    continue
+                for segment, segment_is_completion in ((prompt, False), ([message], True)):
+                    text = maybe_apply_chat_template({"messages": segment}, tokenizer)["text"] if segment else ""
+                    segment_ids = tokenizer(text, add_special_tokens=True)["input_ids"]
+                    token_ids += segment_ids
+                    is_completion += [segment_is_completion] * len(segment_ids)
+                prompt = []
+            sequences.append((token_ids, is_completion))
+
+        max_length = max(len(token_ids) for token_ids, _ in sequences)
+        conversation_ids = torch.full((len(inputs), max_length), tokenizer.pad_token_id)
+        attention_mask = torch.zeros((len(inputs), max_length), dtype=torch.long)
+        completion_mask = torch.zeros((len(inputs), max_length), dtype=torch.bool)
+        for row, (token_ids, is_completion) in enumerate(sequences):
+            conversation_ids[row, : len(token_ids)] = torch.tensor(token_ids, dtype=torch.long)
+            attention_mask[row, : len(token_ids)] = 1
+            completion_mask[row, 1 : len(token_ids)] = torch.tensor(is_completion[1:], dtype=torch.bool)
+        position_ids = torch.arange(max_length).expand(len(inputs), -1)
+        return {
+            "conversation_ids": conversation_ids,
+            "attention_mask": attention_mask,
+            "completion_mask": completion_mask,
+            "position_ids": position_ids,
+        }
+
+    def test_prepare_conversations(self):
+        tokenizer = AutoTokenizer.from_pretrained("trl-internal-testing/tiny-Qwen2ForCausalLM-2.5")
+        inputs = [
+            {
+                "messages": [
+                    {"role": "system", "content": "You are a helpful assistant."},
+                    {"role": "user", "content": "Hello!"},
+                    {"role": "assistant", "content": "Hi there, how can I help?"},
+                    {"role": "user", "content": "List the pods."},
+                    {"role": "tool", "content": "pod-1 pod-2"},
+                    {"role": "assistant", "content": "There are two pods."},
+                ],
+                "problem_id": "1",
+            },
+            {
+                "messages": [
+                    {"role": "user", "content": "What is the capital of France?"},
+                    {"role": "assistant", "content": ""},
+                    {"role": "user", "content": "Are you there?"},
+                ],
+                "problem_id": "2",
+            },
+            {
+                "messages": [
+                    {"role": "user", "content": "Count to three."},
+                    {"role": "assistant", "content": "One."},
+                    {"role": "user", "content": "Go on."},
+                    {"role": "assistant", "content": "Two."},
+                    {"role": "user", "content": "And?"},
+                    {"role": "assistant", "content": "Three."},
+                ],
+                "problem_id": "3",
+            },
+        ]
+        trainer = SimpleNamespace(processing_class=tokenizer, accelerator=SimpleNamespace(device="cpu"))
+
+        outputs = GRPOTrainer._prepare_conversations(trainer, inputs)
+
+        expected_outputs = self._prepare_conversations_per_conversation(tokenizer, inputs)
+        self.assertEqual(outputs.keys(), expected_outputs.keys())
+        for key, expected in expected_outputs.items():
+            self.assertEqual(outputs[key].dtype, expected.dtype, key)
+            torch.testing.assert_close(outputs[key], expected, msg=key)
+
+
 class GRPOTrainerTester(unittest.TestCase):
     def test_init_minimal(self):
         # Test that GRPOTrainer can be instantiated with only model, reward_model and train_dataset
@@ -270,6 +502,190 @@ class GRPOTrainerTester(unittest.TestCase):
                 new_param = trainer.model.get_parameter(n)
                 self.assertFalse(torch.equal(param, new_param), f"Parameter {n} has not changed.")
 
+    def test_training_logprob_chunk_size(self):
+        dataset = load_dataset("trl-internal-testing/zen", "standard_prompt_only", split="train")
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            training_args = GRPOConfig(
+                output_dir=tmp_dir,
+                learning_rate=0.1,  # increase the learning rate to speed up the test
+                per_device_train_batch_size=3,  # reduce the batch size to reduce memory usage
+                num_generations=3,  # reduce the number of generations to reduce memory usage
+                max_completion_length=8,  # reduce the completion length to reduce memory usage
+                num_iterations=2,
+                logprob_chunk_size=5,  # smaller than the number of completion tokens of a batch
+                report_to="none",
+            )
+            trainer = GRPOTrainer(
+                model="trl-internal-testing/tiny-Qwen2ForCausalLM-2.5",
+                reward_funcs="trl-internal-testing/tiny-Qwen2ForSequenceClassification-2.5",
+                args=training_args,
+                train_dataset=dataset,
+            )
+
+            previous_trainable_params = {n: param.clone() for n, param in trainer.model.named_parameters()}
+
+            trainer.train()
+
+            self.assertIsNotNone(trainer.state.log_history[-1]["train_loss"])
+
+            # Check that the params have changed
+            for n, param in previous_trainable_params.items():
+                new_param = trainer.model.get_parameter(n)
+                self.assertFalse(torch.equal(param, new_param), f"Parameter {n} has not changed.")
+
+    def test_training_logprob_max_batch_tokens(self):
+        dataset = load_dataset("trl-internal-testing/zen", "standard_prompt_only", split="train")
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            training_args = GRPOConfig(
+                output_dir=tmp_dir,
+                learning_rate=0.1,  # increase the learning rate to speed up the test
+                per_device_train_batch_size=3,  # reduce the batch size to reduce memory usage
+                num_generations=3,  # reduce the number of generations to reduce memory usage
+                max_completion_length=8,  # reduce the completion length to reduce memory usage
+                num_iterations=2,
+                logprob_max_batch_tokens=20,  # smaller than the number of tokens of a batch
+                report_to="none",
+            )
+            trainer = GRPOTrainer(
+                model="trl-internal-testing/tiny-Qwen2ForCausalLM-2.5",
+                reward_funcs="trl-internal-testing/tiny-Qwen2ForSequenceClassification-2.5",
+                args=training_args,
+                train_dataset=dataset,
+            )
+
+            previous_trainable_params = {n: param.clone() for n, param in trainer.model.named_parameters()}
+
+            trainer.train()
+
+            self.assertIsNotNone(trainer.state.log_history[-1]["train_loss"])
+
+            # Check that the params have changed
+            for n, param in previous_trainable_params.items():
+                new_param = trainer.model.get_parameter(n)
+                self.assertFalse(torch.equal(param, new_param), f"Parameter {n} has not changed.")
+
+    def test_training_reuse_prompt_kv_cache(self):
+        dataset = load_dataset("trl-internal-testing/zen", "standard_prompt_only", split="train")
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            training_args = GRPOConfig(
+                output_dir=tmp_dir,
+                learning_rate=0.1,  # increase the learning rate to speed up the test
+                per_device_train_batch_size=3,  # reduce the batch size to reduce memory usage
+                num_generations=3,  # reduce the number of generations to reduce memory usage
+                max_completion_length=8,  # reduce the completion length to reduce memory usage
+                num_iterations=2,
+                beta=0.1,  # ensure the reference model is used too
+                reuse_prompt_kv_cache=True,
+                report_to="none",
+            )
+            trainer = GRPOTrainer(
+                model="trl-internal-testing/tiny-Qwen2ForCausalLM-2.5",
+                reward_funcs="trl-internal-testing/tiny-Qwen2ForSequenceClassification-2.5",
+                args=training_args,
+                train_dataset=dataset,
+            )
+
+            previous_trainable_params = {n: param.clone() for n, param in trainer.model.named_parameters()}
+
+            trainer.train()
+
+            self.assertIsNotNone(trainer.state.log_history[-1]["train_loss"])
+
+            # Check that the params have changed
+            for n, param in previous_trainable_params.items():
+                new_param = trainer.model.get_parameter(n)
+                self.assertFalse(torch.equal(param, new_param), f"Parameter {n} has not changed.")
+
+    def test_reuse_prompt_kv_cache_matches_full_forward(self):
+        dataset = load_dataset("trl-internal-testing/zen", "standard_prompt_only", split="train")
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            training_args = GRPOConfig(
+                output_dir=tmp_dir,
+                per_device_train_batch_size=3,  # reduce the batch size to reduce memory usage
+                num_generations=3,  # reduce the number of generations to reduce memory usage
+                report_to="none",
+            )
+            trainer = GRPOTrainer(
+                model="trl-internal-testing/tiny-Qwen2ForCausalLM-2.5",
+                reward_funcs="trl-internal-testing/tiny-Qwen2ForSequenceClassification-2.5",
+                args=training_args,
+                train_dataset=dataset,
+            )
+
+        # Two groups of 3 completions, with left-padded prompts of different lengths and right-padded completions
+        prompt_ids = torch.tensor([[0, 0, 11, 12, 13], [21, 22, 23, 24, 25]]).repeat_interleave(3, dim=0)
+        prompt_mask = torch.tensor([[0, 0, 1, 1, 1], [1, 1, 1, 1, 1]]).repeat_interleave(3, dim=0)
+        completion_ids = torch.randint(5, 100, (6, 4))
+        completion_mask = torch.tensor([[1, 1, 1, 1], [1, 1, 0, 0], [1, 0, 0, 0]]).repeat(2, 1)
+        input_ids = torch.cat([prompt_ids, completion_ids], dim=1).to(trainer.accelerator.device)
+        attention_mask = torch.cat([prompt_mask, completion_mask], dim=1).to(trainer.accelerator.device)
+        completion_mask = completion_mask.to(trainer.accelerator.device)
+
+        with torch.no_grad():
+            trainer.reuse_prompt_kv_cache = False
+            expected_logps = trainer._get_per_token_logps(trainer.model, input_ids, attention_mask, 4)
+            trainer.reuse_prompt_kv_cache = True
+            logps = trainer._get_per_token_logps(trainer.model, input_ids, attention_mask, 4)
+
+        # The log probabilities of the padding tokens are irrelevant
+        torch.testing.assert_close(logps * completion_mask, expected_logps * completion_mask, rtol=1e-4, atol=1e-4)
+
+    @parameterized.expand([("lm_head",), ("final_logit_softcapping",)])
+    def test_conversation_logps_match_model_logits(self, model_type):
+        dataset = load_dataset("trl-internal-testing/zen", "standard_prompt_only", split="train")
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            training_args = GRPOConfig(
+                output_dir=tmp_dir,
+                per_device_train_batch_size=3,  # reduce the batch size to reduce memory usage
+                num_generations=3,  # reduce the number of generations to reduce memory usage
+                temperature=0.7,
+                report_to="none",
+            )
+            trainer = GRPOTrainer(
+                model="trl-internal-testing/tiny-Qwen2ForCausalLM-2.5",
+                reward_funcs="trl-internal-testing/tiny-Qwen2ForSequenceClassification-2.5",
+                args=training_args,
+                train_dataset=dataset,
+            )
+        trainer.is_conversation = True
+
+        if model_type == "lm_head":  # the logits are selected before the LM head
+            model = trainer.model
+        else:  # the logits are post-processed by the forward of the model, which must be used
+            config = Gemma2Config(
+                vocab_size=100,
+                hidden_size=16,
+                intermediate_size=32,
+                num_hidden_layers=2,
+                num_attention_heads=2,
+                num_key_value_heads=1,
+                head_dim=8,
+                final_logit_softcapping=0.5,  # low enough to change the log-probabilities
+                attn_implementation="eager",
+            )
+            model = Gemma2ForCausalLM(config).to(trainer.accelerator.device)
+        self.assertEqual(trainer._logits_are_lm_head_outputs(model), model_type == "lm_head")
+
+        # Right-padded conversations, with the tokens of the assistant turns to score
+        input_ids = torch.randint(5, 100, (3, 8), device=trainer.accelerator.device)
+        attention_mask = torch.tensor([[1] * 8, [1] * 6 + [0] * 2, [1] * 4 + [0] * 4], device=input_ids.device)
+        logits_to_keep = torch.tensor(
+            [[0, 0, 1, 1, 0, 1, 1, 0], [0, 1, 1, 0, 1, 1, 0, 0], [0, 0, 0, 1, 0, 0, 0, 0]], device=input_ids.device
+        ).bool()
+
+        with torch.no_grad():
+            logps = trainer._get_per_token_logps(model, input_ids, attention_mask, logits_to_keep)
+            logits = model(input_ids=input_ids, attention_mask=attention_mask).logits[:, :-1] / 0.7
+            expected_logps = torch.zeros_like(logps)
+            expected_logps[:, 1:] = selective_log_softmax(logits, input_ids[:, 1:])
+
+        torch.testing.assert_close(logps, expected_logps * logits_to_keep, rtol=1e-4, atol=1e-4)
+
     @require_peft
     def test_training_peft(self):
         model = AutoModelForCausalLM.from_pretrained("trl-internal-testing/tiny-Qwen2ForCausalLM-2.5")
@@ -398,6 +814,38 @@ class GRPOTrainerTester(unittest.TestCase):
                 new_param = trainer.model.get_parameter(n)
                 self.assertFalse(torch.equal(param, new_param), f"Parameter {n} has not changed.")
 
+    def test_training_reward_models_on_main_process(self):
+        dataset = load_dataset("trl-internal-testing/zen", "standard_prompt_only", split="train")
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            training_args = GRPOConfig(
+                output_dir=tmp_dir,
+                learning_rate=0.1,  # increase the learning rate to speed up the test
+                per_device_train_batch_size=3,  # reduce the batch size to reduce memory usage
+                num_generations=3,  # reduce the number of generations to reduce memory usage
+                max_completion_length=8,  # reduce the completion length to reduce memory usage
+                report_to="none",
+                reward_models_on_main_process=True,
+                reward_model_batch_size=2,
+            )
+            trainer = GRPOTrainer(
+                model="trl-internal-testing/tiny-Qwen2ForCausalLM-2.5",
+                reward_funcs="trl-internal-testing/tiny-Qwen2ForSequenceClassification-2.5",
+                args=training_args,
+                train_dataset=dataset,
+            )
+
+            previous_trainable_params = {n: param.clone() for n, param in trainer.model.named_parameters()}
+
+            trainer.train()
+
+            self.assertIsNotNone(trainer.state.log_history[-1]["train_loss"])
+
+            # Check that the params have changed
+            for n, param in previous_trainable_params.items():
+                new_param = trainer.model.get_parameter(n)
+                self.assertFalse(torch.equal(param, new_param), f"Parameter {n} has not changed.")
+
     def test_training_reward_func_standard(self):
         # Test if trainer can handle reward function with standard format
         dataset = load_dataset("trl-internal-testing/zen", "standard_prompt_only", split="train")
@@ -433,6 +881,110 @@ class GRPOTrainerTester(unittest.TestCase):
                 new_param = trainer.model.get_parameter(n)
                 self.assertFalse(torch.equal(param, new_param), f"Parameter {n} has not changed.")
 
+    def test_training_concurrent_reward_funcs(self):
+        # Test if trainer can handle async and thread-pool reward functions, called once per sample
+        dataset = load_dataset("trl-internal-testing/zen", "standard_prompt_only", split="train")
+
+        async def async_reward_func(completions, **kwargs):
+            """Async reward function that rewards longer completions."""
+            await asyncio.sleep(0.01)
+            return [float(len(completions[0]))]
+
+        def thread_reward_func(completions, **kwargs):
+            """Reward function that rewards shorter completions."""
+            return [-float(len(completions[0]))]
+
+        thread_reward_func.concurrency = "thread"
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            training_args = GRPOConfig(
+                output_dir=tmp_dir,
+                learning_rate=0.1,  # increase the learning rate to speed up the test
+                per_device_train_batch_size=3,  # reduce the batch size to reduce memory usage
+                num_generations=3,  # reduce the number of generations to reduce memory usage
+                max_completion_length=8,  # reduce the completion length to reduce memory usage
+                report_to="none",
+            )
+            trainer = GRPOTrainer(
+                model="trl-internal-testing/tiny-Qwen2ForCausalLM-2.5",
+                reward_funcs=[async_reward_func, thread_reward_func],
+                args=training_args,
+                train_dataset=dataset,
+            )
+
+            previous_trainable_params = {n: param.clone() for n, param in trainer.model.named_parameters()}
+
+            trainer.train()
+
+            self.assertIsNotNone(trainer.state.log_history[-1]["train_loss"])
+
+            # Check that the params have changed
+            for n, param in previous_trainable_params.items():
+                new_param = trainer.model.get_parameter(n)
+                self.assertFalse(torch.equal(param, new_param), f"Parameter {n} has not changed.")
+
+    def test_process_reward_func(self):
+        # Test that process-pool reward functions run in spawned processes, which are shut down at the end of training
+        dataset = load_dataset("trl-internal-testing/zen", "standard_prompt_only", split="train")
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            training_args = GRPOConfig(
+                output_dir=tmp_dir,
+                per_device_train_batch_size=3,  # reduce the batch size to reduce memory usage
+                num_generations=3,  # reduce the number of generations to reduce memory usage
+                report_to="none",
+            )
+            trainer = GRPOTrainer(
+                model="trl-internal-testing/tiny-Qwen2ForCausalLM-2.5",
+                reward_funcs=process_reward_func,
+                args=training_args,
+                train_dataset=dataset,
+            )
+            inputs = [{"prompt": "The sky is"}] * 3
+            rewards_per_func = trainer._calculate_rewards(
+                inputs, {"prompts": ["The sky is"] * 3, "completions": [" blue.", " red", "!"]}
+            )
+            self.assertEqual(rewards_per_func[:, 0].tolist(), [6.0, 4.0, 1.0])
+            executor = trainer._reward_executors["process"]
+            self.assertEqual(executor._mp_context.get_start_method(), "spawn")
+
+            with patch("transformers.Trainer.train"):
+                trainer.train()
+            self.assertEqual(trainer._reward_executors, {})
+            with self.assertRaises(RuntimeError):  # the pool is shut down
+                executor.submit(process_reward_func, completions=["!"])
+
+    def test_reward_func_timeout(self):
+        # Test that a reward function call that times out yields NaN
+        dataset = load_dataset("trl-internal-testing/zen", "standard_prompt_only", split="train")
+
+        def slow_reward_func(completions, **kwargs):
+            time.sleep(1.0)
+            return [1.0]
+
+        slow_reward_func.concurrency = "thread"
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            training_args = GRPOConfig(
+                output_dir=tmp_dir,
+                per_device_train_batch_size=3,  # reduce the batch size to reduce memory usage
+                num_generations=3,  # reduce the number of generations to reduce memory usage
+                report_to="none",
+                reward_func_timeout=0.1,
+            )
+            trainer = GRPOTrainer(
+                model="trl-internal-testing/tiny-Qwen2ForCausalLM-2.5",
+                reward_funcs=slow_reward_func,
+                args=training_args,
+                train_dataset=dataset,
+            )
+            inputs = [{"prompt": "The sky is"}] * 3
+            with self.assertWarns(UserWarning):
+                rewards_per_func = trainer._calculate_rewards(
+                    inputs, {"prompts": ["The sky is"] * 3, "completions": [" blue."] * 3}
+                )
+            self.assertTrue(torch.isnan(rewards_per_func).all())
+
     def test_training_reward_func_conversational(self):
         # Test if trainer can handle reward function with conversational format
         dataset = load_dataset("trl-internal-testing/zen", "conversational_prompt_only", split="train")
@@ -706,6 +1258,175 @@ class GRPOTrainerTester(unittest.TestCase):
                 new_param = trainer.model.get_parameter(n)
                 self.assertFalse(torch.equal(param, new_param), f"Parameter {n} has not changed.")
 
+    def test_async_generation_requires_vllm_server(self):
+        dataset = load_dataset("trl-internal-testing/zen", "standard_prompt_only", split="train")
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            training_args = GRPOConfig(
+                output_dir=tmp_dir,
+                per_device_train_batch_size=3,  # reduce the batch size to reduce memory usage
+                num_generations=3,  # reduce the number of generations to reduce memory usage
+                report_to="none",
+                temperature=1.0,  # vLLM's log-probabilities are not temperature-scaled
+                async_generation=True,
+            )
+            with self.assertRaises(ValueError):
+                GRPOTrainer(
+                    model="trl-internal-testing/tiny-Qwen2ForCausalLM-2.5",
+                    reward_funcs="trl-internal-testing/tiny-Qwen2ForSequenceClassification-2.5",
+                    args=training_args,
+                    train_dataset=dataset,
+                )
+
+    def test_async_generation_requires_unit_temperature(self):
+        # The old policy log-probabilities come from vLLM, so the default temperature would bias the importance ratio
+        with tempfile.TemporaryDirectory() as tmp_dir, self.assertRaises(ValueError):
+            GRPOConfig(output_dir=tmp_dir, report_to="none", async_generation=True)
+
+    def test_use_vllm_logprobs_requires_vllm(self):
+        dataset = load_dataset("trl-internal-testing/zen", "standard_prompt_only", split="train")
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            training_args = GRPOConfig(
+                output_dir=tmp_dir,
+                per_device_train_batch_size=3,  # reduce the batch size to reduce memory usage
+                num_generations=3,  # reduce the number of generations to reduce memory usage
+                report_to="none",
+                temperature=1.0,  # vLLM's log-probabilities are not temperature-scaled
+                use_vllm_logprobs=True,
+            )
+            with self.assertRaises(ValueError):
+                GRPOTrainer(
+                    model="trl-internal-testing/tiny-Qwen2ForCausalLM-2.5",
+                    reward_funcs="trl-internal-testing/tiny-Qwen2ForSequenceClassification-2.5",
+                    args=training_args,
+                    train_dataset=dataset,
+                )
+
+    def test_use_vllm_logprobs_requires_unit_temperature(self):
+        with tempfile.TemporaryDirectory() as tmp_dir, self.assertRaises(ValueError):
+            GRPOConfig(output_dir=tmp_dir, report_to="none", temperature=0.9, use_vllm_logprobs=True)
+
+    def test_training_filter_zero_std_groups(self):
+        dataset = load_dataset("trl-internal-testing/zen", "standard_prompt_only", split="train")
+
+        def reward_func(completions, **kwargs):
+            """Reward function that rewards longer completions, so that most groups have a non-zero reward std."""
+            return [float(len(completion)) for completion in completions]
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            training_args = GRPOConfig(
+                output_dir=tmp_dir,
+                learning_rate=0.1,  # increase the learning rate to speed up the test
+                per_device_train_batch_size=3,  # reduce the batch size to reduce memory usage
+                num_generations=3,  # reduce the number of generations to reduce memory usage
+                max_completion_length=8,  # reduce the completion length to reduce memory usage
+                filter_zero_std_groups=True,
+                oversampling_factor=2,
+                report_to="none",
+            )
+            trainer = GRPOTrainer(
+                model="trl-internal-testing/tiny-Qwen2ForCausalLM-2.5",
+                reward_funcs=reward_func,
+                args=training_args,
+                train_dataset=dataset,
+            )
+
+            previous_trainable_params = {n: param.clone() for n, param in trainer.model.named_parameters()}
+
+            trainer.train()
+
+            self.assertIsNotNone(trainer.state.log_history[-1]["train_loss"])
+            self.assertTrue(any("frac_reward_zero_std" in log for log in trainer.state.log_history))
+
+            # Check that the params have changed
+            for n, param in previous_trainable_params.items():
+                new_param = trainer.model.get_parameter(n)
+                self.assertFalse(torch.equal(param, new_param), f"Parameter {n} has not changed.")
+
+    def test_oversampling_factor_requires_filter_zero_std_groups(self):
+        dataset = load_dataset("trl-internal-testing/zen", "standard_prompt_only", split="train")
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            training_args = GRPOConfig(
+                output_dir=tmp_dir,
+                per_device_train_batch_size=3,  # reduce the batch size to reduce memory usage
+                num_generations=3,  # reduce the number of generations to reduce memory usage
+                report_to="none",
+                oversampling_factor=2,
+            )
+            with self.assertRaises(ValueError):
+                GRPOTrainer(
+                    model="trl-internal-testing/tiny-Qwen2ForCausalLM-2.5",
+                    reward_funcs="trl-internal-testing/tiny-Qwen2ForSequenceClassification-2.5",
+                    args=training_args,
+                    train_dataset=dataset,
+                )
+
+    def test_reuse_prompt_kv_cache_incompatible_with_gradient_checkpointing(self):
+        dataset = load_dataset("trl-internal-testing/zen", "standard_prompt_only", split="train")
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            training_args = GRPOConfig(
+                output_dir=tmp_dir,
+                per_device_train_batch_size=3,  # reduce the batch size to reduce memory usage
+                num_generations=3,  # reduce the number of generations to reduce memory usage
+                report_to="none",
+                reuse_prompt_kv_cache=True,
+                gradient_checkpointing=True,
+            )
+            with self.assertRaises(ValueError):
+                GRPOTrainer(
+                    model="trl-internal-testing/tiny-Qwen2ForCausalLM-2.5",
+                    reward_funcs="trl-internal-testing/tiny-Qwen2ForSequenceClassification-2.5",
+                    args=training_args,
+                    train_dataset=dataset,
+                )
+
+    def test_use_vllm_ref_model_requires_unit_temperature(self):
+        with tempfile.TemporaryDirectory() as tmp_dir, self.assertRaises(ValueError):
+            GRPOConfig(output_dir=tmp_dir, report_to="none", beta=0.1, temperature=0.9, use_vllm_ref_model=True)
+
+    def test_use_vllm_ref_model_requires_vllm_server(self):
+        dataset = load_dataset("trl-internal-testing/zen", "standard_prompt_only", split="train")
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            training_args = GRPOConfig(
+                output_dir=tmp_dir,
+                per_device_train_batch_size=3,  # reduce the batch size to reduce memory usage
+                num_generations=3,  # reduce the number of generations to reduce memory usage
+                report_to="none",
+                beta=0.1,
+                temperature=1.0,  # the reference log-probabilities of vLLM are not temperature-scaled
+                use_vllm_ref_model=True,
+            )
+            with self.assertRaises(ValueError):
+                GRPOTrainer(
+                    model="trl-internal-testing/tiny-Qwen2ForCausalLM-2.5",
+                    reward_funcs="trl-internal-testing/tiny-Qwen2ForSequenceClassification-2.5",
+                    args=training_args,
+                    train_dataset=dataset,
+                )
+
+    def test_padding_free_requires_conversation(self):
+        dataset = load_dataset("trl-internal-testing/zen", "standard_prompt_only", split="train")
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            training_args = GRPOConfig(
+                output_dir=tmp_dir,
+                per_device_train_batch_size=3,  # reduce the batch size to reduce memory usage
+                num_generations=3,  # reduce the number of generations to reduce memory usage
+                report_to="none",
+                padding_free=True,
+            )
+            with self.assertRaises(ValueError):
+                GRPOTrainer(
+                    model="trl-internal-testing/tiny-Qwen2ForCausalLM-2.5",
+                    reward_funcs="trl-internal-testing/tiny-Qwen2ForSequenceClassification-2.5",
+                    args=training_args,
+                    train_dataset=dataset,
+                )
+
     def test_training_with_sync_ref_model(self):
         dataset = load_dataset("trl-internal-testing/zen", "standard_prompt_only", split="train")
 
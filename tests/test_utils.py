@@ -32,11 +32,14 @@ from trl.trainer.utils import (
     batch_generation,
     decode_and_strip_padding,
     flush_left,
+    fused_selective_log_softmax,
     generate_model_card,
     get_peft_config,
+    group_consecutive,
     pad,
     print_prompt_completions_sample,
     selective_log_softmax,
+    split_by_token_budget,
 )
 
 from .testing_utils import require_rich
@@ -493,6 +496,56 @@ class TestFlushLeft(unittest.TestCase):
         self.assertTrue(torch.equal(new_mask, expected_mask))
 
 
+class TestGroupConsecutive(unittest.TestCase):
+    def test_basic_case(self):
+        self.assertEqual(group_consecutive(["a", "a", "b", "c", "c", "c"]), ([0, 2, 3], [2, 1, 3]))
+
+    def test_empty(self):
+        self.assertEqual(group_consecutive([]), ([], []))
+
+    def test_conversational_items(self):
+        first = [{"role": "user", "content": "Hi"}]
+        second = [{"role": "user", "content": "Hello"}]
+        self.assertEqual(group_consecutive([first, first, second]), ([0, 2], [2, 1]))
+
+    def test_non_consecutive_duplicates(self):
+        # Equal items are only grouped when they are consecutive
+        self.assertEqual(group_consecutive(["a", "b", "a"]), ([0, 1, 2], [1, 1, 1]))
+
+
+class TestSplitByTokenBudget(unittest.TestCase):
+    def test_basic_case(self):
+        lengths = torch.tensor([3, 8, 2, 5])
+        micro_batches = split_by_token_budget(lengths, max_tokens=10)
+
+        # Sorted by decreasing length: [8], then [5, 3] (2 * 5 = 10 tokens), then [2]
+        expected = [torch.tensor([1]), torch.tensor([3, 0]), torch.tensor([2])]
+        self.assertEqual(len(micro_batches), len(expected))
+        for micro_batch, expected_micro_batch in zip(micro_batches, expected):
+            self.assertTrue(torch.equal(micro_batch, expected_micro_batch))
+
+    def test_row_longer_than_budget(self):
+        lengths = torch.tensor([12, 2])
+        micro_batches = split_by_token_budget(lengths, max_tokens=10)
+
+        self.assertEqual([micro_batch.tolist() for micro_batch in micro_batches], [[0], [1]])
+
+    def test_segments(self):
+        # Each segment is padded separately, so the padded length of [[4, 1], [1, 4]] is 8, not 5
+        lengths = torch.tensor([[4, 1], [1, 4], [1, 1]])
+        micro_batches = split_by_token_budget(lengths, max_tokens=10)
+
+        self.assertEqual([micro_batch.tolist() for micro_batch in micro_batches], [[0], [1, 2]])
+
+    def test_covers_all_rows(self):
+        lengths = torch.randint(1, 20, (50,))
+        micro_batches = split_by_token_budget(lengths, max_tokens=64)
+
+        self.assertEqual(sorted(torch.cat(micro_batches).tolist()), list(range(50)))
+        for micro_batch in micro_batches:
+            self.assertTrue(len(micro_batch) == 1 or len(micro_batch) * lengths[micro_batch].max() <= 64)
+
+
 class TestSelectiveLogSoftmax(unittest.TestCase):
     @parameterized.expand([(torch.float64,), (torch.float32,), (torch.float16,), (torch.bfloat16,)])
     def test_selective_log_softmax(self, dtype):
@@ -514,6 +567,65 @@ class TestSelectiveLogSoftmax(unittest.TestCase):
             torch.testing.assert_close(actual_output, expected_output, rtol=1e-5, atol=1e-5)
 
 
+class TestFusedSelectiveLogSoftmax(unittest.TestCase):
+    @parameterized.expand([(True,), (False,)])
+    def test_fused_selective_log_softmax(self, use_bias):
+        hidden_size = 16
+        vocab_size = 128
+        batch_size = 3
+        seq_len = 37  # not a multiple of the chunk size
+
+        hidden_states = torch.randn(batch_size, seq_len, hidden_size, dtype=torch.float64, requires_grad=True)
+        weight = torch.randn(vocab_size, hidden_size, dtype=torch.float64, requires_grad=True)
+        bias = torch.randn(vocab_size, dtype=torch.float64, requires_grad=True) if use_bias else None
+        input_ids = torch.randint(low=0, high=vocab_size, size=(batch_size, seq_len))
+        grad_output = torch.randn(batch_size, seq_len, dtype=torch.float64)
+
+        logits = torch.nn.functional.linear(hidden_states, weight, bias) / 0.7
+        expected_output = selective_log_softmax(logits, input_ids)
+        expected_grads = torch.autograd.grad(
+            expected_output, [t for t in (hidden_states, weight, bias) if t is not None], grad_output
+        )
+
+        actual_output = fused_selective_log_softmax(hidden_states, weight, input_ids, bias, 0.7, chunk_size=8)
+        actual_grads = torch.autograd.grad(
+            actual_output, [t for t in (hidden_states, weight, bias) if t is not None], grad_output
+        )
+
+        torch.testing.assert_close(actual_output, expected_output)
+        for actual_grad, expected_grad in zip(actual_grads, expected_grads):
+            torch.testing.assert_close(actual_grad, expected_grad)
+
+    def test_fused_selective_log_softmax_bfloat16(self):
+        hidden_states = torch.randn(10, 8, dtype=torch.bfloat16, requires_grad=True)
+        weight = torch.randn(32, 8, dtype=torch.bfloat16, requires_grad=True)
+        input_ids = torch.randint(low=0, high=32, size=(10,))
+
+        output = fused_selective_log_softmax(hidden_states, weight, input_ids, chunk_size=4)
+        grads = torch.autograd.grad(output.sum(), [hidden_states, weight])
+
+        # Reference with the logits computed in bfloat16, as the fused forward does, and the softmax in float32
+        expected_output = selective_log_softmax((hidden_states @ weight.T).float(), input_ids)
+        expected_grads = torch.autograd.grad(expected_output.sum(), [hidden_states, weight])
+        torch.testing.assert_close(output, expected_output)
+        for grad, expected_grad in zip(grads, expected_grads):
+            self.assertEqual(grad.dtype, torch.bfloat16)
+            torch.testing.assert_close(grad, expected_grad, rtol=2e-2, atol=2e-2)
+
+    def test_fused_selective_log_softmax_frozen_weight(self):
+        hidden_states = torch.randn(10, 8, requires_grad=True)
+        weight = torch.randn(32, 8)  # e.g. frozen LM head with LoRA
+        input_ids = torch.randint(low=0, high=32, size=(10,))
+
+        output = fused_selective_log_softmax(hidden_states, weight, input_ids, chunk_size=4)
+        output.sum().backward()
+
+        expected_output = selective_log_softmax(hidden_states @ weight.T, input_ids)
+        torch.testing.assert_close(output, expected_output)
+        self.assertEqual(output.dtype, torch.float32)
+        self.assertIsNotNone(hidden_states.grad)
+
+
 @require_rich
 class TestPrintPromptCompletionsSample(unittest.TestCase):
     @patch("sys.stdout", new_callable=StringIO)
@@ -12,20 +12,47 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import asyncio
 import os
 import signal
+import struct
 import subprocess
+import threading
+import time
 import unittest
+from concurrent.futures import ThreadPoolExecutor
+from itertools import count
+from multiprocessing import Pipe
+from types import SimpleNamespace
+from unittest.mock import patch
 
 import psutil
 import pytest
+import requests
+import torch
 from transformers import AutoModelForCausalLM
 from transformers.testing_utils import require_torch_multi_gpu
 
-from trl.extras.vllm_client import VLLMClient
-from trl.scripts.vllm_serve import chunk_list
+from trl.extras.vllm_client import (
+    MultiServerVLLMClient,
+    VLLMClient,
+    _concatenate_outputs,
+    pack_sequences,
+    parse_server_timing,
+    unpack_sequences,
+    update_named_params_in_buckets,
+)
+from trl.scripts.vllm_serve import (
+    EngineScheduler,
+    RequestQueue,
+    ServerMetrics,
+    TokenCostEstimator,
+    WorkerConnection,
+    balance_by_cost,
+    chunk_list,
+)
 
-from .testing_utils import require_3_gpus
+from .testing_utils import require_3_gpus, require_vllm
 
 
 class TestChunkList(unittest.TestCase):
@@ -54,6 +81,615 @@ class TestChunkList(unittest.TestCase):
         )
 
 
+class TestBalanceByCost(unittest.TestCase):
+    def test_balanced(self):
+        self.assertEqual(balance_by_cost([1, 8, 2, 3, 4], 2), [[0, 1], [2, 3, 4]])
+
+    def test_skewed_costs(self):
+        # A single long prompt gets its own worker, instead of half of the prompts as with `chunk_list`
+        chunks = balance_by_cost([100, 1, 1, 1, 1, 1, 1, 1], 2)
+        self.assertEqual(chunks, [[0], [1, 2, 3, 4, 5, 6, 7]])
+
+    def test_more_chunks_than_elements(self):
+        self.assertEqual(balance_by_cost([5, 5], 3), [[0], [1], []])
+
+    def test_all_indices_assigned_once(self):
+        costs = [float(cost) for cost in torch.randint(1, 100, (50,))]
+        chunks = balance_by_cost(costs, 4)
+        self.assertEqual(sorted(index for chunk in chunks for index in chunk), list(range(50)))
+        loads = [sum(costs[index] for index in chunk) for chunk in chunks]
+        self.assertLessEqual(max(loads) - min(loads), max(costs))
+
+
+class TestTokenCostEstimator(unittest.TestCase):
+    @staticmethod
+    def make_output(num_prompt_tokens, completion_lengths):
+        completions = [SimpleNamespace(token_ids=[0] * length) for length in completion_lengths]
+        return SimpleNamespace(prompt_token_ids=[0] * num_prompt_tokens, outputs=completions)
+
+    def test_costs_before_any_output(self):
+        estimator = TokenCostEstimator()
+        costs = estimator.costs([{"prompt_token_ids": [1, 2, 3]}, "abcdefgh"], n=2, max_tokens=10)
+        self.assertEqual(costs, [3 + 2 * 10, 8 * 0.25 + 2 * 10])
+
+    def test_update(self):
+        estimator = TokenCostEstimator(momentum=0.0)
+        prompts = ["abcd", {"prompt_token_ids": [1, 2]}]
+        estimator.update(prompts, [self.make_output(4, [2, 4]), self.make_output(2, [6, 8])])
+        self.assertEqual(estimator.tokens_per_char, 1.0)  # only the text prompt is used
+        self.assertEqual(estimator.completion_length, 5.0)
+        self.assertEqual(estimator.costs(["ab"], n=1, max_tokens=16), [2 + 5])
+        self.assertEqual(estimator.costs(["ab"], n=1, max_tokens=3), [2 + 3])  # capped by max_tokens
+
+
+class TestRequestQueue(unittest.TestCase):
+    def test_unlimited(self):
+        async def test():
+            queue = RequestQueue()
+            for _ in range(3):
+                await queue.acquire(100)
+            return queue.inflight_tokens, queue.is_full(100)
+
+        self.assertEqual(asyncio.run(test()), (300, False))
+
+    def test_queued_by_priority(self):
+        async def test():
+            queue = RequestQueue(max_inflight_tokens=10)
+            await queue.acquire(8)
+            admitted = []
+
+            async def request(name, cost, priority):
+                await queue.acquire(cost, priority)
+                admitted.append(name)
+
+            tasks = [
+                asyncio.create_task(request("low", 5, priority=1)),
+                asyncio.create_task(request("high", 5, priority=0)),
+                asyncio.create_task(request("too_large", 20, priority=2)),
+            ]
+            await asyncio.sleep(0)
+            self.assertEqual((admitted, queue.num_queued), ([], 3))
+            queue.release(8)
+            await asyncio.sleep(0)
+            self.assertEqual(admitted, ["high", "low"])
+            queue.release(5)
+            queue.release(5)
+            await asyncio.gather(*tasks)
+            self.assertEqual(admitted, ["high", "low", "too_large"])  # admitted alone, since it exceeds the budget
+            return queue.inflight_tokens
+
+        self.assertEqual(asyncio.run(test()), 20)
+
+    def test_is_full(self):
+        async def test():
+            queue = RequestQueue(max_inflight_tokens=10, max_queued_requests=1)
+            self.assertFalse(queue.is_full(5))
+            await queue.acquire(5)
+            self.assertFalse(queue.is_full(5))  # fits in the budget
+            self.assertFalse(queue.is_full(6))  # would wait, but the queue is empty
+            task = asyncio.create_task(queue.acquire(6))
+            await asyncio.sleep(0)
+            self.assertTrue(queue.is_full(1))  # the queue is full, and requests can't overtake the waiting one
+            queue.release(5)
+            await task
+
+        asyncio.run(test())
+
+    def test_cancelled_request_leaves_queue(self):
+        async def test():
+            queue = RequestQueue(max_inflight_tokens=10)
+            await queue.acquire(10)
+            task = asyncio.create_task(queue.acquire(5))
+            await asyncio.sleep(0)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+            return queue.num_queued, queue.inflight_tokens
+
+        self.assertEqual(asyncio.run(test()), (0, 10))
+
+
+@require_vllm
+class TestEngineScheduler(unittest.TestCase):
+    class FakeEngine:
+        # Finishes one request per step, in the order they were added, and generates the prompt as completion
+        def __init__(self):
+            self.requests = []
+            # Engines whose unfinished states are all-reduced, like the DP group of vLLM, and results of the all-reduces
+            self.dp_group, self.dp_results = [self], []
+            self.num_checks = 0
+            self.num_dummy_steps = 0
+            self.should_execute_dummy_batch = False
+
+        def has_unfinished_requests(self):
+            # The first engine making its i-th check computes the result of the i-th check of the whole group, before
+            # any other engine steps, like a collective call
+            self.num_checks += 1
+            if len(self.dp_results) < self.num_checks:
+                self.dp_results.append(any(engine.requests for engine in self.dp_group))
+            has_unfinished = self.dp_results[self.num_checks - 1]
+            self.should_execute_dummy_batch = has_unfinished and not self.requests
+            return has_unfinished
+
+        def add_request(self, request_id, prompt, sampling_params):
+            if prompt == "invalid":
+                raise ValueError("Invalid prompt")
+            self.requests.append((request_id, prompt))
+
+        def abort_request(self, request_ids):
+            self.requests = [request for request in self.requests if request[0] not in request_ids]
+
+        def step(self):
+            if self.should_execute_dummy_batch:
+                self.should_execute_dummy_batch = False
+                self.num_dummy_steps += 1
+                return []
+            if not self.requests:
+                return []
+            request_id, prompt = self.requests.pop(0)
+            return [SimpleNamespace(request_id=request_id, finished=True, outputs=[prompt])]
+
+    def setUp(self):
+        from vllm import SamplingParams
+
+        self.sampling_params = SamplingParams
+        self.llm = SimpleNamespace(llm_engine=self.FakeEngine(), request_counter=count())
+        self.parent_connection, child_connection = Pipe()
+        self.scheduler = EngineScheduler(self.llm, child_connection)
+
+    def received(self):
+        messages = []
+        while self.parent_connection.poll():
+            messages.append(self.parent_connection.recv())
+        return messages
+
+    def run_until_finished(self):
+        while not self.scheduler.is_idle():
+            self.scheduler.step()
+
+    def test_generations_are_batched(self):
+        sampling_params = self.sampling_params()
+        call = {"type": "call", "method": "generate", "request_id": 0}
+        self.scheduler.add({**call, "kwargs": {"prompts": ["a", "b"], "sampling_params": sampling_params}})
+        # The second command starts before the first one is finished
+        self.scheduler.step()
+        stream = {"type": "stream", "request_id": 1}
+        self.scheduler.add({**stream, "kwargs": {"prompts": ["c"], "sampling_params": sampling_params}})
+        self.run_until_finished()
+
+        messages = self.received()
+        outputs = [
+            [output.outputs for output in message["result"]] for message in messages if message["request_id"] == 0
+        ]
+        self.assertEqual(outputs, [[["a"], ["b"]]])
+        streamed = [message["result"] for message in messages if message["request_id"] == 1]
+        self.assertEqual(streamed[0]["index"], 0)
+        self.assertEqual(streamed[0]["output"].outputs, ["c"])
+        self.assertIsNone(streamed[1])
+
+    def test_data_parallel_ranks_step_in_lockstep(self):
+        # A second DP rank, with a single prompt while the first one has three
+        other_llm = SimpleNamespace(llm_engine=self.FakeEngine(), request_counter=count())
+        dp_group, dp_results = [self.llm.llm_engine, other_llm.llm_engine], []
+        for engine in dp_group:
+            engine.dp_group, engine.dp_results = dp_group, dp_results
+        other_parent_connection, other_child_connection = Pipe()
+        other_scheduler = EngineScheduler(other_llm, other_child_connection)
+        command = {"type": "call", "method": "generate", "request_id": 0}
+        self.scheduler.add(
+            {**command, "kwargs": {"prompts": ["a", "b", "c"], "sampling_params": self.sampling_params()}}
+        )
+        other_scheduler.add({**command, "kwargs": {"prompts": ["d"], "sampling_params": self.sampling_params()}})
+
+        num_steps = 0
+        while not (self.scheduler.is_idle() and other_scheduler.is_idle()):
+            # Both ranks must stay busy, and step, as long as one of them has unfinished requests
+            self.assertEqual(self.scheduler.is_idle(), other_scheduler.is_idle())
+            self.scheduler.step()
+            other_scheduler.step()
+            num_steps += 1
+        # 3 steps to finish the prompts of the first rank, and a last one to find that no rank has unfinished requests
+        self.assertEqual(num_steps, 4)
+        self.assertEqual(other_llm.llm_engine.num_dummy_steps, 2)
+        self.assertFalse(other_scheduler.has_unfinished_generations())
+
+    def test_invalid_prompt_aborts_generation(self):
+        command = {"type": "call", "method": "generate", "request_id": 0}
+        kwargs = {"prompts": ["a", "invalid"], "sampling_params": self.sampling_params()}
+        with self.assertRaises(ValueError):
+            self.scheduler.add({**command, "kwargs": kwargs})
+
+        messages = self.received()
+        self.assertEqual(len(messages), 1)
+        self.assertIn("Invalid prompt", messages[0]["error"])
+        self.assertFalse(self.scheduler.has_unfinished_generations())
+        self.assertEqual(self.llm.llm_engine.requests, [])
+
+
+class TestServerMetrics(unittest.TestCase):
+    def test_counter_and_gauge(self):
+        metrics = ServerMetrics()
+        metrics.declare("requests_total", "counter", "Number of requests.")
+        metrics.declare("queued_requests", "gauge", "Number of queued requests.")
+        metrics.inc("requests_total", endpoint="/generate/")
+        metrics.inc("requests_total", 2, endpoint="/generate/")
+        metrics.inc("requests_total", endpoint="/health/")
+        metrics.set("queued_requests", 3)
+        self.assertEqual(
+            metrics.render(),
+            "# HELP requests_total Number of requests.\n"
+            "# TYPE requests_total counter\n"
+            'requests_total{endpoint="/generate/"} 3.0\n'
+            'requests_total{endpoint="/health/"} 1.0\n'
+            "# HELP queued_requests Number of queued requests.\n"
+            "# TYPE queued_requests gauge\n"
+            "queued_requests 3.0\n",
+        )
+
+    def test_histogram(self):
+        metrics = ServerMetrics()
+        metrics.declare("latency_seconds", "histogram", "Latency.", buckets=(0.1, 1.0))
+        for value in (0.05, 0.5, 5.0):
+            metrics.observe("latency_seconds", value, endpoint='say "hi"')
+        lines = metrics.render().splitlines()
+        self.assertEqual(
+            lines[2:],
+            [
+                'latency_seconds_bucket{endpoint="say \\"hi\\"",le="0.1"} 1.0',
+                'latency_seconds_bucket{endpoint="say \\"hi\\"",le="1.0"} 2.0',
+                'latency_seconds_bucket{endpoint="say \\"hi\\"",le="+Inf"} 3.0',
+                'latency_seconds_sum{endpoint="say \\"hi\\""} 5.55',
+                'latency_seconds_count{endpoint="say \\"hi\\""} 3.0',
+            ],
+        )
+
+
+class TestParseServerTiming(unittest.TestCase):
+    def test_parse(self):
+        timings = parse_server_timing("queue;dur=12.5, engine;dur=830")
+        self.assertAlmostEqual(timings["queue"], 0.0125)
+        self.assertAlmostEqual(timings["engine"], 0.83)
+
+    def test_missing_header(self):
+        self.assertEqual(parse_server_timing(None), {})
+
+    def test_metric_without_duration(self):
+        self.assertEqual(parse_server_timing('cache;desc="hit", engine;desc="vLLM";dur=2'), {"engine": 0.002})
+
+
+class TestWorkerConnection(unittest.TestCase):
+    @staticmethod
+    def fake_worker(connection):
+        # Mimics the protocol of `llm_worker`: `sleep` answers after the given delay, `echo` answers immediately
+        connection.send({"status": "ready"})
+        while (command := connection.recv())["type"] != "shutdown":
+            kwargs = command["kwargs"]
+            if command["type"] == "stream":
+                for index, value in enumerate(kwargs["values"]):
+                    connection.send({"request_id": command["request_id"], "result": {"index": index, "output": value}})
+                connection.send({"request_id": command["request_id"], "result": None})
+            elif command["method"] == "fail":
+                connection.send({"request_id": command["request_id"], "error": "Traceback: boom"})
+            else:
+                if command["method"] == "sleep":
+                    time.sleep(kwargs["seconds"])
+                connection.send({"request_id": command["request_id"], "result": kwargs})
+
+    def run_with_worker(self, test):
+        parent_connection, child_connection = Pipe()
+        thread = threading.Thread(target=self.fake_worker, args=(child_connection,), daemon=True)
+        thread.start()
+
+        async def main():
+            worker = WorkerConnection(parent_connection)
+            await worker.wait_ready()
+            return await test(worker)
+
+        try:
+            return asyncio.run(main())
+        finally:
+            parent_connection.send({"type": "shutdown"})
+            thread.join()
+
+    def test_concurrent_calls_are_routed(self):
+        async def test(worker):
+            return await asyncio.gather(*(worker.call("echo", {"value": value}) for value in range(8)))
+
+        results = self.run_with_worker(test)
+        self.assertEqual(results, [{"value": value} for value in range(8)])
+
+    def test_call_does_not_block_event_loop(self):
+        async def test(worker):
+            ticks = 0
+
+            async def tick():
+                nonlocal ticks
+                while True:
+                    ticks += 1
+                    await asyncio.sleep(0.01)
+
+            ticker = asyncio.create_task(tick())
+            result = await worker.call("sleep", {"seconds": 0.3})
+            ticker.cancel()
+            return result, ticks
+
+        result, ticks = self.run_with_worker(test)
+        self.assertEqual(result, {"seconds": 0.3})
+        self.assertGreater(ticks, 5)  # the loop kept running while the worker was busy
+
+    def test_busy_time(self):
+        async def test(worker):
+            self.assertEqual(worker.busy_time, 0.0)
+            await asyncio.gather(worker.call("sleep", {"seconds": 0.2}), worker.call("sleep", {"seconds": 0.1}))
+            busy_time = worker.busy_time
+            await asyncio.sleep(0.2)  # idle
+            return busy_time, worker.busy_time
+
+        busy_time, later_busy_time = self.run_with_worker(test)
+        self.assertGreaterEqual(busy_time, 0.3)
+        self.assertLess(busy_time, 1.0)
+        self.assertEqual(busy_time, later_busy_time)
+
+    def test_stream(self):
+        async def test(worker):
+            return [message async for message in worker.stream({"values": ["a", "b", "c"]})]
+
+        messages = self.run_with_worker(test)
+        self.assertEqual(
+            messages, [{"index": 0, "output": "a"}, {"index": 1, "output": "b"}, {"index": 2, "output": "c"}]
+        )
+
+    def test_error_is_raised(self):
+        async def test(worker):
+            with self.assertRaisesRegex(RuntimeError, "boom"):
+                await worker.call("fail")
+            # The connection is still usable after an error
+            return await worker.call("echo", {"value": 1})
+
+        self.assertEqual(self.run_with_worker(test), {"value": 1})
+
+
+class TestPostGeneration(unittest.TestCase):
+    def make_client(self, statuses, connection_timeout):
+        # A client whose server answers with the given status codes, without a vLLM server
+        client = VLLMClient.__new__(VLLMClient)
+        client.connection_timeout = connection_timeout
+        responses = [
+            SimpleNamespace(status_code=status, headers={"Retry-After": "0.1"}, close=lambda: None)
+            for status in statuses
+        ]
+        client.session = SimpleNamespace(post=lambda url, **kwargs: responses.pop(0))
+        return client
+
+    def test_retries_busy_server(self):
+        client = self.make_client([429, 429, 200], connection_timeout=1.0)
+        self.assertEqual(client._post_generation("http://server/generate/").status_code, 200)
+
+    def test_busy_server_timeout(self):
+        client = self.make_client([429] * 10, connection_timeout=0.25)
+        start_time = time.monotonic()
+        with self.assertRaises(requests.HTTPError) as context:
+            client._post_generation("http://server/generate/")
+        self.assertEqual(context.exception.response.status_code, 429)
+        self.assertLess(time.monotonic() - start_time, 0.25)
+
+
+class TestUpdateNamedParamsInBuckets(unittest.TestCase):
+    def update(self, named_params, bucket_size_mb, status_code=200):
+        # Records the requests posted to the server and the buffers broadcast to its workers
+        requests_json, buffers = [], []
+
+        def post(url, json):
+            requests_json.append(json)
+            return SimpleNamespace(status_code=status_code, text="error")
+
+        session = SimpleNamespace(post=post)
+        communicator = SimpleNamespace(
+            broadcast=lambda buffer, src: buffers.append(buffer), group=SimpleNamespace(barrier=lambda: None)
+        )
+        update_named_params_in_buckets(session, "http://server/", communicator, 1, named_params, bucket_size_mb)
+        return requests_json, buffers
+
+    def test_buckets(self):
+        named_params = [
+            ("a", torch.ones(2, 2)),  # 16 bytes
+            ("b", torch.ones(3, dtype=torch.bfloat16)),  # 6 bytes
+            ("c", torch.full((2,), 2.0)),  # 8 bytes
+            ("d", torch.full((4,), 3.0)),  # 16 bytes, exceeds the 32 bytes of the float32 bucket
+        ]
+        requests_json, buffers = self.update(named_params, bucket_size_mb=32 / 1024 / 1024)
+
+        # A bucket is sent as soon as it's full, then the remaining ones, one per data type
+        names = [request["names"] for request in requests_json]
+        self.assertEqual(names, [["a", "c"], ["d"], ["b"]])
+        self.assertEqual(requests_json[0]["shapes"], [(2, 2), (2,)])
+        self.assertEqual([request["dtype"] for request in requests_json], ["torch.float32"] * 2 + ["torch.bfloat16"])
+        self.assertEqual(buffers[0].tolist(), [1.0] * 4 + [2.0] * 2)
+        self.assertEqual(buffers[1].tolist(), [3.0] * 4)
+
+    def test_failed_request(self):
+        with self.assertRaises(requests.HTTPError):
+            self.update([("a", torch.ones(2))], bucket_size_mb=1, status_code=500)
+
+
+class FakeVLLMClient:
+    # Stands for the `VLLMClient` of a server, which can be taken down and restarted
+    def __init__(self, host, server_port, group_port=51216, connection_timeout=0.0):
+        self.host, self.server_port, self.group_port = host, server_port, group_port
+        self.session = SimpleNamespace(get=self.get)
+        self.timings = {"generate": {"calls": 1, "total": 2.0}}
+        self.server_id = "first"
+        self.down = False
+        self.num_initializations = 0
+        self.prompts = []
+        self.params = {}
+
+    def check(self):
+        if self.down:
+            raise requests.ConnectionError("Connection refused")
+
+    def get(self, url, timeout=None):
+        self.check()
+        return SimpleNamespace(status_code=200, json=lambda: {"status": "ok", "server_id": self.server_id})
+
+    def generate(self, prompts, n=1, **kwargs):
+        self.check()
+        self.prompts.extend(prompts)
+        return [[self.server_port, prompt] for prompt in prompts for _ in range(n)]
+
+    def score(self, sequences):
+        self.check()
+        return [[float(self.server_port)] * (len(sequence) - 1) for sequence in sequences]
+
+    def init_communicator(self):
+        self.check()
+        self.num_initializations += 1
+
+    def update_named_params(self, named_params, bucket_size_mb=256.0):
+        self.check()
+        self.params.update(named_params)
+
+    def restart(self):
+        self.server_id = "second"
+        self.params = {}
+
+
+@patch("trl.extras.vllm_client.VLLMClient", FakeVLLMClient)
+class TestMultiServerVLLMClient(unittest.TestCase):
+    def make_client(self, **kwargs):
+        client = MultiServerVLLMClient(
+            ["host:8000", "host:8001", "host:8002"], retry_backoff=0.0, health_check_interval=0.0, **kwargs
+        )
+        return client, [server.client for server in client.servers]
+
+    def test_split(self):
+        client, servers = self.make_client()
+        completions = client.generate([1, 2, 3, 4, 5], n=2)
+        self.assertEqual([completion[1] for completion in completions], [1, 1, 2, 2, 3, 3, 4, 4, 5, 5])
+        self.assertEqual(sorted(len(server.prompts) for server in servers), [1, 2, 2])
+        self.assertEqual(client.score([[1, 2, 3], [4, 5]]), [[8000.0, 8000.0], [8001.0]])
+
+    def test_round_robin(self):
+        client, _ = self.make_client(routing="round_robin")
+        ports = [client.generate([prompt])[0][0] for prompt in range(4)]
+        self.assertEqual(ports, [8000, 8001, 8002, 8000])
+
+    def test_least_loaded(self):
+        client, _ = self.make_client(routing="least_loaded")
+        client.servers[0].inflight = 4
+        client.servers[1].inflight = 1
+        self.assertEqual(client.generate([1])[0][0], 8002)
+
+    def test_failover(self):
+        client, servers = self.make_client()
+        servers[1].down = True
+        completions = client.generate([1, 2, 3, 4, 5, 6])
+        self.assertEqual([completion[1] for completion in completions], [1, 2, 3, 4, 5, 6])
+        self.assertEqual(servers[1].prompts, [])
+        self.assertEqual(client.servers[1].failures, 1)
+
+        # The server is used again once it is back
+        servers[1].down = False
+        client.generate([1, 2, 3])
+        self.assertEqual(servers[1].prompts, [2])
+        self.assertEqual(client.servers[1].failures, 0)
+
+    def test_all_servers_down(self):
+        client, servers = self.make_client(max_retries=2)
+        for server in servers:
+            server.down = True
+        with self.assertRaises(requests.ConnectionError):
+            client.generate([1, 2])
+
+    def test_client_error_not_retried(self):
+        client, servers = self.make_client(routing="round_robin")
+        error = requests.HTTPError("Request failed: 400", response=SimpleNamespace(status_code=400))
+        with patch.object(servers[0], "generate", side_effect=error), self.assertRaises(requests.HTTPError):
+            client.generate([1])
+        self.assertEqual(client.servers[0].failures, 0)
+
+    def test_stale_server_not_used_for_generation(self):
+        client, servers = self.make_client()
+        client.init_communicator()
+        servers[2].down = True
+        client.update_named_params([("weight", torch.ones(1))])
+        servers[2].down = False
+        self.assertEqual(client.weight_version, 1)
+        self.assertEqual(client.server_weight_versions, {"host:8000": 1, "host:8001": 1, "host:8002": 0})
+
+        # The server that missed the update gets no prompt, but it can still score the sequences
+        client.generate([1, 2, 3])
+        self.assertEqual(servers[2].prompts, [])
+        self.assertEqual(len(client.score([[1, 2], [3, 4], [5, 6]])), 3)
+
+        client.update_named_params([("weight", 2 * torch.ones(1))])
+        self.assertEqual(client.server_weight_versions, {"host:8000": 2, "host:8001": 2, "host:8002": 2})
+        client.generate([1, 2, 3])
+        self.assertEqual(servers[2].prompts, [3])
+
+    def test_restart(self):
+        client, servers = self.make_client()
+        client.init_communicator()
+        client.update_named_params([("weight", torch.ones(1))])
+        servers[0].restart()
+        client.generate([1, 2])
+        self.assertEqual(servers[0].prompts, [])
+
+        # The weight update group of the restarted server is initialized again before the weights are sent
+        client.update_named_params([("weight", torch.ones(1))])
+        self.assertEqual(servers[0].num_initializations, 2)
+        self.assertIn("weight", servers[0].params)
+        self.assertEqual(client.weight_version, 2)
+        self.assertEqual(min(client.server_weight_versions.values()), 2)
+
+    def test_timings(self):
+        client, _ = self.make_client()
+        self.assertEqual(client.timings, {"generate": {"calls": 3, "total": 6.0}})
+
+    def test_concatenate_tensors(self):
+        outputs = [
+            (torch.tensor([[1, 2]]), torch.tensor([[1, 1]])),
+            (torch.tensor([[3, 4, 5], [6, -1, -1]]), torch.tensor([[1, 1, 1], [1, 0, 0]])),
+        ]
+        completion_ids, completion_mask = _concatenate_outputs(outputs, return_tensors="pt", padding_value=-1)
+        self.assertEqual(completion_ids.tolist(), [[1, 2, -1], [3, 4, 5], [6, -1, -1]])
+        self.assertEqual(completion_mask.tolist(), [[1, 1, 0], [1, 1, 1], [1, 0, 0]])
+
+
+class TestPackSequences(unittest.TestCase):
+    def test_round_trip(self):
+        offsets, tokens, values = unpack_sequences(pack_sequences([[1, 2, 3], [4], [5, 6]]))
+        self.assertEqual(offsets.tolist(), [0, 3, 4, 6])
+        self.assertEqual(tokens.tolist(), [1, 2, 3, 4, 5, 6])
+        self.assertIsNone(values)
+
+    def test_round_trip_with_values(self):
+        buffer = pack_sequences([[1, 2], [3]], values=[[-0.5, -1.0], [-2.0]])
+        offsets, tokens, values = unpack_sequences(buffer, has_values=True)
+        self.assertEqual(offsets.tolist(), [0, 2, 3])
+        self.assertEqual(tokens.tolist(), [1, 2, 3])
+        self.assertEqual(values.tolist(), [-0.5, -1.0, -2.0])
+
+    def test_empty_sequences(self):
+        offsets, tokens, _ = unpack_sequences(pack_sequences([[], [7], []]))
+        self.assertEqual(offsets.tolist(), [0, 0, 1, 1])
+        self.assertEqual(tokens.tolist(), [7])
+
+    def test_no_sequences(self):
+        offsets, tokens, _ = unpack_sequences(pack_sequences([]))
+        self.assertEqual(offsets.tolist(), [0])
+        self.assertEqual(tokens.tolist(), [])
+
+    def test_little_endian(self):
+        # The buffer has the same layout whatever the byte order of the machine
+        expected_buffer = struct.pack("<5i2f", 1, 0, 2, 1, 258, -0.5, -1.0)
+        self.assertEqual(pack_sequences([[1, 258]], values=[[-0.5, -1.0]]), expected_buffer)
+        offsets, tokens, values = unpack_sequences(expected_buffer, has_values=True)
+        self.assertEqual(offsets.tolist(), [0, 2])
+        self.assertEqual(tokens.tolist(), [1, 258])
+        self.assertEqual(values.tolist(), [-0.5, -1.0])
+
+
 @pytest.mark.slow
 @require_torch_multi_gpu
 class TestVLLMClientServer(unittest.TestCase):
@@ -106,10 +742,50 @@ class TestVLLMClientServer(unittest.TestCase):
         for seq in outputs:
             self.assertLessEqual(len(seq), 32)
 
+    def test_generate_tensors(self):
+        prompts = ["Hello, AI!", "Tell me a joke"]
+        completion_ids, completion_mask, logprobs = self.client.generate(
+            prompts, n=2, max_tokens=32, return_logprobs=True, return_tensors="pt"
+        )
+
+        # Check that the binary response is decoded into padded tensors with one row per completion
+        self.assertEqual(completion_ids.shape[0], 2 * len(prompts))
+        self.assertLessEqual(completion_ids.shape[1], 32)
+        self.assertEqual(completion_mask.shape, completion_ids.shape)
+        self.assertEqual(logprobs.shape, completion_ids.shape)
+
+    def test_generate_from_prompt_ids(self):
+        outputs = self.client.generate([[9707, 11, 15235, 0], [40451, 752, 264, 21646]])
+
+        # Check that the number of generated sequences is equal to the number of prompts
+        self.assertEqual(len(outputs), 2)
+
+    def test_generate_stream(self):
+        prompts = ["Hello, AI!", "Tell me a joke"]
+        outputs = list(self.client.generate_stream(prompts, n=2, max_tokens=32))
+
+        # Check that each prompt is yielded exactly once
+        self.assertEqual(sorted(index for index, _ in outputs), list(range(len(prompts))))
+
+        # Check that each prompt comes with n sequences of integers
+        for _, completion_ids in outputs:
+            self.assertEqual(len(completion_ids), 2)
+            for seq in completion_ids:
+                self.assertTrue(all(isinstance(tok, int) for tok in seq))
+                self.assertLessEqual(len(seq), 32)
+
     def test_update_model_params(self):
         model = AutoModelForCausalLM.from_pretrained(self.model_id, device_map="cuda")
         self.client.update_model_params(model)
 
+    def test_update_model_params_small_buckets(self):
+        model = AutoModelForCausalLM.from_pretrained(self.model_id, device_map="cuda")
+        self.client.update_model_params(model, bucket_size_mb=16)
+
+    def test_update_model_params_no_bucket(self):
+        model = AutoModelForCausalLM.from_pretrained(self.model_id, device_map="cuda")
+        self.client.update_model_params(model, bucket_size_mb=0)
+
     def test_reset_prefix_cache(self):
         # Test resetting the prefix cache
         self.client.reset_prefix_cache()
@@ -131,6 +807,72 @@ class TestVLLMClientServer(unittest.TestCase):
         cls.server_process.wait()
 
 
+@pytest.mark.slow
+@require_torch_multi_gpu
+class TestVLLMClientServerRefModel(unittest.TestCase):
+    model_id = "Qwen/Qwen2.5-1.5B"
+
+    @classmethod
+    def setUpClass(cls):
+        # We want the server to run on GPU 1, so we set CUDA_VISIBLE_DEVICES to "1"
+        env = os.environ.copy()
+        env["CUDA_VISIBLE_DEVICES"] = "1"  # Restrict to GPU 1
+
+        # Start the server process, hosting the same model as reference model on the same GPU
+        cls.server_process = subprocess.Popen(
+            [
+                "trl",
+                "vllm-serve",
+                "--model",
+                cls.model_id,
+                "--ref_model",
+                cls.model_id,
+                "--gpu_memory_utilization",
+                "0.5",
+                "--ref_gpu_memory_utilization",
+                "0.3",
+            ],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            env=env,
+        )
+
+        # Initialize the client
+        cls.client = VLLMClient(connection_timeout=240)
+
+    def test_score(self):
+        sequences = [[9707, 11, 15235, 0], [40451, 752, 264, 21646, 30]]
+        logprobs = self.client.score(sequences)
+
+        # Check that there is one log-probability per token, except for the first one
+        self.assertEqual([len(logps) for logps in logprobs], [3, 4])
+
+        # Check that the values are log-probabilities
+        for logps in logprobs:
+            self.assertTrue(all(logp <= 0.0 for logp in logps))
+
+    def test_score_matches_generation_logprobs(self):
+        # The log-probabilities of the sampled tokens (at temperature 1) must match the ones of the reference model,
+        # since both models are the same
+        prompt_ids = [9707, 11, 15235, 0]
+        completion_ids, logprobs = self.client.generate([prompt_ids], max_tokens=16, return_logprobs=True)
+        ref_logprobs = self.client.score([prompt_ids + completion_ids[0]])[0][len(prompt_ids) - 1 :]
+        torch.testing.assert_close(torch.tensor(ref_logprobs), torch.tensor(logprobs[0]), atol=0.1, rtol=0.0)
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+
+        # vLLM x pytest (or Popen) seems not to handle process termination well. To avoid zombie processes, we need to
+        # kill the server process and its children explicitly.
+        parent = psutil.Process(cls.server_process.pid)
+        children = parent.children(recursive=True)
+        for child in children:
+            child.send_signal(signal.SIGTERM)
+        cls.server_process.terminate()
+        cls.server_process.wait()
+
+
 @pytest.mark.slow
 @require_3_gpus
 class TestVLLMClientServerTP(unittest.TestCase):
@@ -204,9 +946,22 @@ class TestVLLMClientServerDP(unittest.TestCase):
         env = os.environ.copy()
         env["CUDA_VISIBLE_DEVICES"] = "1,2"  # Restrict to GPU 1 and 2
 
-        # Start the server process
+        # Start the server process, hosting the same model as reference model on the same GPUs
         cls.server_process = subprocess.Popen(
-            ["trl", "vllm-serve", "--model", cls.model_id, "--data_parallel_size", "2"],
+            [
+                "trl",
+                "vllm-serve",
+                "--model",
+                cls.model_id,
+                "--data_parallel_size",
+                "2",
+                "--ref_model",
+                cls.model_id,
+                "--gpu_memory_utilization",
+                "0.5",
+                "--ref_gpu_memory_utilization",
+                "0.3",
+            ],
             stdout=subprocess.PIPE,
             stderr=subprocess.PIPE,
             env=env,
@@ -229,6 +984,33 @@ class TestVLLMClientServerDP(unittest.TestCase):
         for seq in outputs:
             self.assertTrue(all(isinstance(tok, int) for tok in seq))
 
+    def test_generate_single_prompt(self):
+        # There are fewer prompts than DP workers, so one of them only gets a placeholder prompt, which is ignored
+        outputs = self.client.generate(["Hello, AI!"], n=2)
+        self.assertEqual(len(outputs), 2)
+        for seq in outputs:
+            self.assertTrue(all(isinstance(tok, int) for tok in seq))
+
+    def test_concurrent_generations_of_different_sizes(self):
+        # The two requests are batched together by the workers, which must keep stepping in lockstep although one of
+        # them gets a single prompt of the first request, and finishes it long before the other one
+        prompts = [["Hello, AI!"], ["Tell me a joke", "Write a poem", "Hi", "What is 1+1?", "Name a color"]]
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            futures = [
+                executor.submit(self.client.generate, prompts[0], max_tokens=4),
+                executor.submit(self.client.generate, prompts[1], max_tokens=64),
+            ]
+            outputs = [future.result(timeout=120) for future in futures]
+
+        self.assertEqual([len(completion_ids) for completion_ids in outputs], [1, 5])
+        self.assertTrue(all(len(completion_ids) <= 4 for completion_ids in outputs[0]))
+        self.assertTrue(all(len(completion_ids) <= 64 for completion_ids in outputs[1]))
+
+    def test_score_single_sequence(self):
+        logprobs = self.client.score([[9707, 11, 15235, 0]])
+        self.assertEqual([len(logps) for logps in logprobs], [3])
+        self.assertTrue(all(logp <= 0.0 for logp in logprobs[0]))
+
     def test_update_model_params(self):
         model = AutoModelForCausalLM.from_pretrained(self.model_id, device_map="cuda")
         self.client.update_model_params(model)
@@ -8,6 +8,7 @@ import torch
 from torch import nn
 
 from ..import_utils import is_requests_available, is_vllm_ascend_available, is_vllm_available
+from .vllm_client import update_named_params_in_buckets
 
 
 if is_requests_available():
@@ -165,17 +166,38 @@ class ConversationGenerator:
         self.pynccl_comm.broadcast(weights, src=self.rank)
         self.pynccl_comm.group.barrier()
 
-    def update_model_params(self, model: nn.Module):
+    def update_named_params(self, named_params: list[tuple[str, torch.Tensor]], bucket_size_mb: float = 256.0):
         """
-        Updates all parameters of the given model by calling `update_named_param` for each parameter in the model.
+        Updates several named parameters in the model at once. The tensors are packed into contiguous flat buffers
+        (one per data type) of up to `bucket_size_mb` megabytes, and each buffer is sent with a single request and a
+        single broadcast.
+
+        Args:
+            named_params (`list[tuple[str, torch.Tensor]]`):
+                List of `(name, weights)` pairs of the parameters to update.
+            bucket_size_mb (`float`, *optional*, defaults to `256.0`):
+                Maximum size of a flat buffer in megabytes. A tensor larger than this size is sent in its own buffer.
+        """
+        url = f"http://{self.vllm_server_host}:{self.vllm_server_port}/update_named_params/"
+        update_named_params_in_buckets(self.session, url, self.pynccl_comm, self.rank, named_params, bucket_size_mb)
+
+    def update_model_params(self, model: nn.Module, bucket_size_mb: float = 256.0):
+        """
+        Updates all parameters of the given model.
 
         Args:
             model (`nn.Module`):
                 Model whose parameters (weights/biases) are to be updated.
+            bucket_size_mb (`float`, *optional*, defaults to `256.0`):
+                Maximum size in megabytes of the flat buffers the parameters are packed in (see `update_named_params`).
+                If `0`, each parameter is sent individually with `update_named_param`.
         """
-        for name, param in model.named_parameters():
-            # Update each parameter individually
-            self.update_named_param(name, param.data)
+        if bucket_size_mb > 0:
+            self.update_named_params([(name, param.data) for name, param in model.named_parameters()], bucket_size_mb)
+        else:
+            for name, param in model.named_parameters():
+                # Update each parameter individually
+                self.update_named_param(name, param.data)
 
     def reset_prefix_cache(self):
         """
@@ -13,10 +13,17 @@
 # limitations under the License.
 
 import atexit
+import json
 import logging
+import threading
 import time
-from typing import Optional
+from collections.abc import Iterator
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from itertools import chain
+from typing import Optional, Union
 
+import numpy as np
 import torch
 from torch import nn
 
@@ -39,12 +46,152 @@ if is_vllm_available():
 logger = logging.getLogger(__name__)
 
 
+def pack_sequences(sequences: list[list[int]], values: Optional[list[list[float]]] = None) -> bytes:
+    """
+    Packs variable-length sequences of token IDs into a compact binary buffer, used to transfer completions between
+    the vLLM server and the client without JSON encoding.
+
+    The buffer is made of little-endian 32-bit words: the number of sequences `N` (int32), the `N + 1` offsets of the
+    sequences (int32), the concatenated token IDs (int32), and optionally one value per token (float32).
+
+    Args:
+        sequences (`list[list[int]]`):
+            Sequences of token IDs.
+        values (`list[list[float]]` or `None`, *optional*, defaults to `None`):
+            Per-token values (e.g., log-probabilities), with the same structure as `sequences`.
+
+    Returns:
+        `bytes`:
+            The packed buffer.
+    """
+    offsets = torch.zeros(len(sequences) + 1, dtype=torch.int32)
+    offsets[1:] = torch.tensor([len(sequence) for sequence in sequences], dtype=torch.int32).cumsum(0)
+    parts = [
+        torch.tensor([len(sequences)], dtype=torch.int32),
+        offsets,
+        torch.tensor(list(chain.from_iterable(sequences)), dtype=torch.int32),
+    ]
+    if values is not None:
+        parts.append(torch.tensor(list(chain.from_iterable(values)), dtype=torch.float32))
+    # Written as little-endian whatever the byte order of the machine, so that client and server can differ
+    return b"".join(part.numpy().astype("<i4" if part.dtype == torch.int32 else "<f4").tobytes() for part in parts)
+
+
+def unpack_sequences(
+    buffer: bytes, has_values: bool = False
+) -> tuple[torch.Tensor, torch.Tensor, Optional[torch.Tensor]]:
+    """
+    Unpacks a buffer created with [`pack_sequences`].
+
+    Args:
+        buffer (`bytes`):
+            The packed buffer.
+        has_values (`bool`, *optional*, defaults to `False`):
+            Whether the buffer contains per-token values.
+
+    Returns:
+        `tuple[torch.Tensor, torch.Tensor, Optional[torch.Tensor]]`:
+            The offsets of the sequences (int32, of size `N + 1`), the concatenated token IDs (int32) and, if
+            `has_values` is `True`, the concatenated values (float32), else `None`.
+    """
+    # The words are little-endian, and converted to the byte order of the machine
+    data = np.frombuffer(buffer, dtype="<i4")
+    num_sequences = int(data[0])
+    offsets = torch.from_numpy(data[1 : num_sequences + 2].astype(np.int32))
+    start = num_sequences + 2
+    num_tokens = offsets[-1].item()
+    tokens = torch.from_numpy(data[start : start + num_tokens].astype(np.int32))
+    values = None
+    if has_values:
+        # Values are float32, so they can be read by reinterpreting the remaining 32-bit words
+        values = data[start + num_tokens : start + 2 * num_tokens].view("<f4")
+        values = torch.from_numpy(values.astype(np.float32))
+    return offsets, tokens, values
+
+
+def parse_server_timing(header: Optional[str]) -> dict[str, float]:
+    """
+    Parses a `Server-Timing` header, as sent by `trl vllm-serve`, into durations in seconds.
+
+    Example:
+        >>> parse_server_timing("queue;dur=12.5, engine;dur=830.0")
+        {'queue': 0.0125, 'engine': 0.83}
+    """
+    timings = {}
+    for metric in (header or "").split(","):
+        name, *params = metric.strip().split(";")
+        for param in params:
+            key, _, value = param.strip().partition("=")
+            if name and key == "dur":
+                timings[name] = float(value) / 1000
+    return timings
+
+
+def update_named_params_in_buckets(
+    session: "requests.Session",
+    url: str,
+    communicator: "PyNcclCommunicator",
+    rank: int,
+    named_params: list[tuple[str, torch.Tensor]],
+    bucket_size_mb: float = 256.0,
+) -> None:
+    """
+    Sends weights to a vLLM server packed into contiguous flat buffers (one per data type) of up to `bucket_size_mb`
+    megabytes. For each buffer, the names, data type and shapes of its tensors are posted to the
+    `/update_named_params/` endpoint of the server, then the buffer is broadcast to its workers. Shared by the clients
+    of the server.
+
+    Args:
+        session (`requests.Session`):
+            Session used to post the requests.
+        url (`str`):
+            URL of the `/update_named_params/` endpoint of the server.
+        communicator (`PyNcclCommunicator`):
+            Communicator of the weight update group, between the client and the workers of the server.
+        rank (`int`):
+            Rank of the client in the weight update group.
+        named_params (`list[tuple[str, torch.Tensor]]`):
+            List of `(name, weights)` pairs of the parameters to update.
+        bucket_size_mb (`float`, *optional*, defaults to `256.0`):
+            Maximum size of a flat buffer in megabytes. A tensor larger than this size is sent in its own buffer.
+    """
+
+    def update_bucket(bucket: list[tuple[str, torch.Tensor]]):
+        # All the tensors of a bucket share the same dtype, so they can be packed in one flat buffer
+        names = [name for name, _ in bucket]
+        shapes = [tuple(weights.shape) for _, weights in bucket]
+        dtype = str(bucket[0][1].dtype)
+        response = session.post(url, json={"names": names, "dtype": dtype, "shapes": shapes})
+        if response.status_code != 200:
+            raise requests.HTTPError(f"Request failed: {response.status_code}, {response.text}", response=response)
+
+        # Broadcast the flat buffer to the other processes
+        buffer = torch.cat([weights.reshape(-1) for _, weights in bucket])
+        communicator.broadcast(buffer, src=rank)
+        communicator.group.barrier()
+
+    bucket_size = bucket_size_mb * 1024 * 1024
+    buckets = {}  # dtype -> (list of (name, weights), size in bytes) of the bucket being filled
+    for name, weights in named_params:
+        bucket, size = buckets.get(weights.dtype, ([], 0))
+        nbytes = weights.numel() * weights.element_size()
+        if bucket and size + nbytes > bucket_size:
+            update_bucket(bucket)
+            bucket, size = [], 0
+        bucket.append((name, weights))
+        buckets[weights.dtype] = (bucket, size + nbytes)
+
+    for bucket, _ in buckets.values():
+        update_bucket(bucket)
+
+
 class VLLMClient:
     """
     A client class to interact with a vLLM server.
 
-    This class provides methods to generate completions, initialize and manage weight update groups, and update model
-    weights in a distributed setting. Before using it, start the vLLM server with `trl vllm-serve`.
+    This class provides methods to generate completions, score sequences with a reference model, initialize and manage
+    weight update groups, and update model weights in a distributed setting. Before using it, start the vLLM server
+    with `trl vllm-serve`.
 
     Args:
         host (`str`, *optional*, defaults to `"0.0.0.0"`):
@@ -55,7 +202,16 @@ class VLLMClient:
             Port number for the weight update group.
         connection_timeout (`float`, *optional*, defaults to `0.0`):
             Total timeout duration in seconds to wait for the server to be up. If the server is not up after the
-            timeout, a `ConnectionError` is raised.
+            timeout, a `ConnectionError` is raised. It also bounds the time spent retrying a generation request that
+            the server rejects because it is busy (HTTP 429), after which an `HTTPError` is raised.
+
+    Attributes:
+        timings (`dict[str, dict[str, float]]`):
+            Time spent in the calls to [`~VLLMClient.generate`] and [`~VLLMClient.score`], accumulated by method, in
+            seconds, with keys `"calls"` (number of calls), `"total"`, `"serialization"` (encoding the request and
+            decoding the response, on the client), `"queue"` and `"engine"` (waiting to be admitted and processing the
+            request, on the server) and `"network"` (the rest: transfer, HTTP handling and server-side serialization).
+            Clear it to start a new measurement.
 
     Examples:
         Run the vLLM server with the model `Qwen/Qwen2.5-7B`:
@@ -92,9 +248,11 @@ class VLLMClient:
             raise ImportError("vLLM is not installed. Please install it with `pip install vllm`.")
 
         self.session = requests.Session()
+        self.timings: dict[str, dict[str, float]] = {}
         self.host = host
         self.server_port = server_port
         self.group_port = group_port
+        self.connection_timeout = connection_timeout
         self.check_server(connection_timeout)  # check server and fail after timeout
 
     def check_server(self, total_timeout: float = 0.0, retry_interval: float = 2.0):
@@ -131,9 +289,43 @@ class VLLMClient:
             logger.info(f"Server is not up yet. Retrying in {retry_interval} seconds...")
             time.sleep(retry_interval)
 
+    def _post_generation(self, url: str, **kwargs) -> "requests.Response":
+        # The server rejects the generation requests with 429 when too many of them are queued, see the
+        # `--max_queued_requests` argument of `trl vllm-serve`: wait as advised by the server, and retry, for at most
+        # `connection_timeout` seconds
+        deadline = time.monotonic() + self.connection_timeout
+        while True:
+            response = self.session.post(url, **kwargs)
+            if response.status_code != 429:
+                return response
+            response.close()
+            retry_after = float(response.headers.get("Retry-After", 1))
+            if time.monotonic() + retry_after > deadline:
+                raise requests.HTTPError(
+                    f"Request failed: {response.status_code}, the server is still busy after "
+                    f"{self.connection_timeout} seconds.",
+                    response=response,
+                )
+            logger.info(f"The server is busy. Retrying in {retry_after} seconds...")
+            time.sleep(retry_after)
+
+    def _record_timing(self, name: str, total: float, serialization: float, response: "requests.Response") -> None:
+        # The server reports the time spent waiting to be admitted and processing the request (see
+        # `parse_server_timing`), the rest of the time not spent on the client is attributed to the network
+        server_timing = parse_server_timing(response.headers.get("Server-Timing"))
+        queue, engine = server_timing.get("queue", 0.0), server_timing.get("engine", 0.0)
+        keys = ["calls", "total", "serialization", "queue", "engine", "network"]
+        timing = self.timings.setdefault(name, dict.fromkeys(keys, 0.0))
+        timing["calls"] += 1
+        timing["total"] += total
+        timing["serialization"] += serialization
+        timing["queue"] += queue
+        timing["engine"] += engine
+        timing["network"] += max(total - serialization - queue - engine, 0.0)
+
     def generate(
         self,
-        prompts: list[str],
+        prompts: Union[list[str], list[list[int]]],
         n: int = 1,
         repetition_penalty: float = 1.0,
         temperature: float = 1.0,
@@ -142,13 +334,18 @@ class VLLMClient:
         min_p: float = 0.0,
         max_tokens: int = 16,
         guided_decoding_regex: Optional[str] = None,
-    ) -> list[list[int]]:
+        return_logprobs: bool = False,
+        return_tensors: Optional[str] = None,
+        padding_value: int = 0,
+        priority: int = 0,
+    ) -> Union[list[list[int]], tuple[Union[list[list[int]], list[list[float]], torch.Tensor], ...]]:
         """
         Generates model completions for the provided prompts.
 
         Args:
-            prompts (`list[str]`):
-                List of text prompts for which the model will generate completions.
+            prompts (`list[str]` or `list[list[int]]`):
+                List of text prompts for which the model will generate completions. Prompts can also be given as lists
+                of token IDs, in which case the server doesn't need to tokenize them.
             n (`int`, *optional*, defaults to `1`):
                 Number of completions to generate for each prompt.
             repetition_penalty (`float`, *optional*, defaults to `1.0`):
@@ -165,16 +362,127 @@ class VLLMClient:
                 Maximum number of tokens to generate for each prompt.
             guided_decoding_regex (`str` or `None`, *optional*, defaults to `None`):
                 Regular expression to guide the decoding process.
+            return_logprobs (`bool`, *optional*, defaults to `False`):
+                Whether to also return the log-probability that the vLLM engine assigned to each sampled token.
+            return_tensors (`str` or `None`, *optional*, defaults to `None`):
+                If `"pt"`, the completions are transferred in a compact binary format (see [`pack_sequences`]) and
+                returned as right-padded tensors, instead of lists.
+            padding_value (`int`, *optional*, defaults to `0`):
+                Value used to pad the completion IDs when `return_tensors="pt"`.
+            priority (`int`, *optional*, defaults to `0`):
+                Priority of the request when the server is busy with the requests of other clients (see the
+                `--max_inflight_tokens` argument of `trl vllm-serve`). Lower values are served first.
 
         Returns:
-            `list[list[int]]`:
-                List of lists of token IDs representing the model-generated completions for each prompt.
+            `list[list[int]]` or `tuple`:
+                List of lists of token IDs representing the model-generated completions for each prompt. If
+                `return_logprobs` is `True`, a tuple `(completion_ids, logprobs)` is returned instead, where `logprobs`
+                has the same structure as `completion_ids`. If `return_tensors="pt"`, a tuple `(completion_ids,
+                completion_mask)` of tensors of shape `(num_completions, max_completion_length)` is returned, followed
+                by the padded `logprobs` tensor if `return_logprobs` is `True`.
         """
+        if return_tensors not in (None, "pt"):
+            raise ValueError(f"Unsupported value for `return_tensors`: {return_tensors}. Only 'pt' is supported.")
+
         url = f"http://{self.host}:{self.server_port}/generate/"
-        response = self.session.post(
+        # Prompts given as token IDs are sent as such, so that the server can skip the tokenization
+        prompt_key = "prompts" if not prompts or isinstance(prompts[0], str) else "prompt_ids"
+        headers = {"Content-Type": "application/json"}
+        if return_tensors == "pt":
+            headers["Accept"] = "application/octet-stream"
+        # The request is encoded here, rather than by `requests`, to measure the serialization time
+        start_time = time.perf_counter()
+        data = json.dumps(
+            {
+                prompt_key: prompts,
+                "n": n,
+                "repetition_penalty": repetition_penalty,
+                "temperature": temperature,
+                "top_p": top_p,
+                "top_k": top_k,
+                "min_p": min_p,
+                "max_tokens": max_tokens,
+                "guided_decoding_regex": guided_decoding_regex,
+                "return_logprobs": return_logprobs,
+                "priority": priority,
+            }
+        )
+        encoding_time = time.perf_counter() - start_time
+        response = self._post_generation(url, headers=headers, data=data)
+        if response.status_code != 200:
+            raise requests.HTTPError(f"Request failed: {response.status_code}, {response.text}", response=response)
+
+        decoding_start_time = time.perf_counter()
+        outputs = self._decode_generation(response, return_logprobs, return_tensors, padding_value)
+        end_time = time.perf_counter()
+        self._record_timing(
+            "generate", end_time - start_time, encoding_time + end_time - decoding_start_time, response
+        )
+        return outputs
+
+    @staticmethod
+    def _decode_generation(
+        response: "requests.Response",
+        return_logprobs: bool,
+        return_tensors: Optional[str],
+        padding_value: int,
+    ) -> Union[list[list[int]], tuple[Union[list[list[int]], list[list[float]], torch.Tensor], ...]]:
+        if return_tensors == "pt":
+            if response.headers.get("Content-Type") != "application/octet-stream":
+                raise Exception("The vLLM server doesn't support binary responses, please update it.")
+            offsets, tokens, values = unpack_sequences(response.content, has_values=return_logprobs)
+            # Scatter the concatenated tokens into a right-padded tensor: in row-major order, the positions selected
+            # by the mask are exactly the tokens of each sequence, one after the other
+            lengths = offsets[1:] - offsets[:-1]
+            max_length = lengths.max().item() if len(lengths) > 0 else 0
+            completion_mask = torch.arange(max_length) < lengths.unsqueeze(1)
+            completion_ids = torch.full(completion_mask.shape, padding_value, dtype=torch.long)
+            completion_ids[completion_mask] = tokens.long()
+            if return_logprobs:
+                logprobs = torch.zeros(completion_mask.shape, dtype=torch.float32)
+                logprobs[completion_mask] = values
+                return completion_ids, completion_mask.long(), logprobs
+            return completion_ids, completion_mask.long()
+
+        output = response.json()
+        if return_logprobs:
+            return output["completion_ids"], output["logprobs"]
+        return output["completion_ids"]
+
+    def generate_stream(
+        self,
+        prompts: Union[list[str], list[list[int]]],
+        n: int = 1,
+        repetition_penalty: float = 1.0,
+        temperature: float = 1.0,
+        top_p: float = 1.0,
+        top_k: int = -1,
+        min_p: float = 0.0,
+        max_tokens: int = 16,
+        guided_decoding_regex: Optional[str] = None,
+        return_logprobs: bool = False,
+        priority: int = 0,
+    ) -> Iterator[Union[tuple[int, list[list[int]]], tuple[int, list[list[int]], list[list[float]]]]]:
+        """
+        Generates model completions for the provided prompts, and yields them as soon as all the completions of a
+        prompt are finished, so that they can be processed while the longest ones are still being generated.
+
+        Args:
+            Same as for [`~VLLMClient.generate`].
+
+        Yields:
+            `tuple[int, list[list[int]]]` or `tuple[int, list[list[int]], list[list[float]]]`:
+                Tuple `(index, completion_ids)`, where `index` is the index of the prompt in `prompts` and
+                `completion_ids` is the list of the `n` completions generated for it. Prompts are yielded in order of
+                completion. If `return_logprobs` is `True`, the log-probabilities of the sampled tokens are added as a
+                third element.
+        """
+        url = f"http://{self.host}:{self.server_port}/generate_stream/"
+        prompt_key = "prompts" if not prompts or isinstance(prompts[0], str) else "prompt_ids"
+        response = self._post_generation(
             url,
             json={
-                "prompts": prompts,
+                prompt_key: prompts,
                 "n": n,
                 "repetition_penalty": repetition_penalty,
                 "temperature": temperature,
@@ -183,12 +491,57 @@ class VLLMClient:
                 "min_p": min_p,
                 "max_tokens": max_tokens,
                 "guided_decoding_regex": guided_decoding_regex,
+                "return_logprobs": return_logprobs,
+                "priority": priority,
             },
+            stream=True,
         )
-        if response.status_code == 200:
-            return response.json()["completion_ids"]
-        else:
-            raise Exception(f"Request failed: {response.status_code}, {response.text}")
+        if response.status_code != 200:
+            raise requests.HTTPError(f"Request failed: {response.status_code}, {response.text}", response=response)
+
+        with response:
+            for line in response.iter_lines():
+                if not line:
+                    continue
+                output = json.loads(line)
+                if return_logprobs:
+                    yield output["index"], output["completion_ids"], output["logprobs"]
+                else:
+                    yield output["index"], output["completion_ids"]
+
+    def score(self, sequences: list[list[int]]) -> list[list[float]]:
+        """
+        Computes the log-probabilities of the given sequences with the reference model hosted by the vLLM server. The
+        server must be started with `trl vllm-serve --ref_model ...`.
+
+        Log-probabilities are computed from the raw logits of the model, i.e. without temperature scaling.
+
+        Args:
+            sequences (`list[list[int]]`):
+                Sequences of token IDs to score (typically, prompts followed by their completions).
+
+        Returns:
+            `list[list[float]]`:
+                For each sequence, the log-probability of each of its tokens given the previous ones. The first token
+                has no log-probability, so each list has one element less than the corresponding sequence.
+        """
+        url = f"http://{self.host}:{self.server_port}/score_logprobs/"
+        # The log-probabilities are transferred in binary (see `pack_sequences`), which is much more compact than JSON
+        headers = {"Accept": "application/octet-stream", "Content-Type": "application/json"}
+        start_time = time.perf_counter()
+        data = json.dumps({"sequences": sequences})
+        encoding_time = time.perf_counter() - start_time
+        response = self.session.post(url, headers=headers, data=data)
+        if response.status_code != 200:
+            raise requests.HTTPError(f"Request failed: {response.status_code}, {response.text}", response=response)
+
+        decoding_start_time = time.perf_counter()
+        offsets, _, values = unpack_sequences(response.content, has_values=True)
+        lengths = (offsets[1:] - offsets[:-1]).tolist()
+        logprobs = [logprobs.tolist() for logprobs in values.split(lengths)]
+        end_time = time.perf_counter()
+        self._record_timing("score", end_time - start_time, encoding_time + end_time - decoding_start_time, response)
+        return logprobs
 
     def init_communicator(self):
         """
@@ -200,7 +553,7 @@ class VLLMClient:
         if response.status_code == 200:
             vllm_world_size = response.json()["world_size"]
         else:
-            raise Exception(f"Request failed: {response.status_code}, {response.text}")
+            raise requests.HTTPError(f"Request failed: {response.status_code}, {response.text}", response=response)
 
         world_size = vllm_world_size + 1  # add the client to the world
         self.rank = vllm_world_size  # the client's rank is the last process
@@ -210,7 +563,7 @@ class VLLMClient:
         # In the server side, the host is set to 0.0.0.0
         response = self.session.post(url, json={"host": "0.0.0.0", "port": self.group_port, "world_size": world_size})
         if response.status_code != 200:
-            raise Exception(f"Request failed: {response.status_code}, {response.text}")
+            raise requests.HTTPError(f"Request failed: {response.status_code}, {response.text}", response=response)
 
         # Brief delay to allow server initialization. While not strictly required (client socket will retry on
         # connection failure), this prevents log warnings like:
@@ -238,23 +591,44 @@ class VLLMClient:
         url = f"http://{self.host}:{self.server_port}/update_named_param/"
         response = self.session.post(url, json={"name": name, "dtype": dtype, "shape": shape})
         if response.status_code != 200:
-            raise Exception(f"Request failed: {response.status_code}, {response.text}")
+            raise requests.HTTPError(f"Request failed: {response.status_code}, {response.text}", response=response)
 
         # Broadcast the weights to the other processes
         self.pynccl_comm.broadcast(weights, src=self.rank)
         self.pynccl_comm.group.barrier()
 
-    def update_model_params(self, model: nn.Module):
+    def update_named_params(self, named_params: list[tuple[str, torch.Tensor]], bucket_size_mb: float = 256.0):
         """
-        Updates all parameters of the given model by calling `update_named_param` for each parameter in the model.
+        Updates several named parameters in the model at once. The tensors are packed into contiguous flat buffers
+        (one per data type) of up to `bucket_size_mb` megabytes, and each buffer is sent with a single request and a
+        single broadcast.
+
+        Args:
+            named_params (`list[tuple[str, torch.Tensor]]`):
+                List of `(name, weights)` pairs of the parameters to update.
+            bucket_size_mb (`float`, *optional*, defaults to `256.0`):
+                Maximum size of a flat buffer in megabytes. A tensor larger than this size is sent in its own buffer.
+        """
+        url = f"http://{self.host}:{self.server_port}/update_named_params/"
+        update_named_params_in_buckets(self.session, url, self.pynccl_comm, self.rank, named_params, bucket_size_mb)
+
+    def update_model_params(self, model: nn.Module, bucket_size_mb: float = 256.0):
+        """
+        Updates all parameters of the given model.
 
         Args:
             model (`nn.Module`):
                 Model whose parameters (weights/biases) are to be updated.
+            bucket_size_mb (`float`, *optional*, defaults to `256.0`):
+                Maximum size in megabytes of the flat buffers the parameters are packed in (see `update_named_params`).
+                If `0`, each parameter is sent individually with `update_named_param`.
         """
-        for name, param in model.named_parameters():
-            # Update each parameter individually
-            self.update_named_param(name, param.data)
+        if bucket_size_mb > 0:
+            self.update_named_params([(name, param.data) for name, param in model.named_parameters()], bucket_size_mb)
+        else:
+            for name, param in model.named_parameters():
+                # Update each parameter individually
+                self.update_named_param(name, param.data)
 
     def reset_prefix_cache(self):
         """
@@ -263,7 +637,7 @@ class VLLMClient:
         url = f"http://{self.host}:{self.server_port}/reset_prefix_cache/"
         response = self.session.post(url)
         if response.status_code != 200:
-            raise Exception(f"Request failed: {response.status_code}, {response.text}")
+            raise requests.HTTPError(f"Request failed: {response.status_code}, {response.text}", response=response)
 
     def close_communicator(self):
         """
@@ -278,7 +652,438 @@ class VLLMClient:
             pass
         else:
             if response.status_code != 200:
-                raise Exception(f"Request failed: {response.status_code}, {response.text}")
+                raise requests.HTTPError(f"Request failed: {response.status_code}, {response.text}", response=response)
+
+
+@dataclass
+class _ServerState:
+    # State of a server, as seen by `MultiServerVLLMClient`
+    address: str
+    client: VLLMClient
+    server_id: Optional[str] = None
+    failures: int = 0  # number of consecutive failures, the server is healthy when it is 0
+    retry_at: float = 0.0  # time after which an unhealthy server is probed again
+    checked_at: float = 0.0  # time of the last health check
+    inflight: int = 0  # number of prompts or sequences being processed by the server
+    has_communicator: bool = False
+    param_versions: dict[str, int] = field(default_factory=dict)  # version of each parameter on the server
+
+
+def _concatenate_outputs(outputs: list, return_tensors: Optional[str], padding_value: int):
+    # Concatenates the outputs of `VLLMClient.generate` for consecutive shards of the prompts
+    if not isinstance(outputs[0], tuple):
+        return list(chain.from_iterable(outputs))
+    concatenated = []
+    for i, parts in enumerate(zip(*outputs)):
+        if return_tensors == "pt":
+            # The tensors of each shard are padded to the length of their longest completion
+            length = max(part.size(1) for part in parts)
+            value = padding_value if i == 0 else 0
+            parts = [nn.functional.pad(part, (0, length - part.size(1)), value=value) for part in parts]
+            concatenated.append(torch.cat(parts))
+        else:
+            concatenated.append(list(chain.from_iterable(parts)))
+    return tuple(concatenated)
+
+
+class MultiServerVLLMClient:
+    """
+    A client to spread the generation over several vLLM servers, each started with `trl vllm-serve`, and to keep
+    training when some of them fail.
+
+    It has the same methods as [`VLLMClient`]. The weight updates are sent to all the servers, one after the other,
+    and the client tracks the version of each parameter on each server: a server that missed an update, because it
+    was down or restarted, gets no generation request until the parameters it missed are sent again, usually by the
+    next weight update. A restarted server is detected by the ID it reports at the `/health/` endpoint, and its weight
+    update group is initialized again before the next weight update.
+
+    A server that fails a request (connection error, timeout or HTTP 5xx error) is left out, and probed again after
+    `retry_backoff` seconds, twice as long after each consecutive failure. The requests that can safely be sent
+    again, generation and scoring, are retried on another server, `retry_backoff` seconds later, twice as long after
+    each retry. Weight updates aren't retried: the servers that fail them are synchronized by the next ones.
+
+    Args:
+        servers (`list[str]`):
+            Addresses of the vLLM servers, as `"host:port"`.
+        group_port (`int`, *optional*, defaults to `51216`):
+            Port number for the weight update group of the first server. The `i`-th server uses `group_port + i`.
+        connection_timeout (`float`, *optional*, defaults to `0.0`):
+            Total timeout duration in seconds to wait for each server to be up when the client is created. If a
+            server is not up after the timeout, a `ConnectionError` is raised.
+        routing (`str`, *optional*, defaults to `"split"`):
+            How to spread the requests over the servers:
+
+            - `"split"`: the prompts (or sequences to score) of each request are split evenly over the servers, which
+              process them concurrently.
+            - `"round_robin"`: each request is sent to the next server, in turn.
+            - `"least_loaded"`: each request is sent to the server with the fewest prompts in flight.
+
+        max_retries (`int`, *optional*, defaults to `3`):
+            Number of times a failed generation or scoring request is retried before raising an error.
+        retry_backoff (`float`, *optional*, defaults to `1.0`):
+            Delay in seconds before the first retry of a failed request, and before probing a failed server again.
+        health_check_interval (`float`, *optional*, defaults to `5.0`):
+            Minimum interval in seconds between two health checks of a server, to detect restarts.
+
+    Examples:
+        Run two vLLM servers, on different nodes or GPUs:
+
+        ```
+        $ CUDA_VISIBLE_DEVICES=0 trl vllm-serve --model Qwen/Qwen2.5-7B --port 8000
+        $ CUDA_VISIBLE_DEVICES=1 trl vllm-serve --model Qwen/Qwen2.5-7B --port 8001
+        ```
+
+        Use the client as a [`VLLMClient`]:
+
+        ```python
+        >>> from trl.extras.vllm_client import MultiServerVLLMClient
+        >>> client = MultiServerVLLMClient(["0.0.0.0:8000", "0.0.0.0:8001"])
+        >>> client.init_communicator()
+        >>> client.update_model_params(model)
+        >>> client.generate(["Hello, AI!", "Tell me a joke"])
+        ```
+    """
+
+    def __init__(
+        self,
+        servers: list[str],
+        group_port: int = 51216,
+        connection_timeout: float = 0.0,
+        routing: str = "split",
+        max_retries: int = 3,
+        retry_backoff: float = 1.0,
+        health_check_interval: float = 5.0,
+    ):
+        if not servers:
+            raise ValueError("At least one vLLM server is required.")
+        if routing not in ("split", "round_robin", "least_loaded"):
+            raise ValueError(
+                f"Unsupported value for `routing`: {routing}. Supported values are 'split', 'round_robin' and "
+                "'least_loaded'."
+            )
+        self.routing = routing
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.health_check_interval = health_check_interval
+        self.servers = []
+        for i, address in enumerate(servers):
+            host, _, port = address.rpartition(":")
+            client = VLLMClient(host, int(port), group_port=group_port + i, connection_timeout=connection_timeout)
+            self.servers.append(_ServerState(address, client))
+        self.param_versions: dict[str, int] = {}  # number of updates of each parameter
+        self._lock = threading.Lock()
+        self._turn = 0  # next server for round-robin routing
+        self._executor = ThreadPoolExecutor(max_workers=len(self.servers))
+        self._refresh()
+
+    @property
+    def weight_version(self) -> int:
+        """
+        Number of times all the parameters were updated.
+        """
+        return min(self.param_versions.values(), default=0)
+
+    @property
+    def server_weight_versions(self) -> dict[str, int]:
+        """
+        Number of times all the parameters were updated on each server. It is lower than `weight_version` for the
+        servers that missed updates, and are not used for generation until they get them again.
+        """
+        return {
+            server.address: min((server.param_versions.get(name, 0) for name in self.param_versions), default=0)
+            for server in self.servers
+        }
+
+    @property
+    def timings(self) -> dict[str, dict[str, float]]:
+        """
+        Time spent in the calls to `generate` and `score`, summed over the servers (see [`VLLMClient`]).
+        """
+        timings = {}
+        for server in self.servers:
+            for name, timing in server.client.timings.items():
+                total = timings.setdefault(name, dict.fromkeys(timing, 0.0))
+                for key, value in timing.items():
+                    total[key] += value
+        return timings
+
+    def _is_synced(self, server: _ServerState) -> bool:
+        return all(server.param_versions.get(name) == version for name, version in self.param_versions.items())
+
+    def _probe(self, server: _ServerState):
+        url = f"http://{server.client.host}:{server.client.server_port}/health/"
+        try:
+            response = server.client.session.get(url, timeout=10.0)
+            if response.status_code != 200:
+                raise requests.HTTPError(f"Request failed: {response.status_code}, {response.text}", response=response)
+        except requests.exceptions.RequestException as exc:
+            self._mark_failed(server, exc)
+            return
+        server_id = response.json().get("server_id")
+        with self._lock:
+            if server.server_id is not None and server_id != server.server_id:
+                # The weights sent to the server before it restarted are lost
+                logger.warning(f"The vLLM server {server.address} restarted, its weights will be sent again.")
+                server.has_communicator = False
+                server.param_versions = {}
+            if server.failures:
+                logger.info(f"The vLLM server {server.address} is back.")
+            server.server_id = server_id
+            server.failures = 0
+            server.checked_at = time.monotonic()
+
+    def _refresh(self):
+        # Checks the healthy servers at most every `health_check_interval` seconds, to detect restarts, and probes
+        # the failed servers whose backoff delay has elapsed
+        now = time.monotonic()
+        for server in self.servers:
+            if server.failures == 0:
+                due = now - server.checked_at >= self.health_check_interval
+            else:
+                due = now >= server.retry_at
+            if due:
+                self._probe(server)
+
+    def _mark_failed(self, server: _ServerState, exc: Exception):
+        with self._lock:
+            server.failures += 1
+            delay = self.retry_backoff * 2 ** (server.failures - 1)
+            server.retry_at = time.monotonic() + delay
+        logger.warning(f"The vLLM server {server.address} failed ({exc}), retrying it in {delay} seconds.")
+
+    @staticmethod
+    def _is_retryable(exc: Exception) -> bool:
+        # Requests rejected by the server (HTTP 4xx errors) would fail on any other server as well
+        if isinstance(exc, requests.HTTPError) and exc.response is not None:
+            return exc.response.status_code >= 500
+        return isinstance(exc, requests.exceptions.RequestException)
+
+    def _available_servers(self, requires_weights: bool) -> list[_ServerState]:
+        # The servers that can take a request: the reference model used for scoring is never updated, so only
+        # generation requires the servers to have the latest weights
+        return [
+            server
+            for server in self.servers
+            if server.failures == 0 and (not requires_weights or self._is_synced(server))
+        ]
+
+    def _acquire(
+        self, requires_weights: bool, load: int, routing: str, preferred: Optional[_ServerState] = None
+    ) -> Optional[_ServerState]:
+        with self._lock:
+            servers = self._available_servers(requires_weights)
+            if not servers:
+                return None
+            if preferred in servers:
+                server = preferred
+            elif routing == "round_robin":
+                # The first available server from the one after the last used
+                server = min(servers, key=lambda server: (self.servers.index(server) - self._turn) % len(self.servers))
+                self._turn = self.servers.index(server) + 1
+            else:
+                server = min(servers, key=lambda server: server.inflight)
+            server.inflight += load
+            return server
+
+    def _release(self, server: _ServerState, load: int):
+        with self._lock:
+            server.inflight -= load
+
+    def _run(self, request, requires_weights: bool, load: int, routing: str, preferred: Optional[_ServerState] = None):
+        # Sends `request(client)` to a server (first trying `preferred`), and retries it on another server, with
+        # exponential backoff, if the server fails
+        error = None
+        for attempt in range(self.max_retries + 1):
+            if attempt > 0:
+                time.sleep(self.retry_backoff * 2 ** (attempt - 1))
+                self._refresh()
+            server = self._acquire(requires_weights, load, routing, preferred if attempt == 0 else None)
+            if server is None:
+                error = ConnectionError("No vLLM server is available.")
+                continue
+            try:
+                return request(server.client)
+            except Exception as exc:
+                if not self._is_retryable(exc):
+                    raise
+                self._mark_failed(server, exc)
+                error = exc
+            finally:
+                self._release(server, load)
+        raise ConnectionError(f"The request failed after {self.max_retries} retries.") from error
+
+    def _dispatch(self, method: str, items: list, requires_weights: bool, **kwargs) -> list:
+        # Sends the items (prompts or sequences) to the servers according to the routing, and returns the outputs of
+        # each request, in order
+        self._refresh()
+
+        def request(items):
+            return lambda client: getattr(client, method)(items, **kwargs)
+
+        if self.routing != "split" or len(items) <= 1:
+            return [self._run(request(items), requires_weights, len(items), self.routing)]
+
+        # One shard per available server, the shards of the servers that fail are retried on the least loaded ones
+        servers = self._available_servers(requires_weights)[: len(items)] or [None]
+        bounds = [len(items) * i // len(servers) for i in range(len(servers) + 1)]
+        shards = [items[start:end] for start, end in zip(bounds[:-1], bounds[1:])]
+        futures = [
+            self._executor.submit(self._run, request(shard), requires_weights, len(shard), "least_loaded", server)
+            for shard, server in zip(shards, servers)
+        ]
+        return [future.result() for future in futures]
+
+    def generate(
+        self,
+        prompts: Union[list[str], list[list[int]]],
+        n: int = 1,
+        return_tensors: Optional[str] = None,
+        padding_value: int = 0,
+        **kwargs,
+    ) -> Union[list[list[int]], tuple[Union[list[list[int]], list[list[float]], torch.Tensor], ...]]:
+        """
+        Generates model completions for the provided prompts. Same as [`~VLLMClient.generate`], but with the
+        prompts sent to the servers that have the latest weights, according to `routing`.
+        """
+        outputs = self._dispatch(
+            "generate",
+            prompts,
+            requires_weights=True,
+            n=n,
+            return_tensors=return_tensors,
+            padding_value=padding_value,
+            **kwargs,
+        )
+        return _concatenate_outputs(outputs, return_tensors, padding_value)
+
+    def generate_stream(
+        self, prompts: Union[list[str], list[list[int]]], **kwargs
+    ) -> Iterator[Union[tuple[int, list[list[int]]], tuple[int, list[list[int]], list[list[float]]]]]:
+        """
+        Same as [`~VLLMClient.generate_stream`]. The whole request is sent to a single server, chosen as with
+        `routing="least_loaded"` (or `"round_robin"`), and it is not retried, since the completions that were already
+        yielded can't be taken back.
+        """
+        self._refresh()
+        routing = "round_robin" if self.routing == "round_robin" else "least_loaded"
+        server = self._acquire(requires_weights=True, load=len(prompts), routing=routing)
+        if server is None:
+            raise ConnectionError("No vLLM server is available.")
+        try:
+            yield from server.client.generate_stream(prompts, **kwargs)
+        except Exception as exc:
+            if self._is_retryable(exc):
+                self._mark_failed(server, exc)
+            raise
+        finally:
+            self._release(server, len(prompts))
+
+    def score(self, sequences: list[list[int]]) -> list[list[float]]:
+        """
+        Computes the log-probabilities of the given sequences with the reference model hosted by the vLLM servers.
+        Same as [`~VLLMClient.score`], but with the sequences sent to the servers according to `routing`.
+        """
+        return list(chain.from_iterable(self._dispatch("score", sequences, requires_weights=False)))
+
+    def _init_communicator(self, server: _ServerState) -> bool:
+        try:
+            server.client.init_communicator()
+        except Exception as exc:
+            if not self._is_retryable(exc):
+                raise
+            self._mark_failed(server, exc)
+            return False
+        server.has_communicator = True
+        return True
+
+    def init_communicator(self):
+        """
+        Initializes the weight update group of each server. The servers that can't be reached are initialized when
+        they are back, before the next weight update.
+        """
+        self._refresh()
+        initialized = [self._init_communicator(server) for server in self.servers if server.failures == 0]
+        if not any(initialized):
+            raise ConnectionError("The weight update group couldn't be initialized with any vLLM server.")
+
+    def _update(self, names: list[str], update):
+        # Sends the update to all the healthy servers, and records the new version of the parameters on the servers
+        # that got it
+        self._refresh()
+        with self._lock:
+            for name in names:
+                self.param_versions[name] = self.param_versions.get(name, 0) + 1
+        num_updated = 0
+        for server in self.servers:
+            if server.failures > 0 or (not server.has_communicator and not self._init_communicator(server)):
+                continue
+            try:
+                update(server.client)
+            except Exception as exc:
+                if not self._is_retryable(exc):
+                    raise
+                self._mark_failed(server, exc)
+                continue
+            with self._lock:
+                for name in names:
+                    server.param_versions[name] = self.param_versions[name]
+            num_updated += 1
+        if num_updated == 0:
+            raise ConnectionError("The weights couldn't be sent to any vLLM server.")
+
+    def update_named_param(self, name: str, weights: torch.Tensor):
+        """
+        Updates a specific named parameter in the model of all the servers. Same as
+        [`~VLLMClient.update_named_param`].
+        """
+        self._update([name], lambda client: client.update_named_param(name, weights))
+
+    def update_named_params(self, named_params: list[tuple[str, torch.Tensor]], bucket_size_mb: float = 256.0):
+        """
+        Updates several named parameters in the model of all the servers at once. Same as
+        [`~VLLMClient.update_named_params`].
+        """
+        named_params = list(named_params)
+        names = [name for name, _ in named_params]
+        self._update(names, lambda client: client.update_named_params(named_params, bucket_size_mb))
+
+    def update_model_params(self, model: nn.Module, bucket_size_mb: float = 256.0):
+        """
+        Updates all parameters of the given model on all the servers. Same as [`~VLLMClient.update_model_params`].
+        """
+        if bucket_size_mb > 0:
+            self.update_named_params([(name, param.data) for name, param in model.named_parameters()], bucket_size_mb)
+        else:
+            for name, param in model.named_parameters():
+                self.update_named_param(name, param.data)
+
+    def reset_prefix_cache(self):
+        """
+        Resets the prefix cache of all the healthy servers.
+        """
+        for server in self.servers:
+            if server.failures > 0:
+                continue
+            try:
+                server.client.reset_prefix_cache()
+            except Exception as exc:
+                if not self._is_retryable(exc):
+                    raise
+                self._mark_failed(server, exc)
+
+    def close_communicator(self):
+        """
+        Closes the weight update group of all the servers.
+        """
+        for server in self.servers:
+            if not server.has_communicator:
+                continue
+            try:
+                server.client.close_communicator()
+            except Exception as exc:
+                if not self._is_retryable(exc):
+                    raise
+            server.has_communicator = False
 
 
 # Example usage
@@ -13,19 +13,30 @@
 # limitations under the License.
 
 import argparse
+import asyncio
+import heapq
+import json
 import logging
+import math
 import os
-from collections.abc import Sequence
+import threading
+import time
+import traceback
+import uuid
+from collections import defaultdict, deque
+from collections.abc import AsyncIterator, Awaitable, Sequence
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import asynccontextmanager
 from dataclasses import dataclass, field
-from itertools import chain
+from itertools import count
 from multiprocessing import Pipe, Process
 from multiprocessing.connection import Connection
-from typing import Optional
+from typing import Any, Optional
 
 import torch
 
 from trl import TrlParser
+from trl.extras.vllm_client import pack_sequences
 from trl.import_utils import (
     is_fastapi_available,
     is_pydantic_available,
@@ -36,11 +47,12 @@ from trl.import_utils import (
 
 
 if is_fastapi_available():
-    from fastapi import FastAPI
+    from fastapi import FastAPI, Header, HTTPException, Request
+    from fastapi.responses import Response, StreamingResponse
 
 
 if is_pydantic_available():
-    from pydantic import BaseModel
+    from pydantic import BaseModel, model_validator
 
 
 if is_uvicorn_available():
@@ -52,7 +64,7 @@ if is_vllm_available():
     from vllm.distributed.device_communicators.pynccl import PyNcclCommunicator
     from vllm.distributed.parallel_state import get_world_group
     from vllm.distributed.utils import StatelessProcessGroup
-    from vllm.sampling_params import GuidedDecodingParams
+    from vllm.sampling_params import GuidedDecodingParams, RequestOutputKind
     from vllm.utils import get_open_port
 
     if is_vllm_ascend_available():
@@ -135,6 +147,32 @@ class WeightSyncWorkerExtension:
         # Load the received weights into the model.
         self.model_runner.model.load_weights(weights=[(name, weight)])
 
+    def update_named_params(self, names: Sequence[str], dtype: torch.dtype, shapes: Sequence[Sequence[int]]) -> None:
+        """
+        Receives a bucket of updated weights from the client process, packed in a single flat buffer, and updates the
+        named parameters in the model.
+
+        Args:
+            names (`Sequence[str]`):
+                Names of the weight tensors being updated, in the order they are packed in the buffer.
+            dtype (`torch.dtype`):
+                Data type of all the weight tensors of the bucket (e.g., `torch.bfloat16`).
+            shapes (`Sequence[Sequence[int]]`):
+                Shapes of the weight tensors.
+        """
+        if self.pynccl_comm is None:
+            raise RuntimeError("Communicator not initialized. Call `init_communicator` first.")
+
+        # Allocate a single flat buffer for the whole bucket, and receive it with one broadcast.
+        numels = [math.prod(shape) for shape in shapes]
+        buffer = torch.empty(sum(numels), dtype=dtype, device=self.device)
+        self.pynccl_comm.broadcast(buffer, src=self.client_rank)
+        self.pynccl_comm.group.barrier()
+
+        # Unpack the buffer into views (no copy) and load all the weights of the bucket at once.
+        weights = [(name, weight.view(shape)) for name, weight, shape in zip(names, buffer.split(numels), shapes)]
+        self.model_runner.model.load_weights(weights=weights)
+
     def close_communicator(self) -> None:
         """
         Closes the communicator when weight synchronization is no longer needed.
@@ -187,6 +225,27 @@ class ScriptArguments:
         log_level (`str`, *optional*, defaults to `"info"`):
             Log level for uvicorn. Possible choices: `"critical"`, `"error"`, `"warning"`, `"info"`, `"debug"`,
             `"trace"`.
+        ref_model (`str` or `None`, *optional*, defaults to `None`):
+            Name or path of a frozen reference model to host next to the model, on the same devices. If set, the
+            `/score_logprobs/` endpoint computes the log-probabilities of token sequences with this model, so that the
+            trainers don't need to keep a reference model on the training devices.
+        ref_revision (`str` or `None`, *optional*, defaults to `None`):
+            Revision to use for the reference model. If not specified, `revision` is used when the reference model is
+            the same as the model, so that both load the same snapshot, else the default branch is used.
+        ref_gpu_memory_utilization (`float`, *optional*, defaults to `0.3`):
+            Ratio (between 0 and 1) of GPU memory to reserve for the reference model. The reference model shares the
+            devices of the model, so the sum of `gpu_memory_utilization` and `ref_gpu_memory_utilization` must not
+            exceed 1.
+        max_inflight_tokens (`int` or `None`, *optional*, defaults to `None`):
+            Maximum number of tokens (estimated prompt and completion lengths) of the generation requests processed at
+            the same time. The generation requests of all the clients are batched together by the workers, and the
+            requests exceeding this budget are queued, by priority, until enough requests are finished. A request
+            larger than the budget is processed alone. If `None`, all the requests are processed as soon as they are
+            received.
+        max_queued_requests (`int` or `None`, *optional*, defaults to `None`):
+            Maximum number of generation requests waiting for `max_inflight_tokens` to be available. Further requests
+            are rejected with the HTTP status 429 (Too Many Requests), and the clients retry them later. If `None`, the
+            queue is unbounded.
     """
 
     model: str = field(
@@ -258,10 +317,167 @@ class ScriptArguments:
             "'trace'."
         },
     )
+    ref_model: Optional[str] = field(
+        default=None,
+        metadata={
+            "help": "Name or path of a frozen reference model to host next to the model, on the same devices. If set, "
+            "the `/score_logprobs/` endpoint computes the log-probabilities of token sequences with this model, so "
+            "that the trainers don't need to keep a reference model on the training devices."
+        },
+    )
+    ref_revision: Optional[str] = field(
+        default=None,
+        metadata={
+            "help": "Revision to use for the reference model. If not specified, `revision` is used when the reference "
+            "model is the same as the model, so that both load the same snapshot, else the default branch is used."
+        },
+    )
+    ref_gpu_memory_utilization: float = field(
+        default=0.3,
+        metadata={
+            "help": "Ratio (between 0 and 1) of GPU memory to reserve for the reference model. The reference model "
+            "shares the devices of the model, so the sum of `gpu_memory_utilization` and `ref_gpu_memory_utilization` "
+            "must not exceed 1."
+        },
+    )
+    max_inflight_tokens: Optional[int] = field(
+        default=None,
+        metadata={
+            "help": "Maximum number of tokens (estimated prompt and completion lengths) of the generation requests "
+            "processed at the same time. The generation requests of all the clients are batched together by the "
+            "workers, and the requests exceeding this budget are queued, by priority, until enough requests are "
+            "finished. A request larger than the budget is processed alone. If `None`, all the requests are processed "
+            "as soon as they are received."
+        },
+    )
+    max_queued_requests: Optional[int] = field(
+        default=None,
+        metadata={
+            "help": "Maximum number of generation requests waiting for `max_inflight_tokens` to be available. Further "
+            "requests are rejected with the HTTP status 429 (Too Many Requests), and the clients retry them later. If "
+            "`None`, the queue is unbounded."
+        },
+    )
+
+
+class EngineScheduler:
+    """
+    Runs the generations of a `llm_worker` with continuous batching: the prompts of all the generation commands
+    received by the worker are added to the same vLLM engine, which is stepped until they are finished, and the outputs
+    of each command are sent back as soon as all its prompts are finished. A new command can thus start while the
+    previous ones are still generating, instead of waiting for the whole batch to finish.
+
+    With data parallelism, the engines of the DP ranks step in lockstep: before each step, vLLM checks whether any
+    engine of the DP group has unfinished requests, with a collective call, and the engines without requests run a
+    dummy step. The scheduler of every rank thus keeps stepping, even without generations of its own, until no engine
+    has unfinished requests, and the server sends every generation command to all the workers.
+
+    Args:
+        llm (`vllm.LLM`):
+            Model of the worker.
+        connection (`multiprocessing.connection.Connection`):
+            Child end of the pipe connected to the server, used to send the results.
+    """
+
+    def __init__(self, llm: "LLM", connection: Connection):
+        self.llm = llm
+        self.connection = connection
+        self.generations: dict[int, dict] = {}  # request id of the command -> state of its generation
+        self.owners: dict[str, tuple[int, int]] = {}  # vLLM request id -> (request id of the command, prompt index)
+        self.running = False  # whether an engine of the DP group had unfinished requests at the last step
+
+    @staticmethod
+    def is_generation(command: dict) -> bool:
+        return command["type"] == "stream" or (command["type"] == "call" and command["method"] == "generate")
+
+    def has_unfinished_generations(self) -> bool:
+        return bool(self.generations)
+
+    def is_idle(self) -> bool:
+        """
+        Returns whether the engine doesn't need to be stepped, i.e. neither this engine nor, as of the last step, any
+        other engine of the DP group has unfinished requests. Only then can the worker wait for the next command, or
+        process a command that isn't a generation.
+        """
+        return not self.running and not self.generations
+
+    def add(self, command: dict) -> None:
+        """
+        Adds the prompts of a generation command to the engine. For `"stream"` commands, the output of each prompt is
+        sent as soon as it's finished, along with the index of its prompt, and `None` is sent once all the prompts are
+        finished. For `"call"` commands, the list of outputs is sent once all the prompts are finished, as
+        `llm.generate` would return it.
+        """
+        request_id, prompts = command["request_id"], command["kwargs"]["prompts"]
+        sampling_params = command["kwargs"]["sampling_params"]
+        sampling_params.output_kind = RequestOutputKind.FINAL_ONLY  # we only care about the final output
+        self.generations[request_id] = {
+            "stream": command["type"] == "stream",
+            "outputs": [None] * len(prompts),
+            "vllm_request_ids": [],
+        }
+        try:
+            for index, prompt in enumerate(prompts):
+                vllm_request_id = str(next(self.llm.request_counter))
+                self.llm.llm_engine.add_request(vllm_request_id, prompt, sampling_params)
+                self.generations[request_id]["vllm_request_ids"].append(vllm_request_id)
+                self.owners[vllm_request_id] = (request_id, index)
+        except Exception:
+            self.abort(request_id, traceback.format_exc())
+            raise
+        if not prompts:
+            self._finish(request_id)
+
+    def step(self) -> None:
+        """
+        Runs one step of the engine, and sends the outputs of the prompts finished by this step. Must be called until
+        the scheduler is idle, and never once it is, so that all the DP ranks make the same collective calls.
+        """
+        try:
+            # With data parallelism, this all-reduces the unfinished state of all the engines of the DP group, and
+            # makes the next step a dummy one if this engine has no unfinished requests but another one does
+            self.running = self.llm.llm_engine.has_unfinished_requests()
+            if not self.running:
+                return
+            outputs = self.llm.llm_engine.step()
+        except Exception:
+            for request_id in list(self.generations):
+                self.abort(request_id, traceback.format_exc())
+            raise
+        for output in outputs:
+            if not output.finished or output.request_id not in self.owners:  # unfinished or aborted
+                continue
+            request_id, index = self.owners.pop(output.request_id)
+            generation = self.generations[request_id]
+            if generation["stream"]:
+                self.connection.send({"request_id": request_id, "result": {"index": index, "output": output}})
+            generation["outputs"][index] = output
+            if all(output is not None for output in generation["outputs"]):
+                self._finish(request_id)
+
+    def _finish(self, request_id: int) -> None:
+        generation = self.generations.pop(request_id)
+        result = None if generation["stream"] else generation["outputs"]
+        self.connection.send({"request_id": request_id, "result": result})
+
+    def abort(self, request_id: int, error: str) -> None:
+        """Aborts the generation of a command, and sends `error` to the server."""
+        generation = self.generations.pop(request_id)
+        unfinished = [
+            vllm_request_id for vllm_request_id in generation["vllm_request_ids"] if vllm_request_id in self.owners
+        ]
+        for vllm_request_id in unfinished:
+            del self.owners[vllm_request_id]
+        self.llm.llm_engine.abort_request(unfinished)
+        self.connection.send({"request_id": request_id, "error": error})
 
 
 def llm_worker(
-    script_args: ScriptArguments, data_parallel_rank: int, master_port: int, connection: Connection
+    script_args: ScriptArguments,
+    data_parallel_rank: int,
+    master_port: int,
+    connection: Connection,
+    is_ref_model: bool = False,
 ) -> None:
     # Set required environment variables for DP to work with vLLM
     os.environ["VLLM_DP_RANK"] = str(data_parallel_rank)
@@ -269,42 +485,205 @@ def llm_worker(
     os.environ["VLLM_DP_SIZE"] = str(script_args.data_parallel_size)
     os.environ["VLLM_DP_MASTER_PORT"] = str(master_port)
 
-    llm = LLM(
-        model=script_args.model,
-        revision=script_args.revision,
-        tensor_parallel_size=script_args.tensor_parallel_size,
-        gpu_memory_utilization=script_args.gpu_memory_utilization,
-        enforce_eager=script_args.enforce_eager,
-        dtype=script_args.dtype,
-        # Automatic Prefix Caching caches the KV cache of existing queries, so that a new query can
-        # directly reuse the KV cache if it shares the same prefix with one of the existing queries.
-        # This is particularly useful here because we generate completions from the same prompts.
-        enable_prefix_caching=script_args.enable_prefix_caching,
-        max_model_len=script_args.max_model_len,
-        worker_extension_cls="trl.scripts.vllm_serve.WeightSyncWorkerExtension",
-    )
+    if is_ref_model:
+        # The reference model is frozen and only used for scoring, so it doesn't need the weight sync extension.
+        # Prompt log-probabilities are computed for every position, so prefix caching would be useless.
+        ref_revision = script_args.ref_revision
+        if ref_revision is None and script_args.ref_model == script_args.model:
+            ref_revision = script_args.revision
+        llm = LLM(
+            model=script_args.ref_model,
+            revision=ref_revision,
+            tensor_parallel_size=script_args.tensor_parallel_size,
+            gpu_memory_utilization=script_args.ref_gpu_memory_utilization,
+            enforce_eager=script_args.enforce_eager,
+            dtype=script_args.dtype,
+            enable_prefix_caching=False,
+            max_model_len=script_args.max_model_len,
+        )
+    else:
+        llm = LLM(
+            model=script_args.model,
+            revision=script_args.revision,
+            tensor_parallel_size=script_args.tensor_parallel_size,
+            gpu_memory_utilization=script_args.gpu_memory_utilization,
+            enforce_eager=script_args.enforce_eager,
+            dtype=script_args.dtype,
+            # Automatic Prefix Caching caches the KV cache of existing queries, so that a new query can
+            # directly reuse the KV cache if it shares the same prefix with one of the existing queries.
+            # This is particularly useful here because we generate completions from the same prompts.
+            enable_prefix_caching=script_args.enable_prefix_caching,
+            max_model_len=script_args.max_model_len,
+            worker_extension_cls="trl.scripts.vllm_serve.WeightSyncWorkerExtension",
+        )
 
     # Send ready signal to parent process
     connection.send({"status": "ready"})
 
+    # The generation commands are batched together by the engine as soon as they are received. The other commands are
+    # barriers: they wait for the generations in flight to finish, on all the DP ranks, and the commands received after
+    # them wait for them to be processed, so that, e.g., the weights are never updated in the middle of a generation.
+    scheduler = EngineScheduler(llm, connection)
+    commands = deque()
     while True:
-        # Wait for commands from the parent process
+        # Wait for commands from the parent process, without blocking while generations are in flight
         try:
-            command = connection.recv()
+            if not commands and scheduler.is_idle():
+                commands.append(connection.recv())
+            while connection.poll():
+                commands.append(connection.recv())
         except KeyboardInterrupt:
-            llm.collective_rpc(method="close_communicator")
+            if not is_ref_model:
+                llm.collective_rpc(method="close_communicator")
             break
 
-        # Handle commands
-        if command["type"] in ["call", "fire_and_forget"]:
-            method_name = command["method"]
-            args, kwargs = command.get("args", ()), command.get("kwargs", {})
-            method = getattr(llm, method_name)
-            result = method(*args, **kwargs)
-            if command["type"] == "call":
-                connection.send(result)
-        elif command["type"] == "shutdown":
-            break
+        while commands and (EngineScheduler.is_generation(commands[0]) or scheduler.is_idle()):
+            command = commands.popleft()
+            if command["type"] == "shutdown":
+                return
+
+            # Every message sent back carries the id of the command it answers, see `WorkerConnection`
+            request_id = command.get("request_id")
+            try:
+                if EngineScheduler.is_generation(command):
+                    scheduler.add(command)  # errors are sent by the scheduler
+                elif command["type"] in ["call", "fire_and_forget"]:
+                    method_name = command["method"]
+                    args, kwargs = command.get("args", ()), command.get("kwargs", {})
+                    method = getattr(llm, method_name)
+                    result = method(*args, **kwargs)
+                    if command["type"] == "call":
+                        connection.send({"request_id": request_id, "result": result})
+            except Exception:
+                # Report the error to the request instead of killing the worker, which would leave the server hanging
+                logger.exception(f"Worker failed to process a {command['type']!r} command")
+                if command["type"] == "call" and not EngineScheduler.is_generation(command):
+                    connection.send({"request_id": request_id, "error": traceback.format_exc()})
+
+        if not scheduler.is_idle():
+            try:
+                scheduler.step()  # errors are sent by the scheduler
+            except Exception:
+                logger.exception("Worker failed to run a step of the engine")
+
+
+class WorkerConnection:
+    """
+    Asynchronous interface to a `llm_worker` process, used by the endpoints of the server.
+
+    Each command is tagged with a request id, and the messages sent back by the worker are routed to the request they
+    answer by a reader thread. Commands are sent from a dedicated thread, in the order they are issued, so that a large
+    command sent to a busy worker never blocks the event loop. Several requests can thus be in flight at the same time,
+    queued by the worker, while the server keeps answering other requests, such as health checks.
+
+    Args:
+        connection (`multiprocessing.connection.Connection`):
+            Parent end of the pipe connected to the worker.
+    """
+
+    def __init__(self, connection: Connection):
+        self.connection = connection
+        self._request_ids = count()
+        self._pending: dict[int, asyncio.Queue] = {}
+        self._sender = ThreadPoolExecutor(max_workers=1)  # a single thread keeps the commands in order
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._busy_time = 0.0
+        self._busy_since: Optional[float] = None
+
+    @property
+    def busy_time(self) -> float:
+        """Total time, in seconds, during which at least one request was waiting for the worker."""
+        if self._busy_since is None:
+            return self._busy_time
+        return self._busy_time + time.perf_counter() - self._busy_since
+
+    async def wait_ready(self) -> None:
+        """Waits for the worker to be ready, then starts routing its messages. Must be called from the event loop."""
+        self._loop = asyncio.get_running_loop()
+        message = await self._loop.run_in_executor(self._sender, self.connection.recv)
+        if not (isinstance(message, dict) and message.get("status") == "ready"):
+            raise RuntimeError(f"Unexpected message from the worker while waiting for it to be ready: {message}")
+        threading.Thread(target=self._read, daemon=True).start()
+
+    def _call_in_loop(self, callback, *args) -> None:
+        # Called from the reader and sender threads, which may outlive the event loop when the server shuts down
+        try:
+            self._loop.call_soon_threadsafe(callback, *args)
+        except RuntimeError:  # the event loop is closed
+            pass
+
+    def _read(self) -> None:
+        while True:
+            try:
+                message = self.connection.recv()
+            except (EOFError, OSError):  # the worker has exited, fail the pending requests instead of hanging
+                self._call_in_loop(self._fail_pending, "The vLLM worker has exited.")
+                break
+            self._call_in_loop(self._route, message)
+
+    def _write(self, command: dict) -> None:
+        try:
+            self.connection.send(command)
+        except OSError:
+            error = {"request_id": command["request_id"], "error": "The vLLM worker has exited."}
+            self._call_in_loop(self._route, error)
+
+    def _route(self, message: dict) -> None:
+        queue = self._pending.get(message["request_id"])
+        if queue is not None:
+            queue.put_nowait(message)
+
+    def _fail_pending(self, error: str) -> None:
+        for request_id in list(self._pending):
+            self._route({"request_id": request_id, "error": error})
+
+    def _send(self, command: dict) -> tuple[int, asyncio.Queue]:
+        request_id = next(self._request_ids)
+        queue = asyncio.Queue()
+        if command["type"] != "fire_and_forget":
+            if not self._pending:
+                self._busy_since = time.perf_counter()
+            self._pending[request_id] = queue
+        self._loop.run_in_executor(self._sender, self._write, {**command, "request_id": request_id})
+        return request_id, queue
+
+    def _done(self, request_id: int) -> None:
+        if self._pending.pop(request_id, None) is not None and not self._pending:
+            self._busy_time += time.perf_counter() - self._busy_since
+            self._busy_since = None
+
+    async def _receive(self, queue: asyncio.Queue) -> Any:
+        message = await queue.get()
+        if "error" in message:
+            raise RuntimeError(f"The vLLM worker failed to process the request:\n{message['error']}")
+        return message["result"]
+
+    def call(self, method: str, kwargs: Optional[dict] = None) -> Awaitable[Any]:
+        """
+        Calls `method` of the worker's `LLM` with `kwargs`. The command is sent right away, in the order of the calls,
+        and the returned awaitable resolves to its result.
+        """
+        request_id, queue = self._send({"type": "call", "method": method, "kwargs": kwargs or {}})
+        return self._result(request_id, queue)
+
+    async def _result(self, request_id: int, queue: asyncio.Queue) -> Any:
+        try:
+            return await self._receive(queue)
+        finally:
+            self._done(request_id)
+
+    def fire_and_forget(self, method: str, kwargs: Optional[dict] = None) -> None:
+        """Calls `method` of the worker's `LLM` with `kwargs`, without waiting for it to complete."""
+        self._send({"type": "fire_and_forget", "method": method, "kwargs": kwargs or {}})
+
+    async def stream(self, kwargs: dict) -> AsyncIterator[dict]:
+        """Generates completions, and yields the output of each prompt, with its index, as soon as it's finished."""
+        request_id, queue = self._send({"type": "stream", "kwargs": kwargs})
+        try:
+            while (result := await self._receive(queue)) is not None:
+                yield result
+        finally:
+            self._done(request_id)
 
 
 def chunk_list(lst: list, n: int) -> list[list]:
@@ -323,6 +702,213 @@ def chunk_list(lst: list, n: int) -> list[list]:
     return [lst[i * k + min(i, r) : (i + 1) * k + min(i + 1, r)] for i in range(n)]
 
 
+def balance_by_cost(costs: Sequence[float], n: int) -> list[list[int]]:
+    """
+    Split the indices of `costs` into `n` sublists with total costs as close as possible. Items are taken by decreasing
+    cost, and each one is assigned to the sublist with the lowest total cost so far (longest processing time first).
+    The indices of each sublist are sorted, and sublists can be empty.
+
+    Example:
+        >>> balance_by_cost([1, 8, 2, 3, 4], 2)
+        [[0, 1], [2, 3, 4]]
+        >>> balance_by_cost([5, 5], 3)
+        [[0], [1], []]
+    """
+    loads = [(0.0, i) for i in range(n)]  # (total cost, sublist index), as a heap
+    sublists = [[] for _ in range(n)]
+    for index in sorted(range(len(costs)), key=lambda index: -costs[index]):
+        load, i = heapq.heappop(loads)
+        sublists[i].append(index)
+        heapq.heappush(loads, (load + costs[index], i))
+    return [sorted(sublist) for sublist in sublists]
+
+
+class TokenCostEstimator:
+    """
+    Estimates the number of tokens a prompt costs to a worker, i.e. its length plus the expected length of its
+    completions, to balance the prompts of a request across the data parallel workers with [`balance_by_cost`].
+
+    Both quantities are learned from the outputs of the previous requests, with exponential moving averages: the number
+    of tokens per character, for prompts given as text, and the length of the completions, which defaults to
+    `max_tokens` until outputs are observed.
+
+    Args:
+        momentum (`float`, *optional*, defaults to `0.9`):
+            Weight of the previous estimate when updating it with the average of a new batch of outputs.
+    """
+
+    def __init__(self, momentum: float = 0.9):
+        self.momentum = momentum
+        self.tokens_per_char = 0.25  # typical for English text with BPE tokenizers, until a text prompt is observed
+        self.completion_length: Optional[float] = None
+
+    def _update(self, estimate: Optional[float], value: float) -> float:
+        return value if estimate is None else self.momentum * estimate + (1 - self.momentum) * value
+
+    def prompt_length(self, prompt) -> float:
+        if isinstance(prompt, dict):
+            return len(prompt["prompt_token_ids"])
+        return len(prompt) * self.tokens_per_char
+
+    def costs(self, prompts: list, n: int = 1, max_tokens: int = 16) -> list[float]:
+        """Returns the estimated cost of each prompt, when generating `n` completions of at most `max_tokens`."""
+        completion_length = max_tokens if self.completion_length is None else min(self.completion_length, max_tokens)
+        return [self.prompt_length(prompt) + n * completion_length for prompt in prompts]
+
+    def update(self, prompts: list, outputs: list) -> None:
+        """Updates the estimates from the `RequestOutput`s generated by vLLM for `prompts`."""
+        num_chars = sum(len(prompt) for prompt in prompts if isinstance(prompt, str))
+        if num_chars > 0:
+            num_tokens = sum(
+                len(output.prompt_token_ids) for prompt, output in zip(prompts, outputs) if isinstance(prompt, str)
+            )
+            self.tokens_per_char = self._update(self.tokens_per_char, num_tokens / num_chars)
+        lengths = [len(completion.token_ids) for output in outputs for completion in output.outputs]
+        if lengths:
+            self.completion_length = self._update(self.completion_length, sum(lengths) / len(lengths))
+
+
+class RequestQueue:
+    """
+    Admission control of the generation requests of the server, shared by all its clients.
+
+    Requests are admitted as long as the total cost (number of tokens) of the requests in flight stays within
+    `max_inflight_tokens`. The others wait in a queue, ordered by priority (lower values first), then by arrival, and
+    are admitted as the requests in flight are released. A request larger than the budget is admitted when no other
+    request is in flight.
+
+    Args:
+        max_inflight_tokens (`int` or `None`, *optional*, defaults to `None`):
+            Budget of the requests in flight. If `None`, all the requests are admitted immediately.
+        max_queued_requests (`int` or `None`, *optional*, defaults to `None`):
+            Maximum number of waiting requests, see [`~RequestQueue.is_full`]. If `None`, the queue is unbounded.
+    """
+
+    def __init__(self, max_inflight_tokens: Optional[int] = None, max_queued_requests: Optional[int] = None):
+        self.max_inflight_tokens = max_inflight_tokens
+        self.max_queued_requests = max_queued_requests
+        self.inflight_tokens = 0
+        self._waiting: list[tuple[int, int, float, asyncio.Future]] = []  # (priority, order, cost, future), as a heap
+        self._order = count()
+
+    @property
+    def num_queued(self) -> int:
+        return len(self._waiting)
+
+    def _fits(self, cost: float) -> bool:
+        return (
+            self.max_inflight_tokens is None
+            or self.inflight_tokens == 0
+            or self.inflight_tokens + cost <= self.max_inflight_tokens
+        )
+
+    def is_full(self, cost: float) -> bool:
+        """Whether a request of this cost would have to wait, while the queue already holds `max_queued_requests`."""
+        must_wait = bool(self._waiting) or not self._fits(cost)
+        return must_wait and self.max_queued_requests is not None and len(self._waiting) >= self.max_queued_requests
+
+    async def acquire(self, cost: float, priority: int = 0) -> None:
+        """Waits until a request of this cost is admitted. It must then be released with [`~RequestQueue.release`]."""
+        if not self._waiting and self._fits(cost):
+            self.inflight_tokens += cost
+            return
+        entry = (priority, next(self._order), cost, asyncio.get_running_loop().create_future())
+        heapq.heappush(self._waiting, entry)
+        try:
+            await entry[3]
+        except asyncio.CancelledError:  # e.g., the client disconnected
+            if entry[3].done() and not entry[3].cancelled():  # admitted just before being cancelled
+                self.release(cost)
+            else:
+                self._waiting.remove(entry)
+                heapq.heapify(self._waiting)
+                self._admit_waiting()  # the cancelled request may have been blocking the head of the queue
+            raise
+
+    def release(self, cost: float) -> None:
+        """Releases an admitted request, and admits the waiting requests that fit in the freed budget."""
+        self.inflight_tokens -= cost
+        self._admit_waiting()
+
+    def _admit_waiting(self) -> None:
+        while self._waiting and self._fits(self._waiting[0][2]):
+            _, _, cost, future = heapq.heappop(self._waiting)
+            self.inflight_tokens += cost
+            future.set_result(None)
+
+
+class ServerMetrics:
+    """
+    Minimal registry of counters, gauges and histograms, rendered in the Prometheus text format by the `/metrics/`
+    endpoint, so that the server doesn't need `prometheus_client`.
+
+    Metrics must be declared with [`~ServerMetrics.declare`] before being updated. Each update takes the labels of the
+    series it applies to as keyword arguments.
+
+    Example:
+        >>> metrics = ServerMetrics()
+        >>> metrics.declare("requests_total", "counter", "Number of requests.")
+        >>> metrics.inc("requests_total", endpoint="/generate/")
+        >>> print(metrics.render())
+        # HELP requests_total Number of requests.
+        # TYPE requests_total counter
+        requests_total{endpoint="/generate/"} 1.0
+    """
+
+    LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+    def __init__(self):
+        self._declarations: dict[str, tuple[str, str, tuple[float, ...]]] = {}  # name -> (type, description, buckets)
+        self._values: dict[str, dict[tuple, float]] = defaultdict(dict)  # name -> labels -> value
+        self._histograms: dict[str, dict[tuple, list[float]]] = defaultdict(dict)  # name -> labels -> bucket counts
+
+    def declare(
+        self, name: str, metric_type: str, description: str, buckets: tuple[float, ...] = LATENCY_BUCKETS
+    ) -> None:
+        if metric_type not in ("counter", "gauge", "histogram"):
+            raise ValueError(f"Unsupported metric type: {metric_type}")
+        self._declarations[name] = (metric_type, description, buckets)
+
+    def inc(self, name: str, value: float = 1.0, **labels) -> None:
+        key = tuple(labels.items())
+        self._values[name][key] = self._values[name].get(key, 0.0) + value
+
+    def set(self, name: str, value: float, **labels) -> None:
+        self._values[name][tuple(labels.items())] = float(value)
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        key = tuple(labels.items())
+        buckets = self._declarations[name][2]
+        counts = self._histograms[name].setdefault(key, [0.0] * (len(buckets) + 2))  # buckets, +Inf, sum
+        for i, bound in enumerate(buckets):
+            if value <= bound:
+                counts[i] += 1
+        counts[-2] += 1
+        counts[-1] += value
+
+    @staticmethod
+    def _format_labels(labels: tuple) -> str:
+        if not labels:
+            return ""
+        escape = str.maketrans({"\\": "\\\\", '"': '\\"', "\n": "\\n"})
+        return "{" + ",".join(f'{key}="{str(value).translate(escape)}"' for key, value in labels) + "}"
+
+    def render(self) -> str:
+        lines = []
+        for name, (metric_type, description, buckets) in self._declarations.items():
+            lines += [f"# HELP {name} {description}", f"# TYPE {name} {metric_type}"]
+            if metric_type != "histogram":
+                for labels, value in self._values[name].items():
+                    lines.append(f"{name}{self._format_labels(labels)} {value}")
+                continue
+            for labels, counts in self._histograms[name].items():
+                for bound, bucket_count in zip((*buckets, "+Inf"), counts):
+                    lines.append(f"{name}_bucket{self._format_labels((*labels, ('le', bound)))} {bucket_count}")
+                lines.append(f"{name}_sum{self._format_labels(labels)} {counts[-1]}")
+                lines.append(f"{name}_count{self._format_labels(labels)} {counts[-2]}")
+        return "\n".join(lines) + "\n"
+
+
 def main(script_args: ScriptArguments):
     if not is_fastapi_available():
         raise ImportError(
@@ -342,6 +928,15 @@ def main(script_args: ScriptArguments):
     if not is_vllm_available():
         raise ImportError("vLLM is required to run the vLLM serve script. Please install it using `pip install vllm`.")
 
+    if script_args.ref_model is not None and (
+        script_args.gpu_memory_utilization + script_args.ref_gpu_memory_utilization > 1.0
+    ):
+        raise ValueError(
+            f"The model and the reference model share the same devices, so the sum of `gpu_memory_utilization` "
+            f"({script_args.gpu_memory_utilization}) and `ref_gpu_memory_utilization` "
+            f"({script_args.ref_gpu_memory_utilization}) must not exceed 1."
+        )
+
     # Spawn dp workers, and setup pipes for communication
     master_port = get_open_port()
     connections = []
@@ -353,15 +948,102 @@ def main(script_args: ScriptArguments):
         connections.append(parent_connection)
         processes.append(process)
 
+    # Workers hosting the reference model, if any, with their own DP group
+    ref_connections = []
+
+    # Asynchronous interfaces to the workers, used by the endpoints so that they never block the event loop
+    workers: list[WorkerConnection] = []
+    ref_workers: list[WorkerConnection] = []
+
+    # Balances the prompts across the workers by their estimated number of tokens, learned from the previous requests
+    cost_estimator = TokenCostEstimator()
+
+    # Load of the server, exposed by the `/metrics/` endpoint
+    metrics = ServerMetrics()
+    metrics.declare("trl_vllm_requests_total", "counter", "Number of requests, by endpoint and status code.")
+    metrics.declare(
+        "trl_vllm_request_duration_seconds",
+        "histogram",
+        "Latency of the requests, by endpoint. For /generate_stream/, until the end of the stream.",
+    )
+    metrics.declare(
+        "trl_vllm_queue_time_seconds", "histogram", "Time spent by generation requests waiting to be admitted."
+    )
+    metrics.declare("trl_vllm_queued_requests", "gauge", "Number of generation requests waiting to be admitted.")
+    metrics.declare("trl_vllm_inflight_tokens", "gauge", "Estimated number of tokens of the requests in flight.")
+    metrics.declare("trl_vllm_prompt_tokens_total", "counter", "Number of prompt tokens processed, by model.")
+    metrics.declare("trl_vllm_generation_tokens_total", "counter", "Number of tokens generated.")
+    metrics.declare(
+        "trl_vllm_worker_busy_seconds_total",
+        "counter",
+        "Time during which a worker had requests to process, by model and data parallel rank.",
+    )
+    metrics.declare("trl_vllm_weight_update_bytes_total", "counter", "Size of the weights updated by the clients.")
+    metrics.declare(
+        "trl_vllm_weight_update_seconds",
+        "histogram",
+        "Time to update weights, from the request to the end of the update on all the workers.",
+    )
+    metrics.declare("trl_vllm_prefix_cache_resets_total", "counter", "Number of prefix cache resets.")
+
+    def record_tokens(outputs: list, model: str = "model") -> None:
+        num_tokens = sum(len(output.prompt_token_ids) for output in outputs)
+        metrics.inc("trl_vllm_prompt_tokens_total", num_tokens, model=model)
+        if model == "model":
+            num_tokens = sum(len(completion.token_ids) for output in outputs for completion in output.outputs)
+            metrics.inc("trl_vllm_generation_tokens_total", num_tokens)
+
+    def record_weight_update(num_bytes: int, calls: list) -> None:
+        # The workers are updated in the background, once the client broadcasts the weights
+        metrics.inc("trl_vllm_weight_update_bytes_total", num_bytes)
+        start_time = time.perf_counter()
+
+        async def wait():
+            await asyncio.gather(*calls)
+            metrics.observe("trl_vllm_weight_update_seconds", time.perf_counter() - start_time)
+
+        task = asyncio.create_task(wait())
+        task.add_done_callback(lambda task: task.cancelled() or task.exception())  # errors are logged by the workers
+
+    # Generation requests of all the clients share the workers, within a budget of tokens in flight
+    request_queue = RequestQueue(script_args.max_inflight_tokens, script_args.max_queued_requests)
+
+    async def admit(cost: float, priority: int) -> float:
+        # Signal backpressure to the client, which retries later, instead of queueing requests indefinitely
+        if request_queue.is_full(cost):
+            raise HTTPException(
+                status_code=429,
+                detail=f"Too many queued requests ({request_queue.num_queued}), retry later.",
+                headers={"Retry-After": "1"},
+            )
+        start_time = time.perf_counter()
+        await request_queue.acquire(cost, priority)
+        queue_time = time.perf_counter() - start_time
+        metrics.observe("trl_vllm_queue_time_seconds", queue_time)
+        return queue_time
+
     @asynccontextmanager
     async def lifespan(app: FastAPI):
         # Wait for all workers to send "ready"
-        ready_connections = set()
-        while len(ready_connections) < script_args.data_parallel_size:
-            for connection in connections:
-                msg = connection.recv()
-                if isinstance(msg, dict) and msg.get("status") == "ready":
-                    ready_connections.add(connection)
+        workers.extend(WorkerConnection(connection) for connection in connections)
+        await asyncio.gather(*(worker.wait_ready() for worker in workers))
+
+        if script_args.ref_model is not None:
+            # vLLM sizes its KV cache from the free memory of the devices when the engine starts, so the reference
+            # model engines, which share the devices of the model, are only started once the model engines are ready
+            ref_master_port = get_open_port()
+            for data_parallel_rank in range(script_args.data_parallel_size):
+                parent_connection, child_connection = Pipe()
+                process = Process(
+                    target=llm_worker,
+                    args=(script_args, data_parallel_rank, ref_master_port, child_connection),
+                    kwargs={"is_ref_model": True},
+                )
+                process.start()
+                ref_connections.append(parent_connection)
+                processes.append(process)
+            ref_workers.extend(WorkerConnection(connection) for connection in ref_connections)
+            await asyncio.gather(*(worker.wait_ready() for worker in ref_workers))
 
         yield
 
@@ -373,15 +1055,40 @@ def main(script_args: ScriptArguments):
                 process.terminate()
                 process.join()  # ensure process termination after calling terminate()
 
+    server_id = uuid.uuid4().hex
     app = FastAPI(lifespan=lifespan)
 
+    @app.middleware("http")
+    async def record_request(request: Request, call_next):
+        start_time = time.perf_counter()
+        response = await call_next(request)
+        endpoint = request.url.path
+        metrics.inc("trl_vllm_requests_total", endpoint=endpoint, status=response.status_code)
+        if endpoint != "/generate_stream/":  # recorded at the end of the stream
+            metrics.observe("trl_vllm_request_duration_seconds", time.perf_counter() - start_time, endpoint=endpoint)
+        return response
+
     # Define the endpoints for the model server
     @app.get("/health/")
     async def health():
         """
-        Health check endpoint to verify that the server is running.
+        Health check endpoint to verify that the server is running. The `server_id` changes when the server is
+        restarted, which tells the clients that the weights they sent to it are lost.
+        """
+        return {"status": "ok", "server_id": server_id}
+
+    @app.get("/metrics/")
+    async def get_metrics():
+        """
+        Metrics of the load of the server, in the Prometheus text format: request latencies, queueing, processed
+        tokens (use `rate` to get the throughput), busy time of each worker, and weight updates.
         """
-        return {"status": "ok"}
+        metrics.set("trl_vllm_queued_requests", request_queue.num_queued)
+        metrics.set("trl_vllm_inflight_tokens", request_queue.inflight_tokens)
+        for model, model_workers in (("model", workers), ("ref_model", ref_workers)):
+            for rank, worker in enumerate(model_workers):
+                metrics.set("trl_vllm_worker_busy_seconds_total", worker.busy_time, model=model, rank=rank)
+        return Response(content=metrics.render(), media_type="text/plain; version=0.0.4")
 
     @app.get("/get_world_size/")
     async def get_world_size():
@@ -400,7 +1107,8 @@ def main(script_args: ScriptArguments):
         return {"world_size": script_args.tensor_parallel_size * script_args.data_parallel_size}
 
     class GenerateRequest(BaseModel):
-        prompts: list[str]
+        prompts: Optional[list[str]] = None
+        prompt_ids: Optional[list[list[int]]] = None
         n: int = 1
         repetition_penalty: float = 1.0
         temperature: float = 1.0
@@ -409,22 +1117,55 @@ def main(script_args: ScriptArguments):
         min_p: float = 0.0
         max_tokens: int = 16
         guided_decoding_regex: Optional[str] = None
+        return_logprobs: bool = False
+        priority: int = 0
+
+        @model_validator(mode="after")
+        def check_prompts(self):
+            # Rejected with a 422 error, rather than failing when the prompts are dispatched to the workers
+            if (self.prompts is None) == (self.prompt_ids is None):
+                raise ValueError("Exactly one of `prompts` and `prompt_ids` must be given.")
+            return self
 
     class GenerateResponse(BaseModel):
         completion_ids: list[list[int]]
+        logprobs: Optional[list[list[float]]] = None
+
+    def get_prompts(request: GenerateRequest) -> list:
+        # Prompts given as token IDs are passed to vLLM as tokens prompts, so that they are not tokenized again
+        if request.prompt_ids is not None:
+            return [{"prompt_token_ids": prompt_ids} for prompt_ids in request.prompt_ids]
+        return request.prompts
+
+    def placeholder_kwargs() -> dict:
+        # Sent to the DP workers that get no prompt, which must still take part in the generation. A single token is
+        # enough, since the output is ignored.
+        return {"prompts": ["<placeholder>"], "sampling_params": SamplingParams(max_tokens=1, detokenize=False)}
 
     @app.post("/generate/", response_model=GenerateResponse)
-    async def generate(request: GenerateRequest):
+    async def generate(request: GenerateRequest, response: Response, accept: Optional[str] = Header(None)):
         """
         Generates completions for the provided prompts.
 
         Args:
             request (`GenerateRequest`):
                 - `prompts` (list of `str`): A list of prompts (text strings) for the model to generate completions.
+                - `prompt_ids` (list of list of `int`): The prompts as token IDs, to be used instead of `prompts`.
+                - `return_logprobs` (`bool`): Whether to also return the log-probability of each sampled token.
+                - `priority` (`int`): Priority of the request when it has to wait for `max_inflight_tokens` to be
+                  available. Lower values are served first.
+            accept (`str` or `None`):
+                If `"application/octet-stream"`, the response is a binary buffer created with `pack_sequences`, holding
+                the completion IDs (and the log-probabilities if `return_logprobs` is `True`), instead of JSON.
 
         Returns:
             `GenerateResponse`:
                 - `completion_ids` (list of list of `int`): A list of lists of token IDs for each generated completion.
+                - `logprobs` (list of list of `float` or `None`): The log-probability of each sampled token, only set
+                  when `return_logprobs` is `True`.
+
+            The `Server-Timing` header holds the time spent waiting to be admitted (`queue`) and generating (`engine`),
+            in milliseconds.
 
         Example request:
         ```json
@@ -453,30 +1194,263 @@ def main(script_args: ScriptArguments):
             min_p=request.min_p,
             max_tokens=request.max_tokens,
             guided_decoding=guided_decoding,
+            # logprobs=0 makes vLLM return the log-probability of the sampled token only
+            logprobs=0 if request.return_logprobs else None,
         )
-        # Evenly distribute prompts across DP ranks
-        chunked_prompts = chunk_list(request.prompts, script_args.data_parallel_size)
-
-        # Send the prompts to each worker
-        for connection, prompts in zip(connections, chunked_prompts):
-            # When the number of prompts is less than data_parallel_size, some workers will receive empty prompts.
-            # However, vLLM requires that we always send at least one prompt. So we send a placeholder prompt to comply
-            # with vLLM's requirement, and we later ignore the result.
-            if not prompts:
-                prompts = ["<placeholder>"]
-            kwargs = {"prompts": prompts, "sampling_params": sampling_params}
-            connection.send({"type": "call", "method": "generate", "kwargs": kwargs})
-
-        # Receive results
-        all_outputs = [connection.recv() for connection in connections]
-
-        # Handle empty prompts (see above)
-        all_outputs = [output for output, prompts in zip(all_outputs, chunked_prompts) if prompts]
-
-        # Flatten and combine all results
-        all_outputs = list(chain.from_iterable(all_outputs))  # from list of list to single list
+        # Distribute the prompts across DP ranks so that they all have about the same number of tokens to process
+        prompts = get_prompts(request)
+        costs = cost_estimator.costs(prompts, n=request.n, max_tokens=request.max_tokens)
+        chunked_indices = balance_by_cost(costs, script_args.data_parallel_size)
+
+        # Send the prompts to each worker once the request is admitted, and wait for the results without blocking the
+        # event loop. The workers batch them with the prompts of the other requests in flight. When the number of
+        # prompts is less than data_parallel_size, some workers get no prompt. However, the DP ranks of vLLM step
+        # together, so every worker must take part in every generation: workers without prompts get a placeholder
+        # prompt, whose output is ignored. With a single worker, there is no other rank to wait for.
+        cost = sum(costs)
+        queue_time = await admit(cost, request.priority)
+        start_time = time.perf_counter()
+        try:
+            calls, sent_indices = [], []
+            for worker, indices in zip(workers, chunked_indices):
+                if indices:
+                    kwargs = {"prompts": [prompts[index] for index in indices], "sampling_params": sampling_params}
+                elif script_args.data_parallel_size > 1:
+                    kwargs = placeholder_kwargs()
+                else:
+                    continue
+                calls.append(worker.call("generate", kwargs))
+                sent_indices.append(indices)
+            all_outputs = await asyncio.gather(*calls)
+        finally:
+            request_queue.release(cost)
+        engine_time = time.perf_counter() - start_time
+
+        # Flatten all results, ignoring the placeholders, and put them back in the order of the prompts
+        all_outputs = [
+            (index, output)
+            for indices, outputs in zip(sent_indices, all_outputs)
+            for index, output in zip(indices, outputs)  # a placeholder has no index, so its output is dropped
+        ]
+        all_outputs = [output for _, output in sorted(all_outputs, key=lambda item: item[0])]
+        cost_estimator.update(prompts, all_outputs)
+        record_tokens(all_outputs)
+        server_timing = f"queue;dur={queue_time * 1000:.3f}, engine;dur={engine_time * 1000:.3f}"
+
         completion_ids = [list(output.token_ids) for outputs in all_outputs for output in outputs.outputs]
-        return {"completion_ids": completion_ids}
+        if request.return_logprobs:
+            logprobs = [
+                [logprob[token_id].logprob for token_id, logprob in zip(output.token_ids, output.logprobs)]
+                for outputs in all_outputs
+                for output in outputs.outputs
+            ]
+        else:
+            logprobs = None
+        if accept == "application/octet-stream":
+            return Response(
+                content=pack_sequences(completion_ids, logprobs),
+                media_type="application/octet-stream",
+                headers={"Server-Timing": server_timing},
+            )
+        response.headers["Server-Timing"] = server_timing
+        return {"completion_ids": completion_ids, "logprobs": logprobs}
+
+    @app.post("/generate_stream/")
+    async def generate_stream(request: GenerateRequest):
+        """
+        Generates completions for the provided prompts, and streams them as soon as all the completions of a prompt are
+        finished, instead of waiting for the whole batch.
+
+        The response is a stream of newline-delimited JSON objects, one per prompt, in order of completion.
+
+        Args:
+            request (`GenerateRequest`):
+                Same as for the `/generate/` endpoint.
+
+        Returns:
+            `StreamingResponse`:
+                One JSON object per line, with keys:
+                - `index` (`int`): Index of the prompt in `prompts`.
+                - `completion_ids` (list of list of `int`): The `n` completions generated for this prompt.
+                - `logprobs` (list of list of `float` or `None`): The log-probability of each sampled token, only set
+                  when `return_logprobs` is `True`.
+
+        Example response:
+        ```
+        {"index": 1, "completion_ids": [[201, 202, 203]], "logprobs": null}
+        {"index": 0, "completion_ids": [[101, 102, 103]], "logprobs": null}
+        ```
+        """
+        if request.guided_decoding_regex is not None:
+            guided_decoding = GuidedDecodingParams(backend="outlines", regex=request.guided_decoding_regex)
+        else:
+            guided_decoding = None
+
+        sampling_params = SamplingParams(
+            n=request.n,
+            repetition_penalty=request.repetition_penalty,
+            temperature=request.temperature,
+            top_p=request.top_p,
+            top_k=request.top_k,
+            min_p=request.min_p,
+            max_tokens=request.max_tokens,
+            guided_decoding=guided_decoding,
+            logprobs=0 if request.return_logprobs else None,
+        )
+        prompts = get_prompts(request)
+        costs = cost_estimator.costs(prompts, n=request.n, max_tokens=request.max_tokens)
+        chunked_indices = balance_by_cost(costs, script_args.data_parallel_size)
+
+        # Merge the outputs streamed by the workers in a single queue, as soon as they are finished. The outputs of
+        # a worker are tagged with the indices of its prompts, to map its local indices back to global ones, and
+        # `None` marks the end of its stream.
+        queue = asyncio.Queue()
+
+        async def forward(worker: WorkerConnection, indices: list[int]):
+            try:
+                if indices:
+                    kwargs = {"prompts": [prompts[index] for index in indices], "sampling_params": sampling_params}
+                else:  # the outputs of the placeholder prompt are ignored
+                    kwargs = placeholder_kwargs()
+                async for message in worker.stream(kwargs):
+                    if indices:
+                        await queue.put((indices, message))
+            finally:
+                await queue.put(None)
+
+        # Workers without prompts get a placeholder prompt when there are several DP ranks (see the `/generate/`
+        # endpoint). The request is released once all the workers are done, even if the client stops reading the
+        # stream.
+        cost = sum(costs)
+        queue_time = await admit(cost, request.priority)
+        start_time = time.perf_counter()
+        tasks = [
+            asyncio.create_task(forward(worker, indices))
+            for worker, indices in zip(workers, chunked_indices)
+            if indices or script_args.data_parallel_size > 1
+        ]
+        done = asyncio.gather(*tasks, return_exceptions=True)
+        done.add_done_callback(lambda _: request_queue.release(cost))
+
+        async def stream_outputs():
+            num_running = len(tasks)
+            while num_running:
+                item = await queue.get()
+                if item is None:  # all the requests of a worker are finished
+                    num_running -= 1
+                    continue
+                indices, message = item
+                index = indices[message["index"]]
+                cost_estimator.update([prompts[index]], [message["output"]])
+                record_tokens([message["output"]])
+                outputs = message["output"].outputs
+                if request.return_logprobs:
+                    logprobs = [
+                        [logprob[token_id].logprob for token_id, logprob in zip(output.token_ids, output.logprobs)]
+                        for output in outputs
+                    ]
+                else:
+                    logprobs = None
+                line = {
+                    "index": index,
+                    "completion_ids": [list(output.token_ids) for output in outputs],
+                    "logprobs": logprobs,
+                }
+                yield json.dumps(line) + "\n"
+            # Surface the error of a worker, if any, once the other streams are done
+            for result in await done:
+                if isinstance(result, Exception):
+                    raise result
+            duration = time.perf_counter() - start_time + queue_time
+            metrics.observe("trl_vllm_request_duration_seconds", duration, endpoint="/generate_stream/")
+
+        # The generation time is unknown when the headers are sent, so only the queueing time is reported
+        headers = {"Server-Timing": f"queue;dur={queue_time * 1000:.3f}"}
+        return StreamingResponse(stream_outputs(), media_type="application/x-ndjson", headers=headers)
+
+    class ScoreRequest(BaseModel):
+        sequences: list[list[int]]
+
+    class ScoreResponse(BaseModel):
+        logprobs: list[list[float]]
+
+    @app.post("/score_logprobs/", response_model=ScoreResponse)
+    async def score_logprobs(request: ScoreRequest, response: Response, accept: Optional[str] = Header(None)):
+        """
+        Computes the log-probabilities of the provided token sequences with the reference model. The server must be
+        started with `--ref_model`.
+
+        Log-probabilities are computed from the raw logits of the reference model, i.e. without temperature scaling.
+
+        Args:
+            request (`ScoreRequest`):
+                - `sequences` (list of list of `int`): The token IDs of the sequences to score.
+            accept (`str` or `None`):
+                If `"application/octet-stream"`, the response is a binary buffer created with `pack_sequences`, holding
+                the scored tokens (each sequence without its first token) and their log-probabilities, instead of JSON.
+
+        Returns:
+            `ScoreResponse`:
+                - `logprobs` (list of list of `float`): For each sequence, the log-probability of each token given the
+                  previous ones, starting from the second token.
+
+        Example request:
+        ```json
+        {"sequences": [[101, 102, 103], [201, 202]]}
+        ```
+
+        Example response:
+        ```json
+        {"logprobs": [[-2.31, -0.12], [-5.07]]}
+        ```
+        """
+        if not ref_workers:
+            raise HTTPException(
+                status_code=400, detail="No reference model is hosted. Start the server with `--ref_model`."
+            )
+
+        # prompt_logprobs=0 makes vLLM return the log-probability of each prompt token only. One token must still be
+        # generated, but it's discarded.
+        sampling_params = SamplingParams(max_tokens=1, prompt_logprobs=0, detokenize=False)
+        # Only the sequences are processed, so they are balanced by length. Workers without sequences get a placeholder
+        # prompt when there are several DP ranks (see the `/generate/` endpoint).
+        chunked_indices = balance_by_cost([len(sequence) for sequence in request.sequences], len(ref_workers))
+        start_time = time.perf_counter()
+        calls, sent_indices = [], []
+        for worker, indices in zip(ref_workers, chunked_indices):
+            if indices:
+                prompts = [{"prompt_token_ids": request.sequences[index]} for index in indices]
+                kwargs = {"prompts": prompts, "sampling_params": sampling_params, "use_tqdm": False}
+            elif script_args.data_parallel_size > 1:
+                kwargs = placeholder_kwargs()
+            else:
+                continue
+            calls.append(worker.call("generate", kwargs))
+            sent_indices.append(indices)
+        all_outputs = await asyncio.gather(*calls)
+        all_outputs = [
+            (index, output)
+            for indices, outputs in zip(sent_indices, all_outputs)
+            for index, output in zip(indices, outputs)
+        ]
+        all_outputs = [output for _, output in sorted(all_outputs, key=lambda item: item[0])]
+        record_tokens(all_outputs, model="ref_model")
+        server_timing = f"engine;dur={(time.perf_counter() - start_time) * 1000:.3f}"
+
+        # The first position has no log-probability (`None`), since there is no previous token to condition on
+        logprobs = [
+            [logprob[token_id].logprob for token_id, logprob in zip(sequence[1:], output.prompt_logprobs[1:])]
+            for sequence, output in zip(request.sequences, all_outputs)
+        ]
+        if accept == "application/octet-stream":
+            scored_ids = [sequence[1:] for sequence in request.sequences]
+            return Response(
+                content=pack_sequences(scored_ids, logprobs),
+                media_type="application/octet-stream",
+                headers={"Server-Timing": server_timing},
+            )
+        response.headers["Server-Timing"] = server_timing
+        return {"logprobs": logprobs}
 
     class InitCommunicatorRequest(BaseModel):
         host: str
@@ -501,8 +1475,8 @@ def main(script_args: ScriptArguments):
         # So with collective_rpc we need to call it this way:
         # llm.collective_rpc(method="init_communicator", args=(host, port, world_size))
         kwargs = {"method": "init_communicator", "args": (request.host, request.port, world_size)}
-        for connection in connections:
-            connection.send({"type": "fire_and_forget", "method": "collective_rpc", "kwargs": kwargs})
+        for worker in workers:
+            worker.fire_and_forget("collective_rpc", kwargs)
 
         return {"message": "Request received, initializing communicator"}
 
@@ -530,21 +1504,46 @@ def main(script_args: ScriptArguments):
         # llm.collective_rpc("update_named_param", args=("name", torch.float32, (10, 10)))
         dtype = torch.__getattribute__(request.dtype.split(".")[-1])
         kwargs = {"method": "update_named_param", "args": (request.name, dtype, tuple(request.shape))}
-        for connection in connections:
-            connection.send({"type": "fire_and_forget", "method": "collective_rpc", "kwargs": kwargs})
+        calls = [worker.call("collective_rpc", kwargs) for worker in workers]
+        record_weight_update(math.prod(request.shape) * dtype.itemsize, calls)
 
         return {"message": "Request received, updating named parameter"}
 
+    class UpdateWeightsBucketRequest(BaseModel):
+        names: list[str]
+        dtype: str
+        shapes: list[list[int]]
+
+    @app.post("/update_named_params/")
+    async def update_named_params(request: UpdateWeightsBucketRequest):
+        """
+        Updates several model weights at once, packed by the client in a single flat buffer.
+
+        Once this endpoint is called, the client process should broadcast the flat buffer to all server workers.
+
+        Args:
+            request (`UpdateWeightsBucketRequest`):
+                - `names` (list of `str`): Names of the weight tensors being updated, in the order they are packed.
+                - `dtype` (`str`): Data type shared by all the weight tensors (e.g., `"torch.bfloat16"`).
+                - `shapes` (list of list of `int`): Shapes of the weight tensors.
+        """
+        dtype = torch.__getattribute__(request.dtype.split(".")[-1])
+        shapes = [tuple(shape) for shape in request.shapes]
+        kwargs = {"method": "update_named_params", "args": (request.names, dtype, shapes)}
+        calls = [worker.call("collective_rpc", kwargs) for worker in workers]
+        record_weight_update(sum(math.prod(shape) for shape in shapes) * dtype.itemsize, calls)
+
+        return {"message": "Request received, updating named parameters"}
+
     @app.post("/reset_prefix_cache/")
     async def reset_prefix_cache():
         """
         Resets the prefix cache for the model.
         """
-        for connection in connections:
-            connection.send({"type": "call", "method": "reset_prefix_cache"})
         # Wait for and collect all results
-        all_outputs = [connection.recv() for connection in connections]
+        all_outputs = await asyncio.gather(*(worker.call("reset_prefix_cache") for worker in workers))
         success = all(output for output in all_outputs)
+        metrics.inc("trl_vllm_prefix_cache_resets_total")
         return {"message": "Request received, resetting prefix cache status: " + str(success)}
 
     @app.post("/close_communicator/")
@@ -553,8 +1552,8 @@ def main(script_args: ScriptArguments):
         Closes the weight update group and cleans up associated resources.
         """
         kwargs = {"method": "close_communicator"}
-        for connection in connections:
-            connection.send({"type": "fire_and_forget", "method": "collective_rpc", "kwargs": kwargs})
+        for worker in workers:
+            worker.fire_and_forget("collective_rpc", kwargs)
         return {"message": "Request received, closing communicator"}
 
     # Start the server
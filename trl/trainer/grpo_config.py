@@ -61,6 +61,11 @@ class GRPOConfig(TrainingArguments):
             with vLLM generation.
         shuffle_dataset (`bool`, *optional*, defaults to `True`):
             Whether to shuffle the training dataset.
+        padding_free (`bool`, *optional*, defaults to `False`):
+            Whether to compute the multi-turn conversation log probabilities without padding, by flattening all the
+            conversations of a batch into a single continuous sequence. This reduces memory usage and compute by
+            eliminating padding overhead. Currently, this is only supported with the `flash_attention_2` attention
+            implementation, which can efficiently handle the flattened batch structure.
 
         > Parameters that control generation
 
@@ -97,6 +102,14 @@ class GRPOConfig(TrainingArguments):
               separate server but may cause resource contention with training.
         vllm_guided_decoding_regex (`str` or `None`, *optional*, defaults to `None`):
             Regex for vLLM guided decoding. If `None` (default), guided decoding is disabled.
+        use_vllm_logprobs (`bool`, *optional*, defaults to `False`):
+            Whether to use the log probabilities that vLLM assigned to the sampled tokens as the behavior policy log
+            probabilities (`old_per_token_logps`) in the importance ratio. This saves the extra forward pass of the
+            policy needed when `num_iterations > 1`, and makes the ratio account for the numerical differences
+            between vLLM and the trainer. The mean and max absolute differences between both log probabilities are
+            logged as `vllm_logprob_diff/mean` and `vllm_logprob_diff/max`, to check that this is safe for the model.
+            Only supported for single-turn training. Always enabled with `async_generation=True`. Requires
+            `temperature=1.0`, since the V1 engine of vLLM returns log probabilities before temperature scaling.
 
         > Parameters that control the vLLM server (only used when `vllm_mode` is `"server"`)
 
@@ -107,6 +120,30 @@ class GRPOConfig(TrainingArguments):
         vllm_server_timeout (`float`, *optional*, defaults to `240.0`):
             Total timeout duration in seconds to wait for the vLLM server to be up. If the server is not up after the
             timeout, a `ConnectionError` is raised.
+        vllm_servers (`list[str]` or `None`, *optional*, defaults to `None`):
+            Addresses of several vLLM servers to spread the generation over, as `"host:port"`, instead of
+            `vllm_server_host` and `vllm_server_port`. The weights are sent to all the servers, and the servers that
+            fail are left out until they are back (see `MultiServerVLLMClient`).
+        async_generation (`bool`, *optional*, defaults to `False`):
+            Whether to generate the completions of the next batch in a background thread while the current batch is
+            being trained on. The trainer then learns from completions sampled by the policy of the previous step
+            (off-policy by one step), and the log-probabilities returned by vLLM for the sampled tokens are used as
+            `old_per_token_logps` in the importance ratio. To fill the pipeline, the first batch of prompts is sampled
+            twice. Only supported for single-turn training with `vllm_mode="server"`, and requires `temperature=1.0`.
+        vllm_weight_sync_bucket_size_mb (`float`, *optional*, defaults to `256.0`):
+            Maximum size in megabytes of the flat buffers the weights are packed in when they are sent to the vLLM
+            server, with one request and one NCCL broadcast per buffer. Set to `0` to send each parameter individually.
+        vllm_sync_adapted_modules_only (`bool`, *optional*, defaults to `False`):
+            When training a PEFT model, whether to only send to vLLM the merged weights of the modules with adapters
+            (and the modules to save, or any other trainable parameter), instead of all the base model weights. The
+            other weights are frozen, so they are still identical to the ones vLLM loaded at startup, provided that vLLM
+            serves the same base model as the one being trained.
+        use_vllm_ref_model (`bool`, *optional*, defaults to `False`):
+            Whether to compute the reference log-probabilities with the reference model hosted by the vLLM server
+            (started with `trl vllm-serve --ref_model ...`), instead of keeping a reference model on every training
+            device (or disabling the adapters of a PEFT model). Only supported for single-turn training. Requires
+            `temperature=1.0` when `beta` is not `0.0`, since vLLM computes the log-probabilities without temperature
+            scaling.
 
         > Parameters that control colocated vLLM execution (only used when `vllm_mode` is `"colocate"`)
 
@@ -137,6 +174,20 @@ class GRPOConfig(TrainingArguments):
         reward_weights (`list[float]` or `None`, *optional*, defaults to `None`):
             Weights for each reward function. Must match the number of reward functions. If `None`, all rewards are
             weighted equally with weight `1.0`.
+        reward_func_timeout (`float` or `None`, *optional*, defaults to `None`):
+            Timeout in seconds for the reward functions that are called once per sample, concurrently: `async def`
+            reward functions, and reward functions with a `concurrency` attribute set to `"thread"` or `"process"`. A
+            call that doesn't return within this timeout after being submitted yields NaN, like a `None` reward. If
+            `None`, there is no timeout.
+        reward_models_on_main_process (`bool`, *optional*, defaults to `False`):
+            Whether to host the reward models (reward functions given as model IDs or models) on the main process only.
+            The texts to score are gathered from all processes, scored by the main process, and the rewards are sent
+            back, so the reward models don't use any GPU memory on the other processes. Not supported with DeepSpeed
+            ZeRO-3 or FSDP.
+        reward_model_batch_size (`int` or `None`, *optional*, defaults to `None`):
+            Number of texts scored at once by each reward model when `reward_models_on_main_process=True`. The texts
+            are sorted by length before being split into micro-batches. If `None`, the number of texts per process is
+            used.
         scale_rewards (`bool`, *optional*, defaults to `True`):
             Whether to scale the rewards by dividing them by their standard deviation. If `True` (default), the rewards
             are normalized by the standard deviation, ensuring they have unit variance. If `False`, no scaling is
@@ -159,6 +210,18 @@ class GRPOConfig(TrainingArguments):
             When enabled, truncated completions are excluded from the loss calculation, preventing them from being
             incorrectly penalized and introducing noise during training. According to the
             [DAPO](https://huggingface.co/papers/2503.14476) paper, this is a good practice for training stability.
+        filter_zero_std_groups (`bool`, *optional*, defaults to `False`):
+            Whether to drop the groups whose completions all got the same reward before computing the log
+            probabilities and the loss. The advantages of these groups are zero, so they don't contribute to the policy
+            gradient, only to the KL term when `beta > 0`. This is the dynamic sampling of the
+            [DAPO](https://huggingface.co/papers/2503.14476) paper. The remaining groups are redistributed evenly
+            across processes and gradient accumulation steps, so the number of completions trained on per step can
+            shrink. The fraction of groups with zero reward std is logged as `frac_reward_zero_std`.
+        oversampling_factor (`int`, *optional*, defaults to `1`):
+            Number of times more prompts than needed for one optimization step are sampled and generated for, when
+            `filter_zero_std_groups=True`. The groups with a non-zero reward std are then used to fill the batch, in
+            order, and the extra ones are discarded. Higher values keep the batch full even when many groups are
+            saturated, at the cost of more generation.
         sync_ref_model (`bool`, *optional*, defaults to `False`):
             Whether to synchronize the reference model with the active model every `ref_model_sync_steps` steps, using
             the `ref_model_mixup_alpha` parameter. This synchronization originates from the
@@ -174,6 +237,25 @@ class GRPOConfig(TrainingArguments):
             set `sync_ref_model=True`.
         use_liger_loss (`bool`, *optional*, defaults to `False`):
             Whether to use the Liger GRPO loss.
+        logprob_chunk_size (`int` or `None`, *optional*, defaults to `None`):
+            If set, the per-token log probabilities are computed from the last hidden state and the weight of the LM
+            head, this many tokens at a time, without ever materializing the full logits tensor (the logits are
+            recomputed in the backward pass). This is a pure PyTorch alternative to the Liger GRPO loss that reduces
+            the peak memory for large vocabularies and long completions. Only used when the LM head is a plain linear
+            layer. If `None`, the full logits are computed.
+        logprob_max_batch_tokens (`int` or `None`, *optional*, defaults to `None`):
+            If set, the sequences of the log-probability passes (old policy, reference model and loss) are sorted by
+            length and grouped into micro-batches of at most this many tokens, padding included. Each micro-batch is
+            trimmed to its own longest sequence, so that short sequences aren't padded to the longest one of the whole
+            batch. This replaces the fixed number of rows per forward pass of the old policy and reference model
+            passes. If `None`, the sequences are processed in their original order, `per_device_train_batch_size` at
+            a time. Not supported with DeepSpeed ZeRO-3 or FSDP.
+        reuse_prompt_kv_cache (`bool`, *optional*, defaults to `False`):
+            Whether to encode each distinct prompt once in the log-probability passes, and reuse its KV cache for all
+            its completions, instead of recomputing the prompt tokens for each of the `num_generations` completions
+            of a group. The gradients of the completions flow back to the shared prompt through the cache. This saves
+            most of the compute when the prompts are much longer than the completions. Only supported for single-turn
+            training, without gradient checkpointing.
 
         > Parameters that control the logging
 
@@ -250,6 +332,15 @@ class GRPOConfig(TrainingArguments):
         default=True,
         metadata={"help": "Whether to shuffle the training dataset."},
     )
+    padding_free: bool = field(
+        default=False,
+        metadata={
+            "help": "Whether to compute the multi-turn conversation log probabilities without padding, by flattening "
+            "all the conversations of a batch into a single continuous sequence. This reduces memory usage and "
+            "compute by eliminating padding overhead. Currently, this is only supported with the `flash_attention_2` "
+            "attention implementation, which can efficiently handle the flattened batch structure."
+        },
+    )
 
     # Parameters that control generation
     temperature: float = field(
@@ -312,6 +403,19 @@ class GRPOConfig(TrainingArguments):
         default=None,
         metadata={"help": "Regex for vLLM guided decoding. If `None` (default), guided decoding is disabled."},
     )
+    use_vllm_logprobs: bool = field(
+        default=False,
+        metadata={
+            "help": "Whether to use the log probabilities that vLLM assigned to the sampled tokens as the behavior "
+            "policy log probabilities (`old_per_token_logps`) in the importance ratio. This saves the extra forward "
+            "pass of the policy needed when `num_iterations > 1`, and makes the ratio account for the numerical "
+            "differences between vLLM and the trainer. The mean and max absolute differences between both log "
+            "probabilities are logged as `vllm_logprob_diff/mean` and `vllm_logprob_diff/max`, to check that this is "
+            "safe for the model. Only supported for single-turn training. Always enabled with "
+            "`async_generation=True`. Requires `temperature=1.0`, since the V1 engine of vLLM returns log "
+            "probabilities before temperature scaling."
+        },
+    )
 
     # Parameters that control the vLLM server (only used when `vllm_mode` is `"server"`)
     vllm_server_host: str = field(
@@ -329,6 +433,52 @@ class GRPOConfig(TrainingArguments):
             "after the timeout, a `ConnectionError` is raised."
         },
     )
+    vllm_servers: Optional[list[str]] = field(
+        default=None,
+        metadata={
+            "help": "Addresses of several vLLM servers to spread the generation over, as `'host:port'`, instead of "
+            "`vllm_server_host` and `vllm_server_port`. The weights are sent to all the servers, and the servers that "
+            "fail are left out until they are back."
+        },
+    )
+    async_generation: bool = field(
+        default=False,
+        metadata={
+            "help": "Whether to generate the completions of the next batch in a background thread while the current "
+            "batch is being trained on. The trainer then learns from completions sampled by the policy of the "
+            "previous step (off-policy by one step), and the log-probabilities returned by vLLM for the sampled "
+            "tokens are used as `old_per_token_logps` in the importance ratio. To fill the pipeline, the first batch "
+            "of prompts is sampled twice. Only supported for single-turn training with `vllm_mode='server'`, and "
+            "requires `temperature=1.0`."
+        },
+    )
+    vllm_weight_sync_bucket_size_mb: float = field(
+        default=256.0,
+        metadata={
+            "help": "Maximum size in megabytes of the flat buffers the weights are packed in when they are sent to "
+            "the vLLM server, with one request and one NCCL broadcast per buffer. Set to `0` to send each parameter "
+            "individually."
+        },
+    )
+    vllm_sync_adapted_modules_only: bool = field(
+        default=False,
+        metadata={
+            "help": "When training a PEFT model, whether to only send to vLLM the merged weights of the modules with "
+            "adapters (and the modules to save, or any other trainable parameter), instead of all the base model "
+            "weights. The other weights are frozen, so they are still identical to the ones vLLM loaded at startup, "
+            "provided that vLLM serves the same base model as the one being trained."
+        },
+    )
+    use_vllm_ref_model: bool = field(
+        default=False,
+        metadata={
+            "help": "Whether to compute the reference log-probabilities with the reference model hosted by the vLLM "
+            "server (started with `trl vllm-serve --ref_model ...`), instead of keeping a reference model on every "
+            "training device (or disabling the adapters of a PEFT model). Only supported for single-turn training. "
+            "Requires `temperature=1.0` when `beta` is not `0.0`, since vLLM computes the log-probabilities without "
+            "temperature scaling."
+        },
+    )
 
     # Parameters that control colocated vLLM execution (only used when `vllm_mode` is `"colocate"`)
     vllm_gpu_memory_utilization: float = field(
@@ -392,6 +542,32 @@ class GRPOConfig(TrainingArguments):
             "rewards are weighted equally with weight `1.0`."
         },
     )
+    reward_func_timeout: Optional[float] = field(
+        default=None,
+        metadata={
+            "help": "Timeout in seconds for the reward functions that are called once per sample, concurrently: "
+            "`async def` reward functions, and reward functions with a `concurrency` attribute set to `'thread'` or "
+            "`'process'`. A call that doesn't return within this timeout after being submitted yields NaN, like a "
+            "`None` reward. If `None`, there is no timeout."
+        },
+    )
+    reward_models_on_main_process: bool = field(
+        default=False,
+        metadata={
+            "help": "Whether to host the reward models (reward functions given as model IDs or models) on the main "
+            "process only. The texts to score are gathered from all processes, scored by the main process, and the "
+            "rewards are sent back, so the reward models don't use any GPU memory on the other processes. Not "
+            "supported with DeepSpeed ZeRO-3 or FSDP."
+        },
+    )
+    reward_model_batch_size: Optional[int] = field(
+        default=None,
+        metadata={
+            "help": "Number of texts scored at once by each reward model when `reward_models_on_main_process=True`. "
+            "The texts are sorted by length before being split into micro-batches. If `None`, the number of texts per "
+            "process is used."
+        },
+    )
     scale_rewards: bool = field(
         default=True,
         metadata={
@@ -425,6 +601,26 @@ class GRPOConfig(TrainingArguments):
             "a good practice for training stability."
         },
     )
+    filter_zero_std_groups: bool = field(
+        default=False,
+        metadata={
+            "help": "Whether to drop the groups whose completions all got the same reward before computing the log "
+            "probabilities and the loss. The advantages of these groups are zero, so they don't contribute to the "
+            "policy gradient, only to the KL term when `beta > 0`. This is the dynamic sampling of the DAPO paper. "
+            "The remaining groups are redistributed evenly across processes and gradient accumulation steps, so the "
+            "number of completions trained on per step can shrink. The fraction of groups with zero reward std is "
+            "logged as `frac_reward_zero_std`."
+        },
+    )
+    oversampling_factor: int = field(
+        default=1,
+        metadata={
+            "help": "Number of times more prompts than needed for one optimization step are sampled and generated "
+            "for, when `filter_zero_std_groups=True`. The groups with a non-zero reward std are then used to fill the "
+            "batch, in order, and the extra ones are discarded. Higher values keep the batch full even when many "
+            "groups are saturated, at the cost of more generation."
+        },
+    )
     sync_ref_model: bool = field(
         default=False,
         metadata={
@@ -451,6 +647,37 @@ class GRPOConfig(TrainingArguments):
         default=False,
         metadata={"help": "Whether to use the Liger GRPO loss."},
     )
+    logprob_chunk_size: Optional[int] = field(
+        default=None,
+        metadata={
+            "help": "If set, the per-token log probabilities are computed from the last hidden state and the weight "
+            "of the LM head, this many tokens at a time, without ever materializing the full logits tensor (the "
+            "logits are recomputed in the backward pass). This is a pure PyTorch alternative to the Liger GRPO loss "
+            "that reduces the peak memory for large vocabularies and long completions. Only used when the LM head is "
+            "a plain linear layer. If `None`, the full logits are computed."
+        },
+    )
+    logprob_max_batch_tokens: Optional[int] = field(
+        default=None,
+        metadata={
+            "help": "If set, the sequences of the log-probability passes (old policy, reference model and loss) are "
+            "sorted by length and grouped into micro-batches of at most this many tokens, padding included. Each "
+            "micro-batch is trimmed to its own longest sequence, so that short sequences aren't padded to the longest "
+            "one of the whole batch. This replaces the fixed number of rows per forward pass of the old policy and "
+            "reference model passes. If `None`, the sequences are processed in their original order, "
+            "`per_device_train_batch_size` at a time. Not supported with DeepSpeed ZeRO-3 or FSDP."
+        },
+    )
+    reuse_prompt_kv_cache: bool = field(
+        default=False,
+        metadata={
+            "help": "Whether to encode each distinct prompt once in the log-probability passes, and reuse its KV "
+            "cache for all its completions, instead of recomputing the prompt tokens for each of the "
+            "`num_generations` completions of a group. The gradients of the completions flow back to the shared "
+            "prompt through the cache. This saves most of the compute when the prompts are much longer than the "
+            "completions. Only supported for single-turn training, without gradient checkpointing."
+        },
+    )
 
     # Parameters that control the logging
     log_completions: bool = field(
@@ -478,3 +705,21 @@ class GRPOConfig(TrainingArguments):
             "all prompts are logged."
         },
     )
+
+    def __post_init__(self):
+        super().__post_init__()
+
+        # The V1 engine of vLLM returns the log-probabilities of the sampled tokens before temperature scaling, while
+        # the trainer divides the logits by the temperature: both only match when the temperature is 1
+        if (self.use_vllm_logprobs or self.async_generation) and self.temperature != 1.0:
+            option = "use_vllm_logprobs" if self.use_vllm_logprobs else "async_generation"
+            raise ValueError(
+                f"`{option}=True` requires `temperature=1.0`, since vLLM returns the log-probabilities of the sampled "
+                f"tokens before temperature scaling, but got `temperature={self.temperature}`."
+            )
+        # Same for the reference log-probabilities computed by the vLLM server, used in the KL term
+        if self.use_vllm_ref_model and self.beta != 0.0 and self.temperature != 1.0:
+            raise ValueError(
+                "`use_vllm_ref_model=True` requires `temperature=1.0`, since vLLM computes the reference "
+                f"log-probabilities without temperature scaling, but got `temperature={self.temperature}`."
+            )
@@ -12,25 +12,33 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import asyncio
+import multiprocessing
 import os
 import textwrap
+import threading
+import time
 import warnings
 from collections import defaultdict, deque
 from collections.abc import Sized
+from concurrent import futures
 from contextlib import nullcontext
+from itertools import chain
 from typing import Any, Callable, Optional, Union
 
 import datasets
 import torch
 import torch.utils.data
 import transformers
-from accelerate.utils import broadcast_object_list, gather, gather_object, is_peft_model, set_seed
+from accelerate import PartialState, init_empty_weights
+from accelerate.utils import broadcast, broadcast_object_list, gather, gather_object, is_peft_model, set_seed
 from datasets import Dataset, IterableDataset
 from packaging import version
 from torch import nn
 from torch.distributed.fsdp import FullyShardedDataParallel as FSDP
 from torch.utils.data import DataLoader, Sampler
 from transformers import (
+    AutoConfig,
     AutoModelForCausalLM,
     AutoModelForSequenceClassification,
     AutoTokenizer,
@@ -48,7 +56,7 @@ from transformers.utils import is_datasets_available, is_peft_available, is_rich
 from ..data_utils import apply_chat_template, is_conversational, maybe_apply_chat_template
 from ..extras.conversation_generator import ConversationGenerator
 from ..extras.profiling import profiling_context, profiling_decorator
-from ..extras.vllm_client import VLLMClient
+from ..extras.vllm_client import MultiServerVLLMClient, VLLMClient
 from ..import_utils import is_liger_kernel_available, is_vllm_available
 from ..models import create_reference_model, prepare_deepspeed, prepare_fsdp, unwrap_model_for_generation
 from ..models.utils import _ForwardRedirection
@@ -56,11 +64,14 @@ from .callbacks import SyncRefModelCallback
 from .grpo_config import GRPOConfig
 from .utils import (
     disable_dropout_in_model,
+    fused_selective_log_softmax,
     generate_model_card,
     get_comet_experiment_url,
+    group_consecutive,
     pad,
     print_prompt_completions_sample,
     selective_log_softmax,
+    split_by_token_budget,
 )
 
 
@@ -82,6 +93,25 @@ if is_wandb_available():
 RewardFunc = Union[str, PreTrainedModel, Callable[[list, list], list[float]]]
 
 
+def _get_reward_func_concurrency(reward_func: RewardFunc) -> Optional[str]:
+    """
+    Returns how a custom reward function can be called concurrently, one sample at a time: `"async"` for coroutine
+    functions, `"thread"` or `"process"` when the function has a `concurrency` attribute with this value, and `None`
+    when it must be called on the whole batch.
+    """
+    if isinstance(reward_func, nn.Module):
+        return None
+    if asyncio.iscoroutinefunction(reward_func):
+        return "async"
+    concurrency = getattr(reward_func, "concurrency", None)
+    if concurrency not in (None, "thread", "process"):
+        raise ValueError(
+            f"Invalid `concurrency` attribute for reward function {reward_func.__name__}: {concurrency}. Supported "
+            "values are 'thread' and 'process'."
+        )
+    return concurrency
+
+
 class RepeatSampler(Sampler):
     """
     Sampler that repeats the indices of a dataset in a structured manner.
@@ -419,14 +449,24 @@ class GRPOTrainer(Trainer):
         # Reward functions
         if not isinstance(reward_funcs, list):
             reward_funcs = [reward_funcs]
+        if args.reward_models_on_main_process and is_deepspeed_zero3_enabled():
+            raise ValueError("`reward_models_on_main_process=True` is not supported with DeepSpeed ZeRO-3.")
         self.reward_func_names = []
         for i, reward_func in enumerate(reward_funcs):
             # If the reward function is a string, load it as a pretrained model
             # If the reward function is a python function, use it as is
             if isinstance(reward_func, str):
-                reward_funcs[i] = AutoModelForSequenceClassification.from_pretrained(
-                    reward_func, num_labels=1, **model_init_kwargs
-                )
+                if args.reward_models_on_main_process and not PartialState().is_main_process:
+                    # Only the main process holds the weights of the reward models, the other processes only need the
+                    # config (for the name and the processing class), so the model is created on the meta device
+                    with init_empty_weights():
+                        reward_funcs[i] = AutoModelForSequenceClassification.from_config(
+                            AutoConfig.from_pretrained(reward_func, num_labels=1)
+                        )
+                else:
+                    reward_funcs[i] = AutoModelForSequenceClassification.from_pretrained(
+                        reward_func, num_labels=1, **model_init_kwargs
+                    )
             if isinstance(reward_funcs[i], nn.Module):  # Use Module over PretrainedModel for compat w/ compiled models
                 self.reward_func_names.append(reward_funcs[i].config._name_or_path.split("/")[-1])
             else:
@@ -465,6 +505,11 @@ class GRPOTrainer(Trainer):
                 reward_processing_classes[i] = reward_processing_class
         self.reward_processing_classes = reward_processing_classes
 
+        # Executors for the reward functions that are called concurrently, one sample at a time (see
+        # `_calculate_rewards`). They are created on first use, and shut down at the end of training.
+        self.reward_func_concurrencies = [_get_reward_func_concurrency(reward_func) for reward_func in reward_funcs]
+        self._reward_executors = {}
+
         # Data collator
         def data_collator(features):  # No data collation is needed in GRPO
             return features
@@ -487,6 +532,28 @@ class GRPOTrainer(Trainer):
         self.loss_type = args.loss_type
         self.scale_rewards = args.scale_rewards
         self.mask_truncated_completions = args.mask_truncated_completions
+        self.filter_zero_std_groups = args.filter_zero_std_groups
+        self.oversampling_factor = args.oversampling_factor
+        self.logprob_chunk_size = args.logprob_chunk_size
+        self.logprob_max_batch_tokens = args.logprob_max_batch_tokens
+        self.reuse_prompt_kv_cache = args.reuse_prompt_kv_cache
+        self.async_generation = args.async_generation
+        # With asynchronous generation, the completions are sampled by an older policy, so vLLM's log probabilities
+        # are always needed
+        self.use_vllm_logprobs = args.use_vllm_logprobs or args.async_generation
+        self.padding_free = args.padding_free
+        if self.padding_free:
+            if not self.is_conversation:
+                raise ValueError("Padding-free forward passes are only supported for multi-turn conversations.")
+            if model.config._attn_implementation != "flash_attention_2":
+                warnings.warn(
+                    "Padding-free training is enabled, but the attention implementation is not set to "
+                    "'flash_attention_2'. Padding-free training flattens batches into a single sequence, and "
+                    "'flash_attention_2' is the only known attention mechanism that reliably supports this. Using "
+                    "other implementations may lead to unexpected behavior. To ensure compatibility, set "
+                    "`attn_implementation='flash_attention_2'` in the model configuration, or verify that your "
+                    "attention mechanism can handle flattened sequences."
+                )
 
         # Datasets
         self.shuffle_dataset = args.shuffle_dataset
@@ -534,9 +601,13 @@ class GRPOTrainer(Trainer):
 
         # Reference model
         self.beta = args.beta
+        self.use_vllm_ref_model = args.use_vllm_ref_model and self.beta != 0.0
         if self.beta == 0.0:
             # If beta is 0.0, the reference model is not needed
             self.ref_model = None
+        elif self.use_vllm_ref_model:
+            # The reference log probabilities are computed by the reference model hosted by the vLLM server
+            self.ref_model = None
         elif is_deepspeed_zero3_enabled() or self.is_fsdp_enabled:
             self.ref_model = AutoModelForCausalLM.from_pretrained(model_id, **model_init_kwargs)
         elif is_peft_model(model):
@@ -553,14 +624,16 @@ class GRPOTrainer(Trainer):
             if self.ref_model is not None:
                 disable_dropout_in_model(self.ref_model)
 
+        # Redirect the model.module forward to the model forward to ensure pre-forward hooks are called when only parts
+        # of the model are run (liger loss, and selected logits of multi-turn conversations)
+        self._forward_redirection = _ForwardRedirection()
+
         # Liger loss
         if self.use_liger_loss:
             if not is_liger_kernel_available():
                 raise ImportError(
                     "Liger is required to use `liger_loss` as the GRPO loss. Run `pip install liger-kernel`."
                 )
-            # redirect the model.module forward to the model forward to ensure pre-forward hooks are called
-            self._forward_redirection = _ForwardRedirection()
 
             self.liger_grpo_loss = LigerFusedLinearGRPOLoss(
                 beta=self.beta,
@@ -625,6 +698,46 @@ class GRPOTrainer(Trainer):
         # it's safer to set it in all cases.
         set_seed(args.seed, device_specific=True)
 
+        if self.async_generation and (not self.use_vllm or self.vllm_mode != "server" or self.is_conversation):
+            raise ValueError(
+                "`async_generation=True` is only supported for single-turn training with `use_vllm=True` and "
+                "`vllm_mode='server'`."
+            )
+        if args.use_vllm_logprobs and (not self.use_vllm or self.is_conversation):
+            raise ValueError(
+                "`use_vllm_logprobs=True` is only supported for single-turn training with `use_vllm=True`."
+            )
+        if args.use_vllm_ref_model and (not self.use_vllm or self.vllm_mode != "server" or self.is_conversation):
+            raise ValueError(
+                "`use_vllm_ref_model=True` is only supported for single-turn training with `use_vllm=True` and "
+                "`vllm_mode='server'`."
+            )
+        if self.use_vllm_ref_model and args.sync_ref_model:
+            raise ValueError(
+                "`sync_ref_model=True` is not supported with `use_vllm_ref_model=True`, since the reference model "
+                "hosted by the vLLM server is frozen."
+            )
+        if self.filter_zero_std_groups and self.is_conversation:
+            raise ValueError("`filter_zero_std_groups=True` is only supported for single-turn training.")
+        if self.oversampling_factor < 1 or (self.oversampling_factor > 1 and not self.filter_zero_std_groups):
+            raise ValueError(
+                f"`oversampling_factor` ({self.oversampling_factor}) must be 1, or greater than 1 with "
+                "`filter_zero_std_groups=True`."
+            )
+        if self.logprob_max_batch_tokens is not None and (is_deepspeed_zero3_enabled() or self.is_fsdp_enabled):
+            raise ValueError(
+                "`logprob_max_batch_tokens` is not supported with DeepSpeed ZeRO-3 or FSDP: the number of "
+                "micro-batches depends on the sequence lengths of each process, and every forward pass gathers the "
+                "sharded parameters, so the processes would wait for each other forever."
+            )
+        if self.reuse_prompt_kv_cache and self.is_conversation:
+            raise ValueError("`reuse_prompt_kv_cache=True` is only supported for single-turn training.")
+        if self.reuse_prompt_kv_cache and args.gradient_checkpointing:
+            raise ValueError(
+                "`reuse_prompt_kv_cache=True` is not supported with gradient checkpointing, which disables the KV "
+                "cache during training."
+            )
+
         if self.use_vllm:
             if not is_vllm_available():
                 raise ImportError(
@@ -633,10 +746,18 @@ class GRPOTrainer(Trainer):
                 )
 
             if self.vllm_mode == "server" and self.accelerator.is_main_process:
-                self.vllm_client = VLLMClient(
-                    args.vllm_server_host, args.vllm_server_port, connection_timeout=args.vllm_server_timeout
-                )
+                if args.vllm_servers:
+                    self.vllm_client = MultiServerVLLMClient(
+                        args.vllm_servers, connection_timeout=args.vllm_server_timeout
+                    )
+                else:
+                    self.vllm_client = VLLMClient(
+                        args.vllm_server_host, args.vllm_server_port, connection_timeout=args.vllm_server_timeout
+                    )
                 self.vllm_client.init_communicator()
+                if self.async_generation:
+                    # A single worker, so that at most one generation request is in flight at any time
+                    self._rollout_executor = futures.ThreadPoolExecutor(max_workers=1)
 
             elif self.vllm_mode == "colocate":
                 # Make sure vllm_tensor_parallel_size group size evenly divides the world size - each group should have
@@ -674,6 +795,12 @@ class GRPOTrainer(Trainer):
             self.guided_decoding_regex = args.vllm_guided_decoding_regex
 
             self._last_loaded_step = -1  # tag to avoid useless loading during grad accumulation
+            self._policy_version = 0  # number of weight updates pushed to vLLM, used to tag the generated completions
+
+            # Queues used by `_async_generate`: the local prompt data of the batches waiting to be trained on, and
+            # (main process only) the generation requests in flight with the policy version they were submitted with
+            self._pending_rollouts = deque()
+            self._rollout_futures = deque()
 
             # When using vLLM, the main process is responsible for loading the model weights. This can cause process
             # desynchronization and seems to lead to DeepSpeed hanging during initialization. To prevent this, we
@@ -706,6 +833,7 @@ class GRPOTrainer(Trainer):
                 self.conversation_generator.init_communicator()
 
             self._last_loaded_step = -1  # tag to avoid useless loading during grad accumulation
+            self._policy_version = 0  # number of weight updates pushed to the conversation generator
 
             # When using conversation generator, the main process is responsible for loading the model weights. This can cause process
             # desynchronization and seems to lead to DeepSpeed hanging during initialization. To prevent this, we
@@ -731,9 +859,16 @@ class GRPOTrainer(Trainer):
         if args.sync_ref_model:
             self.add_callback(SyncRefModelCallback(ref_model=self.ref_model, accelerator=self.accelerator))
 
+        if args.reward_models_on_main_process and self.is_fsdp_enabled:
+            raise ValueError("`reward_models_on_main_process=True` is not supported with FSDP.")
+
         for i, reward_func in enumerate(self.reward_funcs):
             if isinstance(reward_func, PreTrainedModel):
-                if self.is_deepspeed_enabled:
+                if args.reward_models_on_main_process:
+                    # Reward models are not wrapped, and only used by the main process (see `_score_on_main_process`)
+                    if self.accelerator.is_main_process:
+                        self.reward_funcs[i] = reward_func.to(self.accelerator.device).eval()
+                elif self.is_deepspeed_enabled:
                     self.reward_funcs[i] = prepare_deepspeed(reward_func, self.accelerator)
                 else:
                     # set device placement to True to make `prepare_model` move `reward_func` to device when using fsdp
@@ -753,7 +888,8 @@ class GRPOTrainer(Trainer):
     # Instead of returning a standard per-step batch, our dataloader loads an *accumulated* batch
     # (i.e., `per_device_batch_size × gradient_accumulation_steps`). This allows us to generate completions
     # once per optimization step—rather than once per gradient accumulation step—which is significantly more efficient.
-    # The only change from the original implementation is multiplying the batch size by `gradient_accumulation_steps`.
+    # The only change from the original implementation is multiplying the batch size by `gradient_accumulation_steps`
+    # (and by `oversampling_factor`, see `_filter_zero_std_groups`).
     # Thus, `_prepare_inputs` is called with the accumulated batch size, and it handles the splitting internally.
     # Maintenance note: This method is a copy-paste of the original `Trainer.get_train_dataloader` with only one line
     # modification. As a result, some parts of the method aren't relevant to GRPO, but we keep them to stay one line
@@ -770,7 +906,8 @@ class GRPOTrainer(Trainer):
             data_collator = self._get_collator_with_removed_columns(data_collator, description="training")
 
         dataloader_params = {
-            "batch_size": self._train_batch_size * self.args.gradient_accumulation_steps,  # < this is the change
+            # < this is the change
+            "batch_size": self._train_batch_size * self.args.gradient_accumulation_steps * self.oversampling_factor,
             "collate_fn": data_collator,
             "num_workers": self.args.dataloader_num_workers,
             "pin_memory": self.args.dataloader_pin_memory,
@@ -819,7 +956,7 @@ class GRPOTrainer(Trainer):
         return RepeatSampler(
             data_source=self.train_dataset,
             mini_repeat_count=self.num_generations,
-            batch_size=effective_batch_size // self.num_generations,
+            batch_size=effective_batch_size * self.oversampling_factor // self.num_generations,
             repeat_count=self.num_iterations * self.args.gradient_accumulation_steps,
             shuffle=self.shuffle_dataset,
             seed=self.args.seed,
@@ -865,9 +1002,83 @@ class GRPOTrainer(Trainer):
             last_hidden_state = last_hidden_state[:, -logits_to_keep:, :]  # (B, logits_to_keep, H)
         return last_hidden_state
 
+    def _get_completion_logps(self, unwrapped_model, input_ids, attention_mask, logits_to_keep):
+        # The LM head must be applied inside the (redirected) forward, for DDP to track the use of its weight
+        last_hidden_state = self._get_last_hidden_state(unwrapped_model, input_ids, attention_mask, logits_to_keep)
+        return self._lm_head_log_softmax(unwrapped_model.lm_head, last_hidden_state, input_ids[:, -logits_to_keep:])
+
+    @profiling_decorator
+    def _get_shared_prompt_logps(self, unwrapped_model, input_ids, attention_mask, logits_to_keep):
+        # The completions of a group share the same prompt. Each distinct prompt is encoded once, and its KV cache is
+        # expanded to all its completions, so the gradients of the completions flow back to the shared prompt.
+        if is_peft_model(unwrapped_model):
+            unwrapped_model = unwrapped_model.base_model.model
+        prompt_length = input_ids.size(1) - logits_to_keep
+        prompts = torch.cat([input_ids[:, :prompt_length], attention_mask[:, :prompt_length].to(input_ids.dtype)], 1)
+        unique_prompts, inverse = torch.unique(prompts, dim=0, return_inverse=True)
+        prompt_output = unwrapped_model.model(
+            input_ids=unique_prompts[:, :prompt_length],
+            attention_mask=unique_prompts[:, prompt_length:],
+            use_cache=True,
+        )
+        past_key_values = prompt_output.past_key_values
+        past_key_values.reorder_cache(inverse)  # (num_unique_prompts, ...) -> (B, ...)
+
+        # The positions of the completion tokens follow the cached prompt, as in a forward pass on the whole sequence
+        completion_ids = input_ids[:, prompt_length:]
+        completion_output = unwrapped_model.model(
+            input_ids=completion_ids, attention_mask=attention_mask, past_key_values=past_key_values, use_cache=True
+        )
+        # The last prompt token predicts the first completion token, and the last completion token is excluded
+        last_hidden_state = torch.cat(
+            [prompt_output.last_hidden_state[inverse, -1:], completion_output.last_hidden_state[:, :-1]], dim=1
+        )  # (B, logits_to_keep, H)
+        return self._lm_head_log_softmax(unwrapped_model.lm_head, last_hidden_state, completion_ids)
+
+    @profiling_decorator
+    def _get_selected_logps(self, unwrapped_model, input_ids, logits_mask, targets, **kwargs):
+        # Only the hidden states selected by `logits_mask` go through the LM head, so the logits have shape
+        # (num_selected, V) instead of (B, L, V)
+        if is_peft_model(unwrapped_model):
+            unwrapped_model = unwrapped_model.base_model.model
+        last_hidden_state = unwrapped_model.model(input_ids=input_ids, **kwargs).last_hidden_state
+        return self._lm_head_log_softmax(unwrapped_model.lm_head, last_hidden_state[logits_mask], targets)
+
+    @staticmethod
+    def _logits_are_lm_head_outputs(unwrapped_model) -> bool:
+        # Whether the logits of the model are its LM head applied to the last hidden state of its decoder, so that they
+        # can be computed for selected positions only. Some models post-process them in their forward (e.g., the final
+        # logit soft-capping of Gemma 2 and 3, the logit scale of Cohere, the logits scaling of Granite).
+        if is_peft_model(unwrapped_model):
+            unwrapped_model = unwrapped_model.base_model.model
+        if not isinstance(getattr(unwrapped_model, "model", None), nn.Module) or not isinstance(
+            getattr(unwrapped_model, "lm_head", None), nn.Module
+        ):
+            return False
+        config = unwrapped_model.config.get_text_config()
+        return (
+            getattr(config, "final_logit_softcapping", None) is None
+            and getattr(config, "logit_scale", None) is None
+            and getattr(config, "logits_scaling", 1.0) == 1.0
+        )
+
+    def _lm_head_log_softmax(self, lm_head, hidden_states, index):
+        # Temperature-scaled log probabilities of the `index` tokens. With `logprob_chunk_size`, the full logits are
+        # never materialized.
+        if self.logprob_chunk_size is not None and isinstance(lm_head, nn.Linear):
+            return fused_selective_log_softmax(
+                hidden_states, lm_head.weight, index, lm_head.bias, self.temperature, self.logprob_chunk_size
+            )
+        # Divide logits by sampling temperature.
+        # See https://huggingface.co/blog/the_n_implementation_details_of_rlhf_with_ppo#policy-training-implementation-details
+        logits = lm_head(hidden_states) / self.temperature
+        return selective_log_softmax(logits, index)
+
     # Get the per-token log probabilities for the completions for the model and the reference model
     @profiling_decorator
-    def _get_per_token_logps(self, model, input_ids, attention_mask, logits_to_keep, batch_size=None) -> torch.Tensor:
+    def _get_per_token_logps(
+        self, model, input_ids, attention_mask, logits_to_keep, batch_size=None, position_ids=None
+    ) -> torch.Tensor:
         """
         Get the per-token log probabilities for the tokens that were actually generated in the completions.
 
@@ -882,61 +1093,182 @@ class GRPOTrainer(Trainer):
                 - If an int, compute logits for the last logits_to_keep tokens.
                 - If 0, calculate logits for all input_ids (special case).
                 Only last token logits are needed for generation, and calculating them only for that token can save memory, which becomes pretty significant for long sequences or large vocabulary size.
-                - If a torch.Tensor, must be 1D mask of the same length as input_ids, with 1s for tokens to keep and 0s for tokens to ignore.
-                This is useful when using packed tensor format (single dimension for batch and sequence length).
+                - If a torch.Tensor (multi-turn conversations), must be a boolean mask of shape (B, L), with True for
+                the tokens to compute the log probabilities of.
             batch_size (`int`, *optional*): Batch size for processing. If `None`, uses input_ids.size(0).
+            position_ids (`torch.Tensor`, *optional*): The position IDs of the multi-turn conversations, shape (B, L).
 
         Returns:
             `torch.Tensor`: Log probabilities for each actual token in the completions.
-            Shape is (B, length of logits_to_keep), where:
+            Shape is (B, logits_to_keep), where:
                 - Each value is the log probability that the model assigned to the token
                 that was actually generated at that position.
+            For multi-turn conversations, the shape is (B, L), aligned with `input_ids`, and the log probabilities of
+            the tokens that are not in `logits_to_keep` are 0.
         """
         batch_size = batch_size or input_ids.size(0)  # Chunk inputs into smaller batches to reduce memory peak
+        micro_batches = self._get_logprob_micro_batches(attention_mask, logits_to_keep, batch_size)
         all_logps = []
 
         if not self.is_conversation:
-            for i in range(0, input_ids.size(0), batch_size):
-                input_ids_batch = input_ids[i : i + batch_size]
-                attention_mask_batch = attention_mask[i : i + batch_size]
-
-                # We add 1 to `logits_to_keep` because the last logits of the sequence is later excluded
-                # The extra +1 when passing logits_to_keep to the model compensates for the fact that the model returns, for each input token, the logits predicting the next token.
-                # By requesting K+1 logits and then dropping the very last prediction (which corresponds to the token following your final completion token), you end up with exactly K log‐prob entries aligned one‐to‐one with each completion token.
-                logits = model(
-                    input_ids=input_ids_batch, attention_mask=attention_mask_batch, logits_to_keep=logits_to_keep + 1
-                ).logits # shape: (batch_size, length_of_logits_to_keep, vocab_size)
-                logits = logits[:, :-1, :]  # (B, L-1, V), exclude the last logit: it corresponds to the next token pred
-                input_ids_batch = input_ids_batch[:, -logits_to_keep:]
-                # For transformers<=4.48, logits_to_keep argument isn't supported, so here we drop logits ourselves.
-                # See https://github.com/huggingface/trl/issues/2770
-                logits = logits[:, -logits_to_keep:]  # shape: (B, logits_to_keep, V)
-                # Divide logits by sampling temperature.
-                # See https://huggingface.co/blog/the_n_implementation_details_of_rlhf_with_ppo#policy-training-implementation-details
-                logits = logits / self.temperature
-                logps = selective_log_softmax(logits, input_ids_batch)  # compute logprobs for the input tokens
+            unwrapped_model = self.accelerator.unwrap_model(model)
+            for rows, columns, logits_to_keep_batch in micro_batches:
+                input_ids_batch = input_ids[rows, columns]
+                attention_mask_batch = attention_mask[rows, columns]
+
+                if self.reuse_prompt_kv_cache:
+                    # Encode each distinct prompt once, and reuse its KV cache for all its completions
+                    logps = self._forward_redirection(
+                        model,
+                        unwrapped_model,
+                        self._get_shared_prompt_logps,
+                        unwrapped_model,
+                        input_ids_batch,
+                        attention_mask_batch,
+                        logits_to_keep_batch,
+                    )  # shape: (B, logits_to_keep)
+                elif self.logprob_chunk_size is not None:
+                    # Compute the log probabilities from the last hidden state, without materializing the logits
+                    logps = self._forward_redirection(
+                        model,
+                        unwrapped_model,
+                        self._get_completion_logps,
+                        unwrapped_model,
+                        input_ids_batch,
+                        attention_mask_batch,
+                        logits_to_keep_batch,
+                    )  # shape: (B, logits_to_keep)
+                else:
+                    # We add 1 to `logits_to_keep` because the last logits of the sequence is later excluded
+                    # The extra +1 when passing logits_to_keep to the model compensates for the fact that the model returns, for each input token, the logits predicting the next token.
+                    # By requesting K+1 logits and then dropping the very last prediction (which corresponds to the token following your final completion token), you end up with exactly K log‐prob entries aligned one‐to‐one with each completion token.
+                    logits = model(
+                        input_ids=input_ids_batch,
+                        attention_mask=attention_mask_batch,
+                        logits_to_keep=logits_to_keep_batch + 1,
+                    ).logits # shape: (batch_size, length_of_logits_to_keep, vocab_size)
+                    # (B, L-1, V), exclude the last logit: it corresponds to the next token pred
+                    logits = logits[:, :-1, :]
+                    input_ids_batch = input_ids_batch[:, -logits_to_keep_batch:]
+                    # For transformers<=4.48, logits_to_keep argument isn't supported, so here we drop logits ourselves.
+                    # See https://github.com/huggingface/trl/issues/2770
+                    logits = logits[:, -logits_to_keep_batch:]  # shape: (B, logits_to_keep, V)
+                    # Divide logits by sampling temperature.
+                    # See https://huggingface.co/blog/the_n_implementation_details_of_rlhf_with_ppo#policy-training-implementation-details
+                    logits = logits / self.temperature
+                    logps = selective_log_softmax(logits, input_ids_batch)  # compute logprobs for the input tokens
                 all_logps.append(logps)
         else:
-            # logits_to_keep is a BoolTensor
-            for i in range(0, input_ids.size(0), batch_size):
-                input_ids_batch = input_ids[i : i + batch_size]
-                attention_mask_batch = attention_mask[i : i + batch_size]
-                logits_to_keep_batch = logits_to_keep.unsqueeze(0).expand_as(input_ids_batch) # shape: (B, L)
-
-                # Convert boolean mask to indices explicitly before passing to model
-                logits_to_keep_indices = torch.nonzero(logits_to_keep).squeeze(1)
-
-                # logits_to_keep_indices is a tensor of indices, those exact indices are used for advanced indexing. We do not need a separate '+1' then drop one
-                logits = model(
-                    input_ids=input_ids_batch, attention_mask=attention_mask_batch, logits_to_keep=logits_to_keep_indices.tolist()
-                ).logits # shape: (batch_size, length_of_logits_to_keep, vocab_size)
-                input_ids_batch = input_ids_batch[logits_to_keep_batch].view(batch_size, -1) # shape: (B, length_of_logits_to_keep)
-                # Divide logits by sampling temperature.
-                # See https://huggingface.co/blog/the_n_implementation_details_of_rlhf_with_ppo#policy-training-implementation-details
-                logits = logits / self.temperature
-                logps = selective_log_softmax(logits, input_ids_batch)  # compute logprobs for the input tokens
+            # logits_to_keep is a BoolTensor of shape (B, L). The logits at position t predict the token at position
+            # t + 1, so the logits to compute are the ones right before each token to keep. They are selected per row,
+            # before the LM head.
+            unwrapped_model = self.accelerator.unwrap_model(model)
+            for rows, columns, _ in micro_batches:
+                input_ids_batch = input_ids[rows, columns]
+                attention_mask_batch = attention_mask[rows, columns]
+                position_ids_batch = position_ids[rows, columns] if position_ids is not None else None
+                logits_to_keep_batch = logits_to_keep[rows, columns].clone()
+                logits_to_keep_batch[:, 0] = False  # no logits predict the first token
+
+                if self.padding_free:
+                    # Flatten the conversations into a single sequence and let flash attention handle the
+                    # boundaries between conversations through the cumulative sequence lengths
+                    # input_ids = [[a, b, c, 0], ->     input_ids = [[a, b, c, d, e, f, g]]
+                    #              [d, e, f, g]]     position_ids = [[0, 1, 2, 0, 1, 2, 3]]
+                    #                                  cu_seq_lens = [0, 3, 7]
+                    mask = attention_mask_batch.bool()
+                    sequence_lengths = attention_mask_batch.sum(dim=1)
+                    cu_seq_lens = torch.cumsum(sequence_lengths, dim=0, dtype=torch.int32)
+                    cu_seq_lens = torch.cat([cu_seq_lens.new_zeros(1), cu_seq_lens])
+                    max_length = sequence_lengths.max().item()
+                    # The first token of each conversation is never kept, so the shifted mask doesn't cross the
+                    # boundaries between conversations
+                    logits_mask = torch.roll(logits_to_keep_batch[mask], shifts=-1).unsqueeze(0)
+                    model_inputs = {
+                        "input_ids": input_ids_batch[mask].unsqueeze(0),
+                        "position_ids": (attention_mask_batch.cumsum(1)[mask] - 1).unsqueeze(0),
+                        "cu_seq_lens_q": cu_seq_lens,
+                        "cu_seq_lens_k": cu_seq_lens,
+                        "max_length_q": max_length,
+                        "max_length_k": max_length,
+                    }
+                else:
+                    logits_mask = torch.roll(logits_to_keep_batch, shifts=-1, dims=1)
+                    model_inputs = {
+                        "input_ids": input_ids_batch,
+                        "attention_mask": attention_mask_batch,
+                        "position_ids": position_ids_batch,
+                    }
+                targets = input_ids_batch[logits_to_keep_batch]
+                if self._logits_are_lm_head_outputs(unwrapped_model):
+                    selected_logps = self._forward_redirection(
+                        model,
+                        unwrapped_model,
+                        self._get_selected_logps,
+                        unwrapped_model,
+                        logits_mask=logits_mask,
+                        targets=targets,
+                        **model_inputs,
+                    )  # shape: (num_tokens_to_keep,)
+                else:
+                    # Compute the logits with the forward of the model, at the positions needed by at least one row
+                    keep_indices = torch.nonzero(logits_mask.any(dim=0)).squeeze(1)
+                    logits = model(**model_inputs, logits_to_keep=keep_indices).logits  # (B, num_positions, V)
+                    logits = logits[logits_mask[:, keep_indices]]  # shape: (num_tokens_to_keep, vocab_size)
+                    # Divide logits by sampling temperature.
+                    # See https://huggingface.co/blog/the_n_implementation_details_of_rlhf_with_ppo#policy-training-implementation-details
+                    selected_logps = selective_log_softmax(logits / self.temperature, targets)
+                logps = torch.zeros(input_ids_batch.shape, dtype=selected_logps.dtype, device=selected_logps.device)
+                logps[logits_to_keep_batch] = selected_logps
                 all_logps.append(logps)
-        return torch.cat(all_logps, dim=0)
+
+        if self.logprob_max_batch_tokens is None:
+            return torch.cat(all_logps, dim=0)
+        # Scatter the log probabilities of the trimmed micro-batches back to the original order and width
+        width = logits_to_keep if not self.is_conversation else input_ids.size(1)
+        per_token_logps = all_logps[0].new_zeros(input_ids.size(0), width)
+        for (rows, _, _), logps in zip(micro_batches, all_logps):
+            per_token_logps[rows, : logps.size(1)] = logps
+        return per_token_logps
+
+    def _get_logprob_micro_batches(self, attention_mask, logits_to_keep, batch_size) -> list[tuple]:
+        """
+        Split the rows of `_get_per_token_logps`'s inputs into micro-batches.
+
+        Returns a list of `(rows, columns, logits_to_keep)` tuples, where `rows` and `columns` index the inputs of the
+        micro-batch, and `logits_to_keep` is its number of completion tokens (single-turn only, `None` otherwise). By
+        default, the micro-batches are consecutive chunks of `batch_size` rows. With `logprob_max_batch_tokens`, the
+        rows are sorted by length and grouped under this token budget, and each micro-batch is trimmed to its longest
+        row, so that short sequences aren't padded to the longest one of the whole batch.
+        """
+        num_rows = attention_mask.size(0)
+        if self.logprob_max_batch_tokens is None:
+            return [
+                (slice(i, i + batch_size), slice(None), logits_to_keep if not self.is_conversation else None)
+                for i in range(0, num_rows, batch_size)
+            ]
+
+        if not self.is_conversation:
+            # Prompts are left-padded and completions right-padded, so each part is trimmed separately. At least one
+            # completion token is kept, even if all the completions of the micro-batch are masked.
+            prompt_length = attention_mask.size(1) - logits_to_keep
+            prompt_lengths = attention_mask[:, :prompt_length].sum(dim=1)
+            completion_lengths = attention_mask[:, prompt_length:].sum(dim=1).clamp(min=1)
+            lengths = torch.stack([prompt_lengths, completion_lengths], dim=1)
+        else:
+            # Conversations are right-padded
+            lengths = attention_mask.sum(dim=1)
+
+        micro_batches = []
+        for rows in split_by_token_budget(lengths, self.logprob_max_batch_tokens):
+            max_lengths = lengths[rows].max(dim=0).values.tolist()
+            if not self.is_conversation:
+                batch_prompt_length, batch_completion_length = max_lengths
+                columns = slice(prompt_length - batch_prompt_length, prompt_length + batch_completion_length)
+                micro_batches.append((rows, columns, batch_completion_length))
+            else:
+                micro_batches.append((rows, slice(0, max_lengths), None))
+        return micro_batches
 
     def _sync_fsdp_params_to_vllm(self, module: nn.Module, prefix: str = "", visited=None):
         """Memory-efficient post-order traversal of FSDP modules to extract full parameters and sync with vLLM."""
@@ -951,6 +1283,7 @@ class GRPOTrainer(Trainer):
 
         if isinstance(module, FSDP):
             with FSDP.summon_full_params(module, recurse=False, writeback=False):
+                named_params = []
                 for param_name, param in module.named_parameters():
                     full_name = f"{prefix}.{param_name}" if prefix else param_name
                     for extra in ("_fsdp_wrapped_module.", "_checkpoint_wrapped_module."):
@@ -960,15 +1293,50 @@ class GRPOTrainer(Trainer):
                         continue  # skip FSDP subtrees already traversed
                     visited.add(full_name)
 
-                    if not self.is_conversation:
-                        if self.vllm_mode == "server" and self.accelerator.is_main_process:
-                            self.vllm_client.update_named_param(full_name, param.data)
-                        elif self.vllm_mode == "colocate":
-                            llm_model = self.llm.llm_engine.model_executor.driver_worker.model_runner.model
-                            llm_model.load_weights([(full_name, param.data)])
+                    if is_peft_model(self.model):
+                        vllm_name = self._peft_param_name_to_vllm(full_name, param)
+                        if vllm_name is not None:
+                            named_params.append((vllm_name, param.data))
                     else:
-                        if self.accelerator.is_main_process:
-                            self.conversation_generator.update_named_param(full_name, param.data)
+                        named_params.append((full_name, param.data))
+
+                # The full parameters are only available within this context, so update them all at once here
+                if named_params:
+                    self._update_vllm_weights(named_params)
+
+    def _peft_param_name_to_vllm(self, name: str, param: torch.nn.Parameter) -> Optional[str]:
+        """
+        Maps the name of a parameter of the PEFT model to the name of the base model parameter it updates in vLLM, once
+        the adapters are merged. Returns `None` for the parameters that must not be sent: the adapter weights, the
+        original copies of the modules to save, and, when `vllm_sync_adapted_modules_only=True`, the frozen parameters
+        of the modules without adapters, which are still identical to the ones vLLM loaded.
+        """
+        if self.model.prefix in name or "original_module" in name:
+            return None
+        if self.args.vllm_sync_adapted_modules_only and not (
+            ".base_layer." in name or "modules_to_save." in name or param.requires_grad
+        ):
+            return None
+        # Recover the original parameter name: remove the PEFT wrappers, and the prefix of the modules to save
+        name = name.removeprefix("base_model.model.").replace(".base_layer", "")
+        return name.replace("modules_to_save.default.", "")
+
+    def _update_vllm_weights(self, named_params: list[tuple[str, torch.Tensor]]):
+        """
+        Pushes the given weights to vLLM (or to the conversation generator). In server mode, the weights are packed
+        into flat buffers of up to `vllm_weight_sync_bucket_size_mb` megabytes, each sent with a single request and a
+        single NCCL broadcast. In colocate mode, they are loaded with a single `load_weights` call.
+        """
+        if not self.is_conversation and self.vllm_mode == "colocate":
+            llm_model = self.llm.llm_engine.model_executor.driver_worker.model_runner.model
+            llm_model.load_weights(named_params)
+        elif self.accelerator.is_main_process:
+            client = self.conversation_generator if self.is_conversation else self.vllm_client
+            if self.args.vllm_weight_sync_bucket_size_mb > 0:
+                client.update_named_params(named_params, bucket_size_mb=self.args.vllm_weight_sync_bucket_size_mb)
+            else:
+                for name, weights in named_params:
+                    client.update_named_param(name, weights)
 
     @profiling_decorator
     def _move_model_to_vllm(self):
@@ -986,7 +1354,16 @@ class GRPOTrainer(Trainer):
             # With PEFT and FSDP/DeepSpeed ZeRO Stage 3, we must gather the full model at once before merging, as
             # merging adapters in a sharded manner is not supported.
             # TODO: does this work with FSDP?
-            with gather_if_zero3(list(self.model.parameters())):
+            if self.args.vllm_sync_adapted_modules_only:
+                # Merging only needs the parameters of the modules with adapters, and only those are sent
+                params = [
+                    param
+                    for name, param in self.model.named_parameters()
+                    if self.model.prefix in name or self._peft_param_name_to_vllm(name, param) is not None
+                ]
+            else:
+                params = list(self.model.parameters())
+            with gather_if_zero3(params):
                 self.model.merge_adapter()
 
                 # Update vLLM weights while parameters are gathered
@@ -996,25 +1373,13 @@ class GRPOTrainer(Trainer):
                     self._sync_fsdp_params_to_vllm(self.model)
                 else:
                     # DeepSpeed ZeRO-3 with PEFT
+                    named_params = []
                     for name, param in self.model.named_parameters():
                         # When using PEFT, we need to recover the original parameter name and discard some parameters
-                        name = name.removeprefix("base_model.model.").replace(".base_layer", "")
-                        if self.model.prefix in name:
-                            continue
-                        # When module to save, remove its prefix and discard the original module
-                        if "original_module" in name:
-                            continue
-                        name = name.replace("modules_to_save.default.", "")
-
-                        if not self.is_conversation:
-                            if self.vllm_mode == "server" and self.accelerator.is_main_process:
-                                    self.vllm_client.update_named_param(name, param.data)
-                            elif self.vllm_mode == "colocate":
-                                llm_model = self.llm.llm_engine.model_executor.driver_worker.model_runner.model
-                                llm_model.load_weights([(name, param.data)])
-                        else:
-                            if self.accelerator.is_main_process:
-                                self.conversation_generator.update_named_param(name, param.data)
+                        vllm_name = self._peft_param_name_to_vllm(name, param)
+                        if vllm_name is not None:
+                            named_params.append((vllm_name, param.data))
+                    self._update_vllm_weights(named_params)
                 # Unmerge adapters while parameters are still gathered
                 self.model.unmerge_adapter()
                 # Parameters will automatically be repartitioned when exiting the context
@@ -1022,18 +1387,23 @@ class GRPOTrainer(Trainer):
             # For non-PEFT models, simply gather (if needed) and update each parameter individually.
             if self.is_fsdp_enabled:
                 self._sync_fsdp_params_to_vllm(self.model)  # use memory-efficient post-order traversal for FSDP
-            else:
+            elif zero_stage_3:
+                # Gathered parameters are released when exiting the context, so gather them by groups of
+                # `vllm_weight_sync_bucket_size_mb` and update each group at once, while it is gathered.
+                bucket_size = self.args.vllm_weight_sync_bucket_size_mb * 1024 * 1024
+                named_params, size = [], 0
                 for name, param in self.model.named_parameters():
-                    with gather_if_zero3([param]):
-                        if not self.is_conversation:
-                            if self.vllm_mode == "server" and self.accelerator.is_main_process:
-                                self.vllm_client.update_named_param(name, param.data)
-                            elif self.vllm_mode == "colocate":
-                                llm_model = self.llm.llm_engine.model_executor.driver_worker.model_runner.model
-                                llm_model.load_weights([(name, param.data)])
-                        else:
-                            if self.accelerator.is_main_process:
-                                self.conversation_generator.update_named_param(name, param.data)
+                    named_params.append((name, param))
+                    size += param.ds_numel * param.element_size()
+                    if size >= bucket_size:
+                        with gather_if_zero3([param for _, param in named_params]):
+                            self._update_vllm_weights([(name, param.data) for name, param in named_params])
+                        named_params, size = [], 0
+                if named_params:
+                    with gather_if_zero3([param for _, param in named_params]):
+                        self._update_vllm_weights([(name, param.data) for name, param in named_params])
+            else:
+                self._update_vllm_weights([(name, param.data) for name, param in self.model.named_parameters()])
 
         if not self.is_conversation:
             # Reset cache on main process
@@ -1044,6 +1414,8 @@ class GRPOTrainer(Trainer):
             if self.accelerator.is_main_process:
                 self.conversation_generator.reset_prefix_cache()
 
+        self._policy_version += 1
+
     @profiling_decorator
     def _prepare_inputs(
         self, accumulated_local_batch: dict[str, Union[torch.Tensor, Any]]
@@ -1091,6 +1463,376 @@ class GRPOTrainer(Trainer):
                 inputs = self._generate_and_score_conversations(accumulated_local_batch)
         return inputs
 
+    def _calculate_rewards(self, inputs: list[dict[str, Any]], reward_kwargs: dict[str, list]) -> torch.Tensor:
+        """
+        Computes the rewards of the local samples with each reward function.
+
+        Reward functions declared with `async def`, or with a `concurrency` attribute set to `"thread"` or `"process"`,
+        are called once per sample, concurrently, in the background. Meanwhile, the other reward functions are called
+        on the whole batch, one after the other. A call that returns `None`, or that doesn't return within
+        `reward_func_timeout` seconds after being submitted, yields NaN.
+
+        Args:
+            inputs (`list[dict[str, Any]]`):
+                Local samples.
+            reward_kwargs (`dict[str, list]`):
+                Keyword arguments passed to the custom reward functions, with one value per sample.
+
+        Returns:
+            `torch.Tensor`:
+                Rewards of shape `(num_samples, num_reward_funcs)`.
+        """
+        device = self.accelerator.device
+        num_samples = len(inputs)
+        timeout = self.args.reward_func_timeout
+        rewards_per_func = torch.zeros(num_samples, len(self.reward_funcs), device=device)
+
+        # Submit the per-sample calls first, so that they run while the other reward functions are computed
+        start_time = time.monotonic()
+        pending_calls = {}
+        for i, (reward_func, concurrency) in enumerate(zip(self.reward_funcs, self.reward_func_concurrencies)):
+            if concurrency is None:
+                continue
+            pending_calls[i] = []
+            for j in range(num_samples):
+                sample_kwargs = {key: value[j : j + 1] for key, value in reward_kwargs.items()}
+                if concurrency == "async":
+                    coroutine = asyncio.wait_for(reward_func(**sample_kwargs), timeout=timeout)
+                    call = asyncio.run_coroutine_threadsafe(coroutine, self._get_reward_executor(concurrency))
+                else:
+                    call = self._get_reward_executor(concurrency).submit(reward_func, **sample_kwargs)
+                pending_calls[i].append(call)
+
+        for i, (reward_func, reward_processing_class, reward_func_name) in enumerate(
+            zip(self.reward_funcs, self.reward_processing_classes, self.reward_func_names)
+        ): # Repeat for each reward function
+            if i in pending_calls:
+                continue
+            with profiling_context(self, reward_func_name):
+                if isinstance(
+                    reward_func, nn.Module
+                ):  # Module instead of PretrainedModel for compat with compiled models
+                    prompts, completions = reward_kwargs["prompts"], reward_kwargs["completions"]
+                    if is_conversational(inputs[0]):
+                        messages = [{"messages": p + c} for p, c in zip(prompts, completions)]
+                        texts = [apply_chat_template(x, reward_processing_class)["text"] for x in messages]
+                    else:
+                        texts = [p + c for p, c in zip(prompts, completions)]
+                    if self.args.reward_models_on_main_process:
+                        rewards_per_func[:, i] = self._score_on_main_process(
+                            reward_func, reward_processing_class, texts
+                        )
+                    else:
+                        reward_inputs = reward_processing_class(
+                            text=texts,
+                            return_tensors="pt",
+                            padding=True,
+                            padding_side="right",
+                            add_special_tokens=False,
+                        )
+                        reward_inputs = super()._prepare_inputs(reward_inputs)
+                        with torch.inference_mode():
+                            rewards_per_func[:, i] = reward_func(**reward_inputs).logits[:, 0]  # Shape (B*G,)
+                else:
+                    output_reward_func = reward_func(**reward_kwargs)
+                    # Convert None values to NaN
+                    output_reward_func = [reward if reward is not None else torch.nan for reward in output_reward_func]
+
+                    rewards_per_func[:, i] = torch.tensor(output_reward_func, dtype=torch.float32, device=device)
+
+        # Collect the results of the per-sample calls. The profiled time is the time spent waiting for them.
+        for i, calls in pending_calls.items():
+            with profiling_context(self, self.reward_func_names[i]):
+                output_reward_func = []
+                num_timeouts = 0
+                for call in calls:
+                    remaining = None if timeout is None else max(0.0, start_time + timeout - time.monotonic())
+                    try:
+                        reward = call.result(timeout=remaining)[0]
+                    except (futures.TimeoutError, asyncio.TimeoutError):
+                        call.cancel()  # only effective if the call hasn't started yet
+                        num_timeouts += 1
+                        reward = None
+                    # Convert None values to NaN
+                    output_reward_func.append(reward if reward is not None else torch.nan)
+                if num_timeouts > 0:
+                    warnings.warn(
+                        f"{num_timeouts} call(s) of the reward function {self.reward_func_names[i]} timed out after "
+                        f"{timeout} seconds. Their rewards are set to NaN."
+                    )
+            rewards_per_func[:, i] = torch.tensor(output_reward_func, dtype=torch.float32, device=device)
+
+        return rewards_per_func
+
+    def _get_reward_executor(self, concurrency: str):
+        if concurrency not in self._reward_executors:
+            if concurrency == "async":
+                # Async reward functions run in an event loop living in a background thread
+                executor = asyncio.new_event_loop()
+                threading.Thread(target=executor.run_forever, daemon=True).start()
+            elif concurrency == "thread":
+                executor = futures.ThreadPoolExecutor()
+            else:
+                # The workers are spawned rather than forked: forking a process that holds CUDA contexts and runs other
+                # threads (async rewards, rollouts) can deadlock
+                executor = futures.ProcessPoolExecutor(mp_context=multiprocessing.get_context("spawn"))
+            self._reward_executors[concurrency] = executor
+        return self._reward_executors[concurrency]
+
+    def _shutdown_reward_executors(self):
+        # The calls that are still running (timed out) are not waited for
+        for concurrency, executor in self._reward_executors.items():
+            if concurrency == "async":
+                executor.call_soon_threadsafe(executor.stop)
+            else:
+                executor.shutdown(wait=False, cancel_futures=True)
+        self._reward_executors = {}
+
+    def _score_on_main_process(
+        self, reward_model: nn.Module, reward_processing_class: PreTrainedTokenizerBase, texts: list[str]
+    ) -> torch.Tensor:
+        """
+        Scores the texts of all processes with a reward model hosted by the main process only, and returns the rewards
+        of the local texts.
+
+        The main process sorts the gathered texts by length and scores them in micro-batches of
+        `reward_model_batch_size` texts, so that each micro-batch holds texts of similar lengths.
+        """
+        device = self.accelerator.device
+        all_texts = gather_object(texts)
+        all_rewards = torch.zeros(len(all_texts), device=device)
+        if self.accelerator.is_main_process:
+            batch_size = self.args.reward_model_batch_size or len(texts)
+            order = sorted(range(len(all_texts)), key=lambda idx: len(all_texts[idx]))
+            for start in range(0, len(order), batch_size):
+                indices = order[start : start + batch_size]
+                reward_inputs = reward_processing_class(
+                    text=[all_texts[idx] for idx in indices],
+                    return_tensors="pt",
+                    padding=True,
+                    padding_side="right",
+                    add_special_tokens=False,
+                )
+                reward_inputs = super()._prepare_inputs(reward_inputs)
+                with torch.inference_mode():
+                    rewards = reward_model(**reward_inputs).logits[:, 0]
+                all_rewards[indices] = rewards.float()
+
+        # Send the rewards to all processes, and keep the local ones
+        all_rewards = broadcast(all_rewards, from_process=0)
+        process_slice = slice(
+            self.accelerator.process_index * len(texts),
+            (self.accelerator.process_index + 1) * len(texts),
+        )
+        return all_rewards[process_slice]
+
+    def _score_with_vllm_ref_model(
+        self, prompt_token_ids: list[list[int]], completion_ids: list[list[int]]
+    ) -> list[list[float]]:
+        """
+        Computes the log-probabilities of the completion tokens with the reference model hosted by the vLLM server.
+        Only called on the main process.
+
+        Args:
+            prompt_token_ids (`list[list[int]]`):
+                Token IDs of the prompts (without padding), one per completion.
+            completion_ids (`list[list[int]]`):
+                Token IDs of the completions.
+
+        Returns:
+            `list[list[float]]`:
+                For each completion, the reference log-probability of each of its tokens.
+        """
+        sequences = [ids + list(completion) for ids, completion in zip(prompt_token_ids, completion_ids)]
+        logprobs = self.vllm_client.score(sequences)
+        # The scores start from the second token of each sequence, so the completion starts at `len(prompt) - 1`
+        return [logps[len(ids) - 1 :] for ids, logps in zip(prompt_token_ids, logprobs)]
+
+    def _gather_groups(self, group_items: list, group_sizes: list[int]) -> list:
+        """
+        Gathers items shared by the rows of a group (e.g. the prompt of `num_generations` completions) from all
+        processes, and repeats each of them for every row of its group. Each process only sends one item per group.
+
+        Args:
+            group_items (`list`):
+                Local items, one per group.
+            group_sizes (`list[int]`):
+                Local number of rows of each group. A group split across processes has rows in each of them.
+
+        Returns:
+            `list`:
+                Items of all the rows of all the processes, in order.
+        """
+        gathered = gather_object([(group_items, group_sizes)])
+        return [item for items, sizes in gathered for item, size in zip(items, sizes) for _ in range(size)]
+
+    def _scatter_completions(
+        self,
+        num_local_rows: int,
+        completion_ids: Optional[list[list[int]]],
+        logprobs: Optional[list[list[float]]] = None,
+        ref_logprobs: Optional[list[list[float]]] = None,
+    ) -> tuple[list[torch.Tensor], Optional[list[torch.Tensor]], Optional[list[torch.Tensor]]]:
+        """
+        Sends to each process its slice of the completions returned by the vLLM server to the main process.
+
+        The slice of each process is packed into a single int32 tensor (the completion lengths, the token IDs and the
+        bits of the float32 log-probabilities), and the tensors are scattered over the process group. Each process
+        thus only receives its own completions, without pickling.
+
+        Args:
+            num_local_rows (`int`):
+                Number of completions of each process.
+            completion_ids (`list[list[int]]` or `None`):
+                Completion IDs of all the processes. Only used on the main process.
+            logprobs (`list[list[float]]` or `None`, *optional*, defaults to `None`):
+                vLLM log-probabilities of the sampled tokens, sent when `use_vllm_logprobs=True`. Only used on the main
+                process.
+            ref_logprobs (`list[list[float]]` or `None`, *optional*, defaults to `None`):
+                Log-probabilities of the reference model hosted by the vLLM server, sent when
+                `use_vllm_ref_model=True`. Only used on the main process.
+
+        Returns:
+            `tuple[list[torch.Tensor], Optional[list[torch.Tensor]], Optional[list[torch.Tensor]]]`:
+                The local completion IDs, log-probabilities and reference log-probabilities, one tensor per completion.
+                The log-probabilities are `None` when they aren't sent.
+        """
+        device = self.accelerator.device
+        num_processes = self.accelerator.num_processes
+        with_values = [self.use_vllm_logprobs, self.use_vllm_ref_model]
+
+        if self.accelerator.is_main_process:
+            packed = []
+            for process_index in range(num_processes):
+                rows = slice(process_index * num_local_rows, (process_index + 1) * num_local_rows)
+                parts = [
+                    torch.tensor([len(ids) for ids in completion_ids[rows]], dtype=torch.int32),
+                    torch.tensor(list(chain.from_iterable(completion_ids[rows])), dtype=torch.int32),
+                ]
+                for values, with_value in zip((logprobs, ref_logprobs), with_values):
+                    if with_value:
+                        values = torch.tensor(list(chain.from_iterable(values[rows])), dtype=torch.float32)
+                        parts.append(values.view(torch.int32))
+                packed.append(torch.cat(parts).to(device))
+
+        if num_processes == 1:
+            local_packed = packed[0]
+        else:
+            sizes = torch.tensor([len(t) for t in packed] if self.accelerator.is_main_process else [0] * num_processes)
+            sizes = broadcast(sizes.to(device), from_process=0).tolist()
+            # Scattered tensors must have the same size
+            local_packed = torch.empty(max(sizes), dtype=torch.int32, device=device)
+            scatter_list = None
+            if self.accelerator.is_main_process:
+                scatter_list = [nn.functional.pad(t, (0, max(sizes) - len(t))) for t in packed]
+            torch.distributed.scatter(local_packed, scatter_list, src=0)
+            local_packed = local_packed[: sizes[self.accelerator.process_index]]
+
+        lengths = local_packed[:num_local_rows].tolist()
+        num_tokens = sum(lengths)
+        start = num_local_rows
+        outputs = [local_packed[start : start + num_tokens].long().split(lengths)]
+        for with_value in with_values:
+            if with_value:
+                start += num_tokens
+                outputs.append(local_packed[start : start + num_tokens].view(torch.float32).split(lengths))
+            else:
+                outputs.append(None)
+        return tuple(list(output) if output is not None else None for output in outputs)
+
+    def _async_generate(self, rollout: dict[str, Any]) -> dict[str, Any]:
+        """
+        Generates completions with the vLLM server one step ahead of training.
+
+        The prompts of the current batch are queued and sent to the vLLM server from a background thread, so that they
+        are generated while the trainer runs the forward and backward passes of the previous batch. In exchange, the
+        oldest queued batch is returned, together with its completions. Weights are only pushed to vLLM once the
+        previous generation request has completed, so each request is sampled from a single policy version.
+
+        Args:
+            rollout (`dict[str, Any]`):
+                Local prompt data of the current batch, with keys `"inputs"`, `"prompts"`, `"prompts_text"` (one per
+                group), `"group_sizes"`, `"prompt_token_ids"` (unpadded, sent to vLLM, one per group), `"prompt_ids"`
+                and `"prompt_mask"`.
+
+        Returns:
+            `dict[str, Any]`:
+                Local prompt data of the oldest queued batch, with the additional keys `"completion_ids"`,
+                `"logprobs"` (log-probabilities of the sampled tokens according to vLLM), `"ref_logprobs"`
+                (log-probabilities of the sampled tokens according to the reference model hosted by the vLLM server,
+                only set with `use_vllm_ref_model=True`) and `"policy_lag"` (number of weight updates between the
+                policy that sampled the completions and the current one).
+        """
+        all_prompt_token_ids = self._gather_groups(rollout["prompt_token_ids"], rollout["group_sizes"])
+        # Since 'prompts' contains 'num_generations' duplicates, we first take unique prompts, and generate
+        # num_generations outputs for each one.
+        ordered_set_of_prompts = all_prompt_token_ids[:: self.num_generations]
+
+        def generate():
+            completion_ids, logprobs = self.vllm_client.generate(
+                prompts=ordered_set_of_prompts,
+                n=self.num_generations,
+                repetition_penalty=self.repetition_penalty,
+                temperature=self.temperature,
+                top_p=self.top_p,
+                top_k=-1 if self.top_k is None else self.top_k,
+                min_p=0.0 if self.min_p is None else self.min_p,
+                max_tokens=self.max_completion_length,
+                guided_decoding_regex=self.guided_decoding_regex,
+                return_logprobs=True,
+            )
+            # The reference model is frozen, so the completions can be scored as soon as they are generated
+            if self.use_vllm_ref_model:
+                ref_logprobs = self._score_with_vllm_ref_model(all_prompt_token_ids, completion_ids)
+            else:
+                ref_logprobs = None
+            return completion_ids, logprobs, ref_logprobs
+
+        def submit():
+            future = self._rollout_executor.submit(generate)
+            self._rollout_futures.append((future, self._policy_version))
+
+        self._pending_rollouts.append(rollout)
+        if len(self._pending_rollouts) == 1:
+            # Nothing is in flight (first step, or after resuming from a checkpoint): the current batch is sampled once
+            # to be trained on right away, and once more below to fill the pipeline.
+            self._pending_rollouts.append(rollout)
+            if self.state.global_step != self._last_loaded_step:
+                self._move_model_to_vllm()
+                self._last_loaded_step = self.state.global_step
+            if self.accelerator.is_main_process:
+                submit()
+
+        if self.accelerator.is_main_process:
+            future, policy_version = self._rollout_futures.popleft()
+            with profiling_context(self, "vLLM.generate"):
+                completion_ids, logprobs, ref_logprobs = future.result()
+
+        # The server is idle again, so the weights can be updated before the next request is sent
+        if self.state.global_step != self._last_loaded_step:
+            self._move_model_to_vllm()
+            self._last_loaded_step = self.state.global_step
+
+        if self.accelerator.is_main_process:
+            submit()
+            policy_lag = [self._policy_version - policy_version]
+        else:
+            completion_ids, logprobs, ref_logprobs, policy_lag = None, None, None, [None]
+        policy_lag = broadcast_object_list(policy_lag, from_process=0)[0]
+
+        # Each process receives the completions corresponding to its local part of the oldest queued batch
+        rollout = self._pending_rollouts.popleft()
+        completion_ids, logprobs, ref_logprobs = self._scatter_completions(
+            len(rollout["prompts"]), completion_ids, logprobs, ref_logprobs
+        )
+        return {
+            **rollout,
+            "completion_ids": completion_ids,
+            "logprobs": logprobs,
+            "ref_logprobs": ref_logprobs,
+            "policy_lag": policy_lag,
+        }
+
     def _generate_and_score_completions(
         self, inputs: list[dict[str, Union[torch.Tensor, Any]]]
     ) -> dict[str, Union[torch.Tensor, Any]]:
@@ -1122,7 +1864,10 @@ class GRPOTrainer(Trainer):
         mode = "train" if self.model.training else "eval"
 
         prompts = [x["prompt"] for x in inputs]
-        prompts_text = [maybe_apply_chat_template(example, self.processing_class)["prompt"] for example in inputs] # list[str]
+        # The sampler yields each prompt `num_generations` times in a row. The chat template and the tokenizer are only
+        # applied to the first prompt of each group, and `prompts_text` holds one text per group.
+        group_starts, group_sizes = group_consecutive(prompts)
+        prompts_text = [maybe_apply_chat_template(inputs[i], self.processing_class)["prompt"] for i in group_starts]
         prompt_inputs = self.processing_class(
             text=prompts_text, return_tensors="pt", padding=True, padding_side="left", add_special_tokens=False
         )
@@ -1133,8 +1878,51 @@ class GRPOTrainer(Trainer):
             prompt_ids = prompt_ids[:, -self.max_prompt_length :]
             prompt_mask = prompt_mask[:, -self.max_prompt_length :]
 
-        # Generate completions using either vLLM or regular generation
         if self.use_vllm:
+            # vLLM receives the (truncated) prompt token IDs without padding, so that it doesn't tokenize the prompts
+            # again, and generates from exactly the same tokens as the ones the policy is trained on. One per group.
+            prompt_token_ids = [ids[mask.bool()].tolist() for ids, mask in zip(prompt_ids, prompt_mask)]
+
+        # Repeat the prompts for each completion of their group
+        repeats = torch.tensor(group_sizes, device=device)
+        prompt_ids = prompt_ids.repeat_interleave(repeats, dim=0)
+        prompt_mask = prompt_mask.repeat_interleave(repeats, dim=0)
+
+        old_per_token_logps = None
+
+        # Generate completions using either vLLM or regular generation
+        if self.async_generation and mode == "train":
+            # Queue the current batch for generation, and train on the oldest queued batch instead
+            rollout = self._async_generate(
+                {
+                    "inputs": inputs,
+                    "prompts": prompts,
+                    "prompts_text": prompts_text,
+                    "group_sizes": group_sizes,
+                    "prompt_token_ids": prompt_token_ids,
+                    "prompt_ids": prompt_ids,
+                    "prompt_mask": prompt_mask,
+                }
+            )
+            inputs, prompts, prompts_text = rollout["inputs"], rollout["prompts"], rollout["prompts_text"]
+            group_sizes = rollout["group_sizes"]
+            prompt_ids, prompt_mask = rollout["prompt_ids"], rollout["prompt_mask"]
+            self._metrics[mode]["policy_lag"].append(rollout["policy_lag"])
+
+            # The completions were sampled by an older policy: vLLM's log-probabilities of the sampled tokens are the
+            # behavior policy log-probabilities needed in the importance ratio
+            old_per_token_logps = [torch.as_tensor(logps, device=device) for logps in rollout["logprobs"]]
+            old_per_token_logps = pad(old_per_token_logps, padding_value=0.0)
+            ref_logprobs = rollout["ref_logprobs"]
+
+            # Pad the completions
+            completion_ids = [torch.as_tensor(ids, device=device) for ids in rollout["completion_ids"]]
+            completion_ids = pad(completion_ids, padding_value=self.processing_class.pad_token_id)
+        elif self.use_vllm:
+            if self.async_generation and self.accelerator.is_main_process:
+                # Let the generation running in the background finish before using the client from this thread
+                futures.wait([future for future, _ in self._rollout_futures])
+
             # First, update the vLLM weights if needed
             if self.state.global_step != self._last_loaded_step:
                 self._move_model_to_vllm()
@@ -1142,12 +1930,12 @@ class GRPOTrainer(Trainer):
 
             # Generate completions using vLLM: gather all prompts and use them in a single call in the main process
             if self.vllm_mode == "server":
-                all_prompts_text = gather_object(prompts_text)
+                all_prompt_token_ids = self._gather_groups(prompt_token_ids, group_sizes)
                 if self.accelerator.is_main_process:
                     # Since 'prompts' contains 'num_generations' duplicates, we first take unique prompts, and generate
                     # num_generations outputs for each one. This is faster than generating outputs for each duplicate
                     # prompt individually.
-                    ordered_set_of_prompts = all_prompts_text[:: self.num_generations]
+                    ordered_set_of_prompts = all_prompt_token_ids[:: self.num_generations]
                     with profiling_context(self, "vLLM.generate"):
                         completion_ids = self.vllm_client.generate(
                             prompts=ordered_set_of_prompts,
@@ -1159,17 +1947,21 @@ class GRPOTrainer(Trainer):
                             min_p=0.0 if self.min_p is None else self.min_p,
                             max_tokens=self.max_completion_length,
                             guided_decoding_regex=self.guided_decoding_regex,
+                            return_logprobs=self.use_vllm_logprobs,
                         )
+                    completion_logprobs, ref_logprobs = None, None
+                    if self.use_vllm_logprobs:
+                        completion_ids, completion_logprobs = completion_ids
+                    if self.use_vllm_ref_model:
+                        with profiling_context(self, "vLLM.score"):
+                            ref_logprobs = self._score_with_vllm_ref_model(all_prompt_token_ids, completion_ids)
                 else:
-                    completion_ids = [None] * len(all_prompts_text)
-                # Broadcast the completions from the main process to all processes, ensuring each process receives its
+                    completion_ids, completion_logprobs, ref_logprobs = None, None, None
+                # Scatter the completions from the main process to all processes, ensuring each process receives its
                 # corresponding slice.
-                completion_ids = broadcast_object_list(completion_ids, from_process=0)
-                process_slice = slice(
-                    self.accelerator.process_index * len(prompts),
-                    (self.accelerator.process_index + 1) * len(prompts),
+                completion_ids, completion_logprobs, ref_logprobs = self._scatter_completions(
+                    len(prompts), completion_ids, completion_logprobs, ref_logprobs
                 )
-                completion_ids = completion_ids[process_slice]
 
             # Generate completions using colocated vLLM instances: each device holds vLLM copy and work on their own batch of prompts
             elif self.vllm_mode == "colocate":
@@ -1186,20 +1978,30 @@ class GRPOTrainer(Trainer):
                     min_p=0.0 if self.min_p is None else self.min_p,
                     max_tokens=self.max_completion_length,
                     guided_decoding=guided_decoding,
+                    logprobs=0 if self.use_vllm_logprobs else None,  # only the log probability of the sampled token
                 )
 
+                # Each completion is generated from its own copy of the prompt
+                prompt_token_ids = [ids for ids, size in zip(prompt_token_ids, group_sizes) for _ in range(size)]
                 if self.vllm_tensor_parallel_size > 1:
                     # Gather prompts from all ranks in the TP group and flatten.
                     # Each rank starts with its own prompts; after gathering, all ranks see the full group set.
-                    orig_size = len(prompts_text)
+                    orig_size = len(prompt_token_ids)
                     gathered_prompts = [None for _ in range(self.vllm_tensor_parallel_size)]
-                    torch.distributed.all_gather_object(gathered_prompts, prompts_text, group=self.tp_group)
-                    prompts_text = [p for sublist in gathered_prompts for p in sublist]
+                    torch.distributed.all_gather_object(gathered_prompts, prompt_token_ids, group=self.tp_group)
+                    prompt_token_ids = [p for sublist in gathered_prompts for p in sublist]
 
+                vllm_prompts = [{"prompt_token_ids": ids} for ids in prompt_token_ids]
                 with profiling_context(self, "vLLM.generate"):
-                    all_outputs = self.llm.generate(prompts_text, sampling_params=sampling_params, use_tqdm=False)
+                    all_outputs = self.llm.generate(vllm_prompts, sampling_params=sampling_params, use_tqdm=False)
 
                 completion_ids = [output.token_ids for outputs in all_outputs for output in outputs.outputs]
+                if self.use_vllm_logprobs:
+                    completion_logprobs = [
+                        [logprobs[token_id].logprob for token_id, logprobs in zip(output.token_ids, output.logprobs)]
+                        for outputs in all_outputs
+                        for output in outputs.outputs
+                    ]
 
                 if self.vllm_tensor_parallel_size > 1:
                     # Slice completions for this rank within its TP group.
@@ -1207,11 +2009,17 @@ class GRPOTrainer(Trainer):
                     local_rank_in_group = torch.distributed.get_rank(group=self.tp_group)
                     tp_slice = slice(local_rank_in_group * orig_size, (local_rank_in_group + 1) * orig_size)
                     completion_ids = completion_ids[tp_slice]
+                    if self.use_vllm_logprobs:
+                        completion_logprobs = completion_logprobs[tp_slice]
+
+            if self.use_vllm_logprobs:
+                # vLLM's log probabilities of the sampled tokens are used as the behavior policy log probabilities
+                old_per_token_logps = [torch.as_tensor(logps, device=device) for logps in completion_logprobs]
+                old_per_token_logps = pad(old_per_token_logps, padding_value=0.0)
 
-            # Pad the completions, and concatenate them with the prompts
-            completion_ids = [torch.tensor(ids, device=device) for ids in completion_ids]
+            # Pad the completions
+            completion_ids = [torch.as_tensor(ids, device=device) for ids in completion_ids]
             completion_ids = pad(completion_ids, padding_value=self.processing_class.pad_token_id)
-            prompt_completion_ids = torch.cat([prompt_ids, completion_ids], dim=1)
         else:
             # Regular generation path
             with unwrap_model_for_generation(
@@ -1246,18 +2054,12 @@ class GRPOTrainer(Trainer):
         # Concatenate prompt_mask with completion_mask for logit computation
         attention_mask = torch.cat([prompt_mask, completion_mask], dim=1)  # (B, P+C)
 
-        logits_to_keep = completion_ids.size(1)  # we only need to compute the logits for the completion tokens
-        batch_size = self.args.per_device_train_batch_size if mode == "train" else self.args.per_device_eval_batch_size
-
-        with torch.no_grad():
-            # When using num_iterations == 1, old_per_token_logps == per_token_logps, so we can skip its
-            # computation here, and use per_token_logps.detach() instead.
-            if self.num_iterations > 1:
-                old_per_token_logps = self._get_per_token_logps(
-                    self.model, prompt_completion_ids, attention_mask, logits_to_keep, batch_size
-                ) # shape (batch_size, logits_to_keep)
-            else:
-                old_per_token_logps = None
+        if self.use_vllm_ref_model:
+            # The reference log probabilities were already computed by the reference model hosted by the vLLM server
+            ref_per_token_logps = [torch.as_tensor(logps, device=device) for logps in ref_logprobs]
+            ref_per_token_logps = pad(ref_per_token_logps, padding_value=0.0)
+        else:
+            ref_per_token_logps = None
 
         # Decode the generated completions
         completions_text = self.processing_class.batch_decode(completion_ids, skip_special_tokens=True)
@@ -1269,34 +2071,12 @@ class GRPOTrainer(Trainer):
         else:
             completions = completions_text
 
-        rewards_per_func = torch.zeros(len(prompts), len(self.reward_funcs), device=device)
-        for i, (reward_func, reward_processing_class, reward_func_name) in enumerate(
-            zip(self.reward_funcs, self.reward_processing_classes, self.reward_func_names)
-        ): # Repeat for each reward function
-            with profiling_context(self, reward_func_name):
-                if isinstance(
-                    reward_func, nn.Module
-                ):  # Module instead of PretrainedModel for compat with compiled models
-                    if is_conversational(inputs[0]):
-                        messages = [{"messages": p + c} for p, c in zip(prompts, completions)]
-                        texts = [apply_chat_template(x, reward_processing_class)["text"] for x in messages]
-                    else:
-                        texts = [p + c for p, c in zip(prompts, completions)]
-                    reward_inputs = reward_processing_class(
-                        text=texts, return_tensors="pt", padding=True, padding_side="right", add_special_tokens=False
-                    )
-                    reward_inputs = super()._prepare_inputs(reward_inputs)
-                    with torch.inference_mode():
-                        rewards_per_func[:, i] = reward_func(**reward_inputs).logits[:, 0]  # Shape (B*G,)
-                else:
-                    # Repeat all input columns (but "prompt" and "completion") to match the number of generations
-                    keys = [key for key in inputs[0] if key not in ["prompt", "completion"]]
-                    reward_kwargs = {key: [example[key] for example in inputs] for key in keys}
-                    output_reward_func = reward_func(prompts=prompts, completions=completions, **reward_kwargs)
-                    # Convert None values to NaN
-                    output_reward_func = [reward if reward is not None else torch.nan for reward in output_reward_func]
-
-                    rewards_per_func[:, i] = torch.tensor(output_reward_func, dtype=torch.float32, device=device)
+        # Repeat all input columns (but "prompt" and "completion") to match the number of generations
+        keys = [key for key in inputs[0] if key not in ["prompt", "completion"]]
+        reward_kwargs = {key: [example[key] for example in inputs] for key in keys}
+        rewards_per_func = self._calculate_rewards(
+            inputs, {"prompts": prompts, "completions": completions, **reward_kwargs}
+        )
 
         # If all reward functions return None for a given row, issue a detailed warning
         if torch.isnan(rewards_per_func).all(dim=1).any():
@@ -1365,32 +2145,138 @@ class GRPOTrainer(Trainer):
             self._metrics[mode][f"rewards/{reward_func_name}/std"].append(std_rewards)
         self._metrics[mode]["reward"].append(mean_grouped_rewards.mean().item())
         self._metrics[mode]["reward_std"].append(std_grouped_rewards.mean().item())
+        is_std_zero = torch.isclose(std_grouped_rewards, torch.zeros_like(std_grouped_rewards))
+        self._metrics[mode]["frac_reward_zero_std"].append(is_std_zero.float().mean().item())
 
         # Log prompt and completion texts
-        self._textual_logs["prompt"].extend(gather_object(prompts_text))
+        self._textual_logs["prompt"].extend(self._gather_groups(prompts_text, group_sizes))
         self._textual_logs["completion"].extend(gather_object(completions_text))
         for i, name in enumerate(self.reward_func_names):
             self._textual_logs["rewards"][name].extend(rewards_per_func[:, i].tolist())
 
-        return {
+        outputs = {
             "prompt_ids": prompt_ids,
             "prompt_mask": prompt_mask,
             "completion_ids": completion_ids,
             "completion_mask": completion_mask,
             "advantages": advantages,
             "old_per_token_logps": old_per_token_logps,
+            "ref_per_token_logps": ref_per_token_logps,
+        }
+        if self.filter_zero_std_groups and mode == "train":
+            # The log probabilities are only computed for the completions that remain
+            outputs = self._filter_zero_std_groups(outputs, is_std_zero)
+
+        prompt_completion_ids = torch.cat([outputs["prompt_ids"], outputs["completion_ids"]], dim=1)
+        attention_mask = torch.cat([outputs["prompt_mask"], outputs["completion_mask"]], dim=1)
+        # We only need to compute the logits for the completion tokens
+        logits_to_keep = outputs["completion_ids"].size(1)
+        batch_size = self.args.per_device_train_batch_size if mode == "train" else self.args.per_device_eval_batch_size
+
+        with torch.no_grad():
+            # When using num_iterations == 1, old_per_token_logps == per_token_logps, so we can skip its
+            # computation here, and use per_token_logps.detach() instead. With `use_vllm_logprobs` (or asynchronous
+            # generation), old_per_token_logps were already returned by vLLM.
+            if self.num_iterations > 1 and outputs["old_per_token_logps"] is None:
+                outputs["old_per_token_logps"] = self._get_per_token_logps(
+                    self.model, prompt_completion_ids, attention_mask, logits_to_keep, batch_size
+                ) # shape (batch_size, logits_to_keep)
+
+            # Compute the reference model log probabilities once per generation batch (unless the vLLM server already
+            # did), they are reused for all the iterations over this batch
+            if self.beta != 0.0 and outputs["ref_per_token_logps"] is None:
+                if self.ref_model is not None:
+                    outputs["ref_per_token_logps"] = self._get_per_token_logps(
+                        self.ref_model, prompt_completion_ids, attention_mask, logits_to_keep, batch_size
+                    )
+                else:
+                    with self.accelerator.unwrap_model(self.model).disable_adapter():
+                        outputs["ref_per_token_logps"] = self._get_per_token_logps(
+                            self.model, prompt_completion_ids, attention_mask, logits_to_keep, batch_size
+                        )
+
+        return outputs
+
+    def _filter_zero_std_groups(
+        self, inputs: dict[str, Optional[torch.Tensor]], is_std_zero: torch.Tensor
+    ) -> dict[str, Optional[torch.Tensor]]:
+        """
+        Drops the completions of the groups whose rewards all have the same value, and redistributes the remaining
+        ones evenly across processes.
+
+        The remaining completions are kept in order, up to the number of completions of one optimization step (the
+        generation batch is `oversampling_factor` times larger). The number of completions per process is rounded down
+        to a multiple of `gradient_accumulation_steps`, and at least one completion per process and accumulation step
+        is kept (taken from the dropped groups if needed), so that all the processes run the same number of forward
+        and backward passes.
+
+        Args:
+            inputs (`dict[str, Optional[torch.Tensor]]`):
+                Local part of the generation batch, with left-padded `"prompt_ids"` and `"prompt_mask"`, right-padded
+                `"completion_ids"`, `"completion_mask"`, `"old_per_token_logps"` and `"ref_per_token_logps"` (the last
+                two can be `None`), and `"advantages"`.
+            is_std_zero (`torch.Tensor`):
+                Boolean tensor of shape `(global_batch_size,)`, `True` for the completions of the groups whose rewards
+                have a zero standard deviation.
+
+        Returns:
+            `dict[str, Optional[torch.Tensor]]`:
+                The same keys, with the completions assigned to this process.
+        """
+        num_processes = self.accelerator.num_processes
+        step_size = num_processes * self.args.gradient_accumulation_steps
+        num_completions = min((~is_std_zero).sum().item(), step_size * self.args.per_device_train_batch_size)
+        num_completions = max(num_completions // step_size * step_size, step_size)
+        if num_completions == len(is_std_zero):
+            return inputs  # nothing to drop
+
+        # The completions with a non-zero advantage come first, in order, then the other ones if needed
+        order = torch.cat([(~is_std_zero).nonzero().squeeze(1), is_std_zero.nonzero().squeeze(1)])
+        num_local = num_completions // num_processes
+        indices = order[:num_completions][self.accelerator.process_index * num_local :][:num_local]
+
+        def select(tensor, padding_value, pad_first=False):
+            if tensor is None:
+                return None
+            if tensor.dim() > 1:
+                tensor = self.accelerator.pad_across_processes(
+                    tensor, dim=1, pad_index=padding_value, pad_first=pad_first
+                )
+            return gather(tensor)[indices]
+
+        pad_token_id = self.processing_class.pad_token_id
+        prompt_mask = select(inputs["prompt_mask"], 0, pad_first=True)
+        completion_mask = select(inputs["completion_mask"], 0)
+        # Remove the padding columns that are no longer needed (completion masks are contiguous from the start)
+        prompt_length = prompt_mask.sum(dim=1).max().item()
+        completion_length = max(completion_mask.sum(dim=1).max().item(), 1)
+        outputs = {
+            "prompt_ids": select(inputs["prompt_ids"], pad_token_id, pad_first=True),
+            "prompt_mask": prompt_mask,
+            "completion_ids": select(inputs["completion_ids"], pad_token_id),
+            "completion_mask": completion_mask,
+            "advantages": select(inputs["advantages"], 0),
+            "old_per_token_logps": select(inputs["old_per_token_logps"], 0.0),
+            "ref_per_token_logps": select(inputs["ref_per_token_logps"], 0.0),
         }
+        for key in ["prompt_ids", "prompt_mask"]:
+            outputs[key] = outputs[key][:, -prompt_length:]
+        for key in ["completion_ids", "completion_mask", "old_per_token_logps", "ref_per_token_logps"]:
+            if outputs[key] is not None:
+                outputs[key] = outputs[key][:, :completion_length]
+        return outputs
 
     def _prepare_conversations(
         self, inputs: list[dict[str, Union[torch.Tensor, Any]]]
     ) -> dict[str, Union[torch.Tensor, Any]]:
         """
-        Process batched multi-turn conversations into aligned tensor representations with appropriate masks.
+        Process batched multi-turn conversations into a padding-free tensor representation with appropriate masks.
 
         This function handles conversations with varying numbers of turns by:
         1. Separating each conversation into prompt-completion turn pairs
-        2. Tokenizing prompts (with LEFT padding) and completions (with RIGHT padding) separately
-        3. Aligning tokens from the same turn positions across all conversations in the batch
+        2. Tokenizing the prompts and completions of all turns separately
+        3. Concatenating the tokens of each conversation contiguously, without padding between turns. Conversations
+           are only right-padded to the length of the longest conversation in the batch
         4. Creating appropriate masks to identify valid completion tokens for loss calculation
 
         Args:
@@ -1418,142 +2304,71 @@ class GRPOTrainer(Trainer):
         Returns:
             dict[str, Union[torch.Tensor, Any]]: Processed conversation representations:
                 - conversation_ids (torch.Tensor): Token IDs for the full conversations, shape (B, L)
-                where B is batch size and L is the total sequence length. All turns are
-                aligned at the same positions across the batch.
+                where B is batch size and L is the length of the longest conversation. The tokens of each
+                conversation are contiguous and right-padded.
                 - completion_mask (torch.Tensor): Boolean mask identifying which tokens belong to
-                completions (assistant responses), shape (B, L). Only tokens corresponding to valid
-                turns for each conversation are marked as True.
+                completions (assistant responses), shape (B, L).
                 - attention_mask (torch.Tensor): Attention mask for the transformer model, shape (B, L),
                 where 1 indicates valid tokens and 0 indicates padding.
+                - position_ids (torch.Tensor): Position of each token in its conversation, shape (B, L).
         """
         batch_size = len(inputs)
         device = self.accelerator.device
 
-        # Find the maximum number of turns across all conversations
-        max_turns = max(len([message for message in spec["messages"] if message["role"] == "assistant"])
-                    for spec in inputs)
-
-        # Process each conversation, separating by turns
-        all_prompt_texts_by_turn = [[] for _ in range(max_turns)]
-        all_completion_texts_by_turn = [[] for _ in range(max_turns)]
-
-        # Track which conversations have which turns
-        turn_presence = torch.zeros((batch_size, max_turns), dtype=torch.bool, device=device)
-
-        for conv_idx, conversation in enumerate(inputs):
-            messages = conversation["messages"]
-
-            # Group messages into turns
+        # Group the messages of each conversation into (prompt, completion) turns: an assistant message is a
+        # completion, and the user/system messages preceding it form its prompt
+        turns_per_conversation = []
+        for conversation in inputs:
             turns = []
             current_prompt = []
-
-            # Process messages to group them into prompt-completion pairs
-            for message in messages:
+            for message in conversation["messages"]:
                 if message["role"] == "assistant":
                     turns.append((current_prompt, [message]))
                     current_prompt = []
                 else:
-                    # User or system messages form the prompt
                     current_prompt.append(message)
-
-            for turn_idx in range(min(len(turns), max_turns)):
-                # Mark this turn as present
-                turn_presence[conv_idx, turn_idx] = True
-
-                # Get prompt and completion for this turn
-                prompt, completion = turns[turn_idx]
-
-                # Apply chat template
-                prompt_dict = {"messages": prompt}
-                completion_dict = {"messages": completion}
-
-                prompt_text = maybe_apply_chat_template(prompt_dict, self.processing_class)["text"]
-                completion_text = maybe_apply_chat_template(completion_dict, self.processing_class)["text"]
-
-                # Add to the appropriate turn lists
-                all_prompt_texts_by_turn[turn_idx].append(prompt_text)
-                all_completion_texts_by_turn[turn_idx].append(completion_text)
-
-            # For remaining turns that this conversation doesn't have, add empty placeholders
-            for turn_idx in range(len(turns), max_turns):
-                # Add empty strings as placeholders
-                all_prompt_texts_by_turn[turn_idx].append("")
-                all_completion_texts_by_turn[turn_idx].append("")
-
-        # Process each turn separately and collect tensors
-        prompt_ids_by_turn = []
-        prompt_mask_by_turn = []
-        completion_ids_by_turn = []
-        completion_mask_by_turn = []
-
-        for turn_idx in range(max_turns):
-            # Tokenize all prompts and completions for this turn
-            prompt_inputs = self.processing_class(
-                all_prompt_texts_by_turn[turn_idx],
-                return_tensors="pt",
-                padding=True,
-                padding_side="left",
-                add_special_tokens=True,
-            )
-
-            completion_inputs = self.processing_class(
-                all_completion_texts_by_turn[turn_idx],
-                return_tensors="pt",
-                padding=True,
-                padding_side="right",
-                add_special_tokens=True,
-            )
-
-            # Store the IDs and masks
-            prompt_ids_by_turn.append(prompt_inputs["input_ids"])
-            prompt_mask_by_turn.append(prompt_inputs["attention_mask"])
-            completion_ids_by_turn.append(completion_inputs["input_ids"])
-            completion_mask_by_turn.append(completion_inputs["attention_mask"])
-
-        # Determine the sizes for full tensors
-        turn_prompt_lengths = [ids.size(1) for ids in prompt_ids_by_turn]
-        turn_completion_lengths = [ids.size(1) for ids in completion_ids_by_turn]
-
-        total_prompt_length = sum(turn_prompt_lengths)
-        total_completion_length = sum(turn_completion_lengths)
-        total_length = total_prompt_length + total_completion_length
-
-        # Create full tensors with proper alignment
-        conversation_ids = torch.zeros((batch_size, total_length), dtype=torch.long, device=device)
-        attention_mask = torch.zeros((batch_size, total_length), dtype=torch.long, device=device)
-        completion_mask = torch.zeros((batch_size, total_length), dtype=torch.bool, device=device)
-
-        # Track positions for each turn
-        current_pos = 0
-
-        # Fill tensors for each turn
-        for turn_idx in range(max_turns):
-            p_length = turn_prompt_lengths[turn_idx]
-            c_length = turn_completion_lengths[turn_idx]
-
-            # Fill prompt section
-            prompt_end_pos = current_pos + p_length
-            conversation_ids[:, current_pos:prompt_end_pos] = prompt_ids_by_turn[turn_idx]
-            attention_mask[:, current_pos:prompt_end_pos] = prompt_mask_by_turn[turn_idx]
-
-            current_pos = prompt_end_pos
-
-            # Fill completion section
-            completion_end_pos = current_pos + c_length
-            conversation_ids[:, current_pos:completion_end_pos] = completion_ids_by_turn[turn_idx]
-            attention_mask[:, current_pos:completion_end_pos] = completion_mask_by_turn[turn_idx]
-
-            # Set completion mask for valid turns only
-            for b in range(batch_size):
-                if turn_presence[b, turn_idx]:
-                    completion_mask[b, current_pos:completion_end_pos] = completion_mask_by_turn[turn_idx][b].bool()
-
-            current_pos = completion_end_pos
+            turns_per_conversation.append(turns)
+        num_segments = torch.tensor([2 * len(turns) for turns in turns_per_conversation], device=device)
+
+        # Template and tokenize all the segments at once, in the order (conversation, turn, prompt/completion)
+        segments = [messages for turns in turns_per_conversation for turn in turns for messages in turn]
+        non_empty_segments = [messages for messages in segments if messages]
+        templated = iter(
+            self.processing_class.apply_chat_template(non_empty_segments, tokenize=False) if non_empty_segments else []
+        )
+        templated = [next(templated) if messages else "" for messages in segments]
+        segment_ids = self.processing_class(text=templated, add_special_tokens=True)["input_ids"]
+
+        # Concatenate the segments of each conversation, then scatter each token to its (row, column). Since every
+        # conversation has an even number of segments, odd segment indices are completions.
+        segment_lengths = torch.tensor([len(ids) for ids in segment_ids], dtype=torch.long, device=device)
+        segment_row = torch.repeat_interleave(torch.arange(batch_size, device=device), num_segments)
+        sequence_lengths = torch.zeros(batch_size, dtype=torch.long, device=device)
+        sequence_lengths.index_add_(0, segment_row, segment_lengths)
+        max_length = sequence_lengths.max().item()
+
+        token_ids = torch.tensor(list(chain.from_iterable(segment_ids)), dtype=torch.long, device=device)
+        token_segment = torch.repeat_interleave(torch.arange(len(segment_ids), device=device), segment_lengths)
+        token_row = segment_row[token_segment]
+        sequence_starts = torch.cumsum(sequence_lengths, dim=0) - sequence_lengths
+        token_column = torch.arange(len(token_ids), device=device) - sequence_starts[token_row]
+
+        conversation_ids = torch.full(
+            (batch_size, max_length), self.processing_class.pad_token_id, dtype=torch.long, device=device
+        )
+        attention_mask = torch.zeros((batch_size, max_length), dtype=torch.long, device=device)
+        completion_mask = torch.zeros((batch_size, max_length), dtype=torch.bool, device=device)
+        conversation_ids[token_row, token_column] = token_ids
+        attention_mask[token_row, token_column] = 1
+        # The first token of a conversation has no context to be predicted from, so it's never trained on
+        completion_mask[token_row, token_column] = (token_segment % 2 == 1) & (token_column > 0)
+        position_ids = torch.arange(max_length, device=device).expand(batch_size, -1)
 
         return {
             "conversation_ids": conversation_ids,
             "attention_mask": attention_mask,
             "completion_mask": completion_mask,
+            "position_ids": position_ids,
         }
 
     def _generate_and_score_conversations(
@@ -1616,15 +2431,15 @@ class GRPOTrainer(Trainer):
         conversation_ids = conversation_data["conversation_ids"]
         attention_mask = conversation_data["attention_mask"]
         completion_mask = conversation_data["completion_mask"]
-        logits_to_keep_mask = torch.any(completion_mask, dim=0) # shape (L,)
+        position_ids = conversation_data["position_ids"]
 
         with torch.no_grad():
             # When using num_iterations == 1, old_per_token_logps == per_token_logps, so we can skip it's
             # computation here, and use per_token_logps.detach() instead.
             if self.num_iterations > 1:
                 old_per_token_logps = self._get_per_token_logps(
-                    self.model, conversation_ids, attention_mask, logits_to_keep_mask, batch_size
-                ) # shape (batch_size, logits_to_keep)
+                    self.model, conversation_ids, attention_mask, completion_mask, batch_size, position_ids
+                )  # shape (B, L)
             else:
                 old_per_token_logps = None
 
@@ -1633,28 +2448,19 @@ class GRPOTrainer(Trainer):
                 ref_per_token_logps = None
             elif self.ref_model is not None:
                 ref_per_token_logps = self._get_per_token_logps(
-                    self.ref_model, conversation_ids, attention_mask, logits_to_keep_mask, batch_size
+                    self.ref_model, conversation_ids, attention_mask, completion_mask, batch_size, position_ids
                 )
             else:
                 # If PEFT is used, disable adapter to get reference model probabilities
                 with self.accelerator.unwrap_model(self.model).disable_adapter():
                     ref_per_token_logps = self._get_per_token_logps(
-                        self.model, conversation_ids, attention_mask, logits_to_keep_mask, batch_size
+                        self.model, conversation_ids, attention_mask, completion_mask, batch_size, position_ids
                     )
 
-        rewards_per_func = torch.zeros(len(conversations), len(self.reward_funcs), device=device)
-        for i, (reward_func, reward_processing_class, reward_func_name) in enumerate(
-            zip(self.reward_funcs, self.reward_processing_classes, self.reward_func_names)
-        ): # Repeat for each reward function
-            with profiling_context(self, reward_func_name):
-                # Repeat all input columns (but "messages") to match the number of generations
-                keys = [key for key in inputs[0] if key not in ["messages"]]
-                reward_kwargs = {key: [example[key] for example in inputs] for key in keys}
-                output_reward_func = reward_func(conversations=conversations, **reward_kwargs)
-                # Convert None values to NaN
-                output_reward_func = [reward if reward is not None else torch.nan for reward in output_reward_func]
-
-                rewards_per_func[:, i] = torch.tensor(output_reward_func, dtype=torch.float32, device=device)
+        # Repeat all input columns (but "messages") to match the number of generations
+        keys = [key for key in inputs[0] if key not in ["messages"]]
+        reward_kwargs = {key: [example[key] for example in inputs] for key in keys}
+        rewards_per_func = self._calculate_rewards(inputs, {"conversations": conversations, **reward_kwargs})
 
         # Gather the reward per function: this part is crucial, because the rewards are normalized per group and the
         # completions may be distributed across processes
@@ -1681,10 +2487,6 @@ class GRPOTrainer(Trainer):
         )
         advantages = advantages[process_slice]
 
-        logits_to_keep_mask = logits_to_keep_mask.expand(
-            (conversation_ids.size(0), logits_to_keep_mask.size(0))
-        ) # shape (B, L)
-
         # Log the metrics
         if mode == "train":
             self.state.num_input_tokens_seen += self.accelerator.gather_for_metrics(attention_mask.sum()).sum().item()
@@ -1714,7 +2516,7 @@ class GRPOTrainer(Trainer):
             "conversation_ids": conversation_ids,
             "attention_mask": attention_mask,
             "completion_mask": completion_mask,
-            "logits_to_keep_mask": logits_to_keep_mask,
+            "position_ids": position_ids,
             "advantages": advantages,
             "old_per_token_logps": old_per_token_logps,
             "ref_per_token_logps": ref_per_token_logps,
@@ -1728,20 +2530,6 @@ class GRPOTrainer(Trainer):
         attention_mask = torch.cat([prompt_mask, completion_mask], dim=1)
         logits_to_keep = completion_ids.size(1)  # we only need to compute the logits for the completion tokens
 
-        # Compute the KL divergence between the model and the reference model
-        ref_per_token_logps = None
-        if self.beta != 0.0:
-            with torch.no_grad():
-                if self.ref_model is not None:
-                    ref_per_token_logps = self._get_per_token_logps(
-                        self.ref_model, input_ids, attention_mask, logits_to_keep
-                    )
-                else:
-                    with self.accelerator.unwrap_model(self.model).disable_adapter():
-                        ref_per_token_logps = self._get_per_token_logps(
-                            self.model, input_ids, attention_mask, logits_to_keep
-                        )
-
         # get the last hidden state of the model
         last_hidden_state = self._get_last_hidden_state(unwrapped_model, input_ids, attention_mask, logits_to_keep)
 
@@ -1754,7 +2542,7 @@ class GRPOTrainer(Trainer):
             advantages=inputs["advantages"],
             bias=unwrapped_model.lm_head.bias,
             old_per_token_logps=inputs["old_per_token_logps"],
-            ref_per_token_logps=ref_per_token_logps,
+            ref_per_token_logps=inputs["ref_per_token_logps"],
         )
         # Extract metrics from the liger_grpo_loss output
         # KL divergence is the first metric when beta is non-zero
@@ -1767,6 +2555,13 @@ class GRPOTrainer(Trainer):
         self._metrics[mode]["clip_ratio"].append(self.accelerator.gather_for_metrics(clip_ratio).mean().item())
         return loss
 
+    def train(self, *args, **kwargs):
+        try:
+            return super().train(*args, **kwargs)
+        finally:
+            # The executors are created again if needed, e.g., for a later evaluation
+            self._shutdown_reward_executors()
+
     @profiling_decorator
     def compute_loss(self, model, inputs, return_outputs=False, num_items_in_batch=None):
         if return_outputs:
@@ -1791,16 +2586,7 @@ class GRPOTrainer(Trainer):
 
             # Compute the KL divergence between the model and the reference model
             if self.beta != 0.0:
-                with torch.no_grad():
-                    if self.ref_model is not None:
-                        ref_per_token_logps = self._get_per_token_logps(
-                            self.ref_model, input_ids, attention_mask, logits_to_keep
-                        )
-                    else:
-                        with self.accelerator.unwrap_model(self.model).disable_adapter():
-                            ref_per_token_logps = self._get_per_token_logps(
-                                self.model, input_ids, attention_mask, logits_to_keep
-                            )
+                ref_per_token_logps = inputs["ref_per_token_logps"]
                 per_token_kl = (
                     torch.exp(ref_per_token_logps - per_token_logps) - (ref_per_token_logps - per_token_logps) - 1
                 )
@@ -1809,7 +2595,11 @@ class GRPOTrainer(Trainer):
             advantages = inputs["advantages"]
             # When using num_iterations == 1, old_per_token_logps == per_token_logps, so we can skip it's computation (see
             # _generate_and_score_completions) and use per_token_logps.detach() instead.
-            old_per_token_logps = inputs["old_per_token_logps"] if self.num_iterations > 1 else per_token_logps.detach()
+            old_per_token_logps = (
+                inputs["old_per_token_logps"]
+                if inputs["old_per_token_logps"] is not None
+                else per_token_logps.detach()
+            )
             coef_1 = torch.exp(per_token_logps - old_per_token_logps)
             coef_2 = torch.clamp(coef_1, 1 - self.epsilon_low, 1 + self.epsilon_high)
             per_token_loss1 = coef_1 * advantages.unsqueeze(1)
@@ -1826,14 +2616,31 @@ class GRPOTrainer(Trainer):
                 loss = (per_token_loss * completion_mask).sum() / (per_token_loss.size(0) * self.max_completion_length)
             else:
                 raise ValueError(f"Unknown loss type: {self.loss_type}")
+
+            # Compare vLLM's log probabilities with the trainer's ones, before the policy is updated on this batch
+            mode = "train" if self.model.training else "eval"
+            generate_every = self.args.gradient_accumulation_steps * self.num_iterations
+            is_first_iteration = (
+                mode == "eval" or (self._step - 1) % generate_every < self.args.gradient_accumulation_steps
+            )
+            if self.use_vllm_logprobs and inputs["old_per_token_logps"] is not None and is_first_iteration:
+                logprob_diff = (per_token_logps.detach() - inputs["old_per_token_logps"]).abs()
+                mask = completion_mask.bool()
+                mean_logprob_diff = logprob_diff[mask].sum() / mask.sum().clamp(min=1.0)
+                max_logprob_diff = logprob_diff[mask].max() if mask.any() else logprob_diff.new_zeros(())
+                mean_logprob_diff = self.accelerator.gather_for_metrics(mean_logprob_diff)
+                max_logprob_diff = self.accelerator.gather_for_metrics(max_logprob_diff)
+                self._metrics[mode]["vllm_logprob_diff/mean"].append(mean_logprob_diff.nanmean().item())
+                self._metrics[mode]["vllm_logprob_diff/max"].append(nanmax(max_logprob_diff).item())
         else:
             input_ids = inputs["conversation_ids"]
             completion_mask = inputs["completion_mask"] # shape (B, L)
             attention_mask = inputs["attention_mask"] # shape (B, L)
-            logits_to_keep_mask = inputs["logits_to_keep_mask"] # shape (B, L)
-            logits_to_keep_mask = logits_to_keep_mask[0] # shape (L,)
+            position_ids = inputs["position_ids"] # shape (B, L)
 
-            per_token_logps = self._get_per_token_logps(model, input_ids, attention_mask, logits_to_keep_mask) # shape (batch_size, length_of_logits_to_keep), and the length is the same as completion_mask
+            per_token_logps = self._get_per_token_logps(
+                model, input_ids, attention_mask, completion_mask, position_ids=position_ids
+            )  # shape (B, L), aligned with input_ids
 
             # Compute the KL divergence between the model and the reference model
             if self.beta != 0.0:
@@ -1847,17 +2654,14 @@ class GRPOTrainer(Trainer):
             # When using num_iterations == 1, old_per_token_logps == per_token_logps, so we can skip it's computation (see
             # _generate_and_score_completions) and use per_token_logps.detach() instead.
             old_per_token_logps = inputs["old_per_token_logps"] if self.num_iterations > 1 else per_token_logps.detach()
-            coef_1 = torch.exp(per_token_logps - old_per_token_logps) # shape (batch_size, length_of_logits_to_keep)
+            coef_1 = torch.exp(per_token_logps - old_per_token_logps) # shape (B, L)
             coef_2 = torch.clamp(coef_1, 1 - self.epsilon_low, 1 + self.epsilon_high)
-            per_token_loss1 = coef_1 * advantages.unsqueeze(1) # shape (batch_size, length_of_logits_to_keep)
+            per_token_loss1 = coef_1 * advantages.unsqueeze(1) # shape (B, L)
             per_token_loss2 = coef_2 * advantages.unsqueeze(1)
-            per_token_loss = -torch.min(per_token_loss1, per_token_loss2) # shape (batch_size, length_of_logits_to_keep)
+            per_token_loss = -torch.min(per_token_loss1, per_token_loss2) # shape (B, L)
             if self.beta != 0.0:
                 per_token_loss = per_token_loss + self.beta * per_token_kl
 
-            # We only need to compute the loss for the completion tokens
-            completion_mask = completion_mask[:, logits_to_keep_mask] # shape (B, length_of_logits_to_keep)
-
             if self.loss_type == "grpo":
                 loss = ((per_token_loss * completion_mask).sum(-1) / completion_mask.sum(-1).clamp(min=1.0)).mean()
             elif self.loss_type == "bnpo":
@@ -70,6 +70,11 @@ class OnlineDPOConfig(TrainingArguments):
             This setting applies to DeepSpeed ZeRO-3. If enabled, the policy model weights are gathered for generation,
             improving generation speed. However, disabling this option allows training models that exceed the VRAM
             capacity of a single GPU, albeit at the cost of slower generation.
+        logprob_max_batch_tokens (`int` or `None`, *optional*, defaults to `None`):
+            If set, the log probabilities of the completions are computed with the sequences sorted by length and
+            grouped into micro-batches of at most this many tokens, padding included, each trimmed to its own longest
+            sequence. The log probabilities of the padding tokens are then 0. If `None`, all the sequences are
+            processed in a single forward pass. Not supported with DeepSpeed ZeRO-3 or FSDP.
     """
 
     learning_rate: float = field(
@@ -160,6 +165,15 @@ class OnlineDPOConfig(TrainingArguments):
             "exceed the VRAM capacity of a single GPU, albeit at the cost of slower generation."
         },
     )
+    logprob_max_batch_tokens: Optional[int] = field(
+        default=None,
+        metadata={
+            "help": "If set, the log probabilities of the completions are computed with the sequences sorted by "
+            "length and grouped into micro-batches of at most this many tokens, padding included, each trimmed to "
+            "its own longest sequence. The log probabilities of the padding tokens are then 0. If `None`, all the "
+            "sequences are processed in a single forward pass. Not supported with DeepSpeed ZeRO-3 or FSDP."
+        },
+    )
 
     def __post_init__(self):
         super().__post_init__()
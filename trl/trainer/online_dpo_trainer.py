@@ -42,6 +42,7 @@ from transformers import (
     is_apex_available,
     is_wandb_available,
 )
+from transformers.integrations.deepspeed import is_deepspeed_zero3_enabled
 from transformers.trainer_utils import PREFIX_CHECKPOINT_DIR, EvalPrediction, seed_worker
 from transformers.training_args import OptimizerNames
 from transformers.utils import is_peft_available, is_sagemaker_mp_enabled, logging
@@ -57,10 +58,12 @@ from .utils import (
     DPODataCollatorWithPadding,
     disable_dropout_in_model,
     empty_cache,
+    first_true_indices,
     generate_model_card,
     get_comet_experiment_url,
     get_reward,
     prepare_deepspeed,
+    split_by_token_budget,
     truncate_right,
 )
 
@@ -314,6 +317,13 @@ class OnlineDPOTrainer(Trainer):
 
         self._beta = args.beta
 
+        if args.logprob_max_batch_tokens is not None and (is_deepspeed_zero3_enabled() or self.is_fsdp_enabled):
+            raise ValueError(
+                "`logprob_max_batch_tokens` is not supported with DeepSpeed ZeRO-3 or FSDP: the number of "
+                "micro-batches depends on the sequence lengths of each process, and every forward pass gathers the "
+                "sharded parameters, so the processes would wait for each other forever."
+            )
+
         # Placed after the super().__init__ because we need self.is_deepspeed_enabled and self.accelerator
         if self.is_deepspeed_enabled:
             if self.reward_model is not None:
@@ -500,6 +510,11 @@ class OnlineDPOTrainer(Trainer):
         prompt_ids = prompt_ids[:, num_tokens_to_truncate:]
         prompt_mask = prompt_mask[:, num_tokens_to_truncate:]
 
+        if self.args.logprob_max_batch_tokens is not None:
+            return self._forward_by_token_budget(model, prompt_ids, prompt_mask, completion_ids, completion_mask)
+        return self._forward_batch(model, prompt_ids, prompt_mask, completion_ids, completion_mask)
+
+    def _forward_batch(self, model, prompt_ids, prompt_mask, completion_ids, completion_mask):
         # Concat the prompt and completion
         prompt_completion_ids = torch.cat((prompt_ids, completion_ids), dim=1)
         prompt_completion_mask = torch.cat((prompt_mask, completion_mask), dim=1)
@@ -514,6 +529,30 @@ class OnlineDPOTrainer(Trainer):
         logprobs = torch.take_along_dim(logits.log_softmax(dim=-1), completion_ids.unsqueeze(-1), dim=2).squeeze(-1)
         return logprobs
 
+    def _forward_by_token_budget(self, model, prompt_ids, prompt_mask, completion_ids, completion_mask):
+        # Sort the sequences by length and group them into micro-batches of at most `logprob_max_batch_tokens` tokens,
+        # each trimmed to its longest prompt (left-padded) and completion (right-padded). The log probabilities of the
+        # padding tokens are 0.
+        prompt_length = prompt_ids.size(1)
+        prompt_lengths = (prompt_length - first_true_indices(prompt_mask.bool())).clamp(min=1)
+        completion_lengths = completion_mask.sum(dim=1).clamp(min=1)
+        lengths = torch.stack([prompt_lengths, completion_lengths], dim=1)
+
+        logprobs = None
+        for rows in split_by_token_budget(lengths, self.args.logprob_max_batch_tokens):
+            batch_prompt_length, batch_completion_length = lengths[rows].max(dim=0).values.tolist()
+            batch_logprobs = self._forward_batch(
+                model,
+                prompt_ids[rows, prompt_length - batch_prompt_length :],
+                prompt_mask[rows, prompt_length - batch_prompt_length :],
+                completion_ids[rows, :batch_completion_length],
+                completion_mask[rows, :batch_completion_length],
+            )
+            if logprobs is None:
+                logprobs = batch_logprobs.new_zeros(completion_ids.shape)
+            logprobs[rows, :batch_completion_length] = batch_logprobs
+        return logprobs * completion_mask
+
     def training_step(
         self, model: nn.Module, inputs: dict[str, Union[torch.Tensor, Any]], num_items_in_batch: Optional[int] = None
     ) -> torch.Tensor:
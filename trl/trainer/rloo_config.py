@@ -14,6 +14,7 @@
 
 import os
 from dataclasses import dataclass, field
+from typing import Optional
 
 from ..trainer.utils import OnPolicyConfig
 
@@ -54,6 +55,11 @@ class RLOOConfig(OnPolicyConfig):
             This setting applies to DeepSpeed ZeRO-3. If enabled, the policy model weights are gathered for generation,
             improving generation speed. However, disabling this option allows training models that exceed the VRAM
             capacity of a single GPU, albeit at the cost of slower generation.
+        logprob_max_batch_tokens (`int` or `None`, *optional*, defaults to `None`):
+            If set, the reference log probabilities are computed with the sequences sorted by length and grouped into
+            micro-batches of at most this many tokens, padding included, each trimmed to its own longest sequence. If
+            `None`, they are computed `local_rollout_forward_batch_size` sequences at a time. Not supported with
+            DeepSpeed ZeRO-3 or FSDP.
     """
 
     exp_name: str = field(
@@ -108,3 +114,12 @@ class RLOOConfig(OnPolicyConfig):
             "exceed the VRAM capacity of a single GPU, albeit at the cost of slower generation."
         },
     )
+    logprob_max_batch_tokens: Optional[int] = field(
+        default=None,
+        metadata={
+            "help": "If set, the reference log probabilities are computed with the sequences sorted by length and "
+            "grouped into micro-batches of at most this many tokens, padding included, each trimmed to its own "
+            "longest sequence. If `None`, they are computed `local_rollout_forward_batch_size` sequences at a time. "
+            "Not supported with DeepSpeed ZeRO-3 or FSDP."
+        },
+    )
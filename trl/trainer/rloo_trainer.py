@@ -41,6 +41,7 @@ from transformers import (
     is_wandb_available,
 )
 from transformers.integrations import get_reporting_integration_callbacks
+from transformers.integrations.deepspeed import is_deepspeed_zero3_enabled
 from transformers.trainer import DEFAULT_CALLBACKS, DEFAULT_PROGRESS_CALLBACK
 from transformers.trainer_callback import CallbackHandler, ExportableState, PrinterCallback
 from transformers.utils import is_rich_available
@@ -57,6 +58,7 @@ from ..trainer.utils import (
     prepare_deepspeed,
     print_rich_table,
     selective_log_softmax,
+    split_by_token_budget,
     truncate_response,
 )
 from .rloo_config import RLOOConfig
@@ -184,6 +186,12 @@ class RLOOTrainer(Trainer):
         self.hp_search_backend = None
         self.is_deepspeed_enabled = getattr(self.accelerator.state, "deepspeed_plugin", None) is not None
         self.is_fsdp_enabled = getattr(self.accelerator.state, "fsdp_plugin", None) is not None
+        if args.logprob_max_batch_tokens is not None and (is_deepspeed_zero3_enabled() or self.is_fsdp_enabled):
+            raise ValueError(
+                "`logprob_max_batch_tokens` is not supported with DeepSpeed ZeRO-3 or FSDP: the number of "
+                "micro-batches depends on the sequence lengths of each process, and every forward pass gathers the "
+                "sharded parameters, so the processes would wait for each other forever."
+            )
         # Create distant repo and output directory if needed
         self.hub_model_id = None
         if self.args.push_to_hub:
@@ -325,6 +333,11 @@ class RLOOTrainer(Trainer):
                         generation_config,
                     )
 
+                if args.logprob_max_batch_tokens is not None:
+                    # Compute the reference log probabilities of all the responses at once, in micro-batches of
+                    # similar lengths, instead of `local_rollout_forward_batch_size` rows at a time
+                    all_ref_logprobs = self._get_ref_logprobs_by_token_budget(query_responses, context_length)
+
                 # Process responses in batches
                 for i in range(0, queries.shape[0], args.local_rollout_forward_batch_size):
                     query = queries[i : i + args.local_rollout_forward_batch_size]
@@ -335,12 +348,15 @@ class RLOOTrainer(Trainer):
                     del logits
                     torch.cuda.empty_cache()
 
-                    ref_output = forward(ref_policy, query_response, processing_class.pad_token_id)
-                    ref_logits = ref_output.logits[:, context_length - 1 : -1]
-                    ref_logits /= args.temperature + 1e-7
-                    ref_logprob = selective_log_softmax(ref_logits, response)
-                    del ref_output, ref_logits
-                    torch.cuda.empty_cache()
+                    if args.logprob_max_batch_tokens is not None:
+                        ref_logprob = all_ref_logprobs[i : i + args.local_rollout_forward_batch_size]
+                    else:
+                        ref_output = forward(ref_policy, query_response, processing_class.pad_token_id)
+                        ref_logits = ref_output.logits[:, context_length - 1 : -1]
+                        ref_logits /= args.temperature + 1e-7
+                        ref_logprob = selective_log_softmax(ref_logits, response)
+                        del ref_output, ref_logits
+                        torch.cuda.empty_cache()
 
                     # Response Processing 1. truncate response after the first occurrence of `stop_token_id`
                     postprocessed_response = response
@@ -564,6 +580,36 @@ class RLOOTrainer(Trainer):
             self._save_checkpoint(model, trial=None, metrics=None)
             self.control = self.callback_handler.on_save(self.args, self.state, self.control)
 
+    @torch.no_grad()
+    def _get_ref_logprobs_by_token_budget(self, query_responses: torch.Tensor, context_length: int) -> torch.Tensor:
+        """
+        Compute the reference log probabilities of the responses. The rows are sorted by length and grouped into
+        micro-batches of at most `logprob_max_batch_tokens` tokens, each trimmed to its longest query and response.
+        """
+        pad_token_id = self.processing_class.pad_token_id
+        response_length = query_responses.size(1) - context_length
+        not_pad = query_responses != pad_token_id
+        # Queries are left-padded and responses right-padded
+        query_lengths = (context_length - first_true_indices(not_pad[:, :context_length])).clamp(min=1)
+        response_lengths = (response_length - first_true_indices(not_pad[:, context_length:].fliplr())).clamp(min=1)
+        lengths = torch.stack([query_lengths, response_lengths], dim=1)
+
+        ref_logprobs = None
+        for rows in split_by_token_budget(lengths, self.args.logprob_max_batch_tokens):
+            batch_query_length, batch_response_length = lengths[rows].max(dim=0).values.tolist()
+            columns = slice(context_length - batch_query_length, context_length + batch_response_length)
+            query_response = query_responses[rows, columns]
+            ref_output = forward(self.ref_policy, query_response, pad_token_id)
+            ref_logits = ref_output.logits[:, batch_query_length - 1 : -1]
+            ref_logits /= self.args.temperature + 1e-7
+            ref_logprob = selective_log_softmax(ref_logits, query_response[:, batch_query_length:])
+            if ref_logprobs is None:
+                ref_logprobs = ref_logprob.new_zeros(query_responses.size(0), response_length)
+            ref_logprobs[rows, :batch_response_length] = ref_logprob
+            del ref_output, ref_logits
+            torch.cuda.empty_cache()
+        return ref_logprobs
+
     def generate_completions(self, sampling: bool = False):
         args = self.args
         processing_class = self.processing_class
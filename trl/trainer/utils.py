@@ -1684,6 +1684,76 @@ def flush_left(mask: torch.Tensor, *tensors: torch.Tensor) -> tuple[torch.Tensor
         return mask, *tensors
 
 
+def group_consecutive(items: list) -> tuple[list[int], list[int]]:
+    """
+    Find the runs of consecutive equal items, such as the `num_generations` copies of a prompt yielded in a row by the
+    sampler. A run that is split across processes is only seen partially by each of them.
+
+    Args:
+        items (`list`):
+            Items to group. They only need to support `!=`.
+
+    Returns:
+        `tuple[list[int], list[int]]`:
+            Index of the first item of each group, and number of items of each group.
+
+    Example:
+    ```python
+    >>> group_consecutive(["a", "a", "b", "c", "c", "c"])
+    ([0, 2, 3], [2, 1, 3])
+    ```
+    """
+    starts = [i for i in range(len(items)) if i == 0 or items[i] != items[i - 1]]
+    sizes = [end - start for start, end in zip(starts, starts[1:] + [len(items)])]
+    return starts, sizes
+
+
+def split_by_token_budget(lengths: torch.Tensor, max_tokens: int) -> list[torch.Tensor]:
+    """
+    Group the rows of a padded batch into micro-batches of rows with similar lengths, such that each micro-batch, once
+    trimmed to its own longest row, holds at most `max_tokens` tokens (padding included).
+
+    Rows are sorted by decreasing length and added greedily to the current micro-batch until the budget is exceeded. A
+    row longer than `max_tokens` gets a micro-batch of its own.
+
+    Args:
+        lengths (`torch.Tensor`):
+            Length of each row, without padding. Either a 1D tensor of shape `(N,)`, or a 2D tensor of shape `(N, S)`
+            when the rows are made of `S` segments that are padded separately (for example, a left-padded prompt
+            followed by a right-padded completion). In the latter case, the padded length of a micro-batch is the sum
+            over the segments of their longest length.
+        max_tokens (`int`):
+            Maximum number of tokens (rows times padded length) of each micro-batch.
+
+    Returns:
+        `list[torch.Tensor]`:
+            Indices of the rows of each micro-batch.
+
+    Example:
+    ```python
+    >>> split_by_token_budget(torch.tensor([3, 8, 2, 5]), max_tokens=10)
+    [tensor([1]), tensor([3, 0]), tensor([2])]
+    ```
+    """
+    if lengths.dim() == 1:
+        lengths = lengths.unsqueeze(1)
+    order = torch.argsort(lengths.sum(dim=1), descending=True, stable=True)
+    sorted_lengths = lengths[order].tolist()
+
+    micro_batches = []
+    start = 0
+    max_lengths = sorted_lengths[0] if sorted_lengths else []
+    for i in range(1, len(sorted_lengths)):
+        new_max_lengths = [max(a, b) for a, b in zip(max_lengths, sorted_lengths[i])]
+        if (i - start + 1) * sum(new_max_lengths) > max_tokens:
+            micro_batches.append(order[start:i])
+            start, new_max_lengths = i, sorted_lengths[i]
+        max_lengths = new_max_lengths
+    if sorted_lengths:
+        micro_batches.append(order[start:])
+    return micro_batches
+
+
 def selective_log_softmax(logits, index):
     """
     A memory-efficient implementation of the common `log_softmax -> gather` operation.
@@ -1719,6 +1789,98 @@ def selective_log_softmax(logits, index):
     return per_token_logps
 
 
+class _FusedSelectiveLogSoftmax(torch.autograd.Function):
+    # Logits are computed one chunk of rows at a time, in (at least) float32, and are never stored: the forward only
+    # keeps the logsumexp of each row, and the backward recomputes the logits of each chunk to get the softmax.
+    @staticmethod
+    def forward(ctx, hidden_states, weight, bias, index, temperature, chunk_size):
+        dtype = torch.promote_types(hidden_states.dtype, torch.float32)
+        per_token_logps = torch.empty(hidden_states.size(0), dtype=dtype, device=hidden_states.device)
+        logsumexp_values = torch.empty_like(per_token_logps)
+        for start in range(0, hidden_states.size(0), chunk_size):
+            end = start + chunk_size
+            logits = F.linear(hidden_states[start:end], weight, bias).to(dtype) / temperature
+            logsumexp_values[start:end] = torch.logsumexp(logits, dim=-1)
+            selected_logits = torch.gather(logits, dim=-1, index=index[start:end].unsqueeze(-1)).squeeze(-1)
+            per_token_logps[start:end] = selected_logits - logsumexp_values[start:end]
+        ctx.save_for_backward(hidden_states, weight, bias, index, logsumexp_values)
+        ctx.temperature = temperature
+        ctx.chunk_size = chunk_size
+        return per_token_logps
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        hidden_states, weight, bias, index, logsumexp_values = ctx.saved_tensors
+        needs_hidden_grad, needs_weight_grad, needs_bias_grad = ctx.needs_input_grad[:3]
+        grad_hidden_states = torch.empty_like(hidden_states) if needs_hidden_grad else None
+        dtype = logsumexp_values.dtype
+        grad_weight = torch.zeros_like(weight, dtype=dtype) if needs_weight_grad else None
+        grad_bias = torch.zeros_like(bias, dtype=dtype) if needs_bias_grad else None
+        for start in range(0, hidden_states.size(0), ctx.chunk_size):
+            end = start + ctx.chunk_size
+            hidden_states_chunk = hidden_states[start:end]
+            logits = F.linear(hidden_states_chunk, weight, bias).to(dtype) / ctx.temperature
+            # d(logp_i)/d(logits) = onehot(i) - softmax(logits), and the logits are divided by the temperature
+            grad_logits = -torch.exp(logits - logsumexp_values[start:end].unsqueeze(-1))
+            grad_logits.scatter_add_(-1, index[start:end].unsqueeze(-1), torch.ones_like(grad_logits[:, :1]))
+            grad_logits *= grad_output[start:end].unsqueeze(-1) / ctx.temperature
+            if needs_hidden_grad:
+                # Multiply in the dtype of the weight, rather than casting the whole weight for each chunk
+                grad_hidden_states[start:end] = (grad_logits.to(weight.dtype) @ weight).to(hidden_states.dtype)
+            if needs_weight_grad:
+                grad_weight += grad_logits.T @ hidden_states_chunk.to(dtype)
+            if needs_bias_grad:
+                grad_bias += grad_logits.sum(dim=0)
+        if needs_weight_grad:
+            grad_weight = grad_weight.to(weight.dtype)
+        if needs_bias_grad:
+            grad_bias = grad_bias.to(bias.dtype)
+        return grad_hidden_states, grad_weight, grad_bias, None, None, None
+
+
+def fused_selective_log_softmax(
+    hidden_states: torch.Tensor,
+    weight: torch.Tensor,
+    index: torch.Tensor,
+    bias: Optional[torch.Tensor] = None,
+    temperature: float = 1.0,
+    chunk_size: int = 1024,
+) -> torch.Tensor:
+    """
+    A memory-efficient implementation of the `linear -> log_softmax -> gather` operation of a language model head.
+
+    This function is equivalent to the following naive implementation:
+    ```python
+    logits = F.linear(hidden_states, weight, bias) / temperature
+    logps = selective_log_softmax(logits, index)
+    ```
+    but the full logits tensor is never materialized: the logits are computed `chunk_size` rows at a time (in at
+    least float32), and recomputed chunk by chunk in the backward pass.
+
+    Args:
+        hidden_states (`torch.Tensor`):
+            Hidden states tensor of shape `(..., hidden_size)`, typically the last hidden state of the model.
+        weight (`torch.Tensor`):
+            Weight of the language model head, of shape `(vocab_size, hidden_size)`.
+        index (`torch.Tensor`):
+            Index tensor of shape `(...)`, specifying the positions to gather from the log-softmax output.
+        bias (`torch.Tensor` or `None`, *optional*, defaults to `None`):
+            Bias of the language model head, of shape `(vocab_size,)`.
+        temperature (`float`, *optional*, defaults to `1.0`):
+            Temperature the logits are divided by.
+        chunk_size (`int`, *optional*, defaults to `1024`):
+            Number of rows of logits computed at once.
+
+    Returns:
+        `torch.Tensor`:
+            Gathered log probabilities with the same shape as `index`, in float32 (or float64 for float64 inputs).
+    """
+    per_token_logps = _FusedSelectiveLogSoftmax.apply(
+        hidden_states.reshape(-1, hidden_states.size(-1)), weight, bias, index.reshape(-1), temperature, chunk_size
+    )
+    return per_token_logps.view(index.shape)
+
+
 def print_prompt_completions_sample(
     prompts: list[str], completions: list[str], rewards: dict[str, list[float]], step: int, num_samples: int = None
 ) -> None: